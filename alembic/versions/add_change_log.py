@@ -0,0 +1,92 @@
+"""add change log
+
+Revision ID: add_change_log
+Revises: add_simplified_geometry_columns
+Create Date: 2024-06-03 09:41:27.552103
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'add_change_log'
+down_revision: Union[str, None] = 'add_simplified_geometry_columns'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Same SQL as models.CHANGE_LOG_DDL
+LOG_FUNCTION = """
+CREATE OR REPLACE FUNCTION log_cities_changes() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO cities_changes (op, feature_id, version, bbox_minx, bbox_miny, bbox_maxx, bbox_maxy)
+        SELECT 'create', id, version,
+               ST_XMin(geometry), ST_YMin(geometry), ST_XMax(geometry), ST_YMax(geometry)
+        FROM new_rows;
+    ELSIF TG_OP = 'UPDATE' THEN
+        INSERT INTO cities_changes (op, feature_id, version, bbox_minx, bbox_miny, bbox_maxx, bbox_maxy)
+        SELECT 'update', n.id, n.version,
+               LEAST(ST_XMin(o.geometry), ST_XMin(n.geometry)), LEAST(ST_YMin(o.geometry), ST_YMin(n.geometry)),
+               GREATEST(ST_XMax(o.geometry), ST_XMax(n.geometry)), GREATEST(ST_YMax(o.geometry), ST_YMax(n.geometry))
+        FROM new_rows n JOIN old_rows o ON o.id = n.id;
+    ELSE
+        INSERT INTO cities_changes (op, feature_id, version, bbox_minx, bbox_miny, bbox_maxx, bbox_maxy)
+        SELECT 'delete', id, version,
+               ST_XMin(geometry), ST_YMin(geometry), ST_XMax(geometry), ST_YMax(geometry)
+        FROM old_rows;
+    END IF;
+    IF FOUND THEN
+        PERFORM pg_notify('cities_changes', '');
+    END IF;
+    RETURN NULL;
+END
+$$
+"""
+
+TRIGGERS = {
+    'cities_log_insert': ('INSERT', 'NEW TABLE AS new_rows'),
+    'cities_log_update': ('UPDATE', 'OLD TABLE AS old_rows NEW TABLE AS new_rows'),
+    'cities_log_delete': ('DELETE', 'OLD TABLE AS old_rows'),
+}
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'cities_changes',
+        sa.Column('change_id', sa.BigInteger(), sa.Identity(), nullable=False),
+        sa.Column('seq', sa.BigInteger(), nullable=True),
+        sa.Column('xid', sa.BigInteger(), nullable=False,
+                  server_default=sa.text('CAST(CAST(pg_current_xact_id() AS text) AS bigint)')),
+        sa.Column('op', sa.String(), nullable=False),
+        sa.Column('feature_id', sa.Integer(), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=True),
+        sa.Column('bbox_minx', sa.Float(), nullable=True),
+        sa.Column('bbox_miny', sa.Float(), nullable=True),
+        sa.Column('bbox_maxx', sa.Float(), nullable=True),
+        sa.Column('bbox_maxy', sa.Float(), nullable=True),
+        sa.Column('changed_at', sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()),
+        sa.PrimaryKeyConstraint('change_id'),
+        sa.UniqueConstraint('seq'),
+    )
+    op.create_index('ix_cities_changes_changed_at', 'cities_changes', ['changed_at'])
+    op.create_index('ix_cities_changes_pending', 'cities_changes', ['xid'], postgresql_where=sa.text('seq IS NULL'))
+    op.execute(LOG_FUNCTION)
+    for name, (event, referencing) in TRIGGERS.items():
+        op.execute(
+            f'CREATE TRIGGER {name} AFTER {event} ON cities REFERENCING {referencing} '
+            'FOR EACH STATEMENT EXECUTE FUNCTION log_cities_changes()'
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    for name in TRIGGERS:
+        op.execute(f'DROP TRIGGER IF EXISTS {name} ON cities')
+    op.execute('DROP FUNCTION IF EXISTS log_cities_changes()')
+    op.drop_index('ix_cities_changes_pending', table_name='cities_changes')
+    op.drop_index('ix_cities_changes_changed_at', table_name='cities_changes')
+    op.drop_table('cities_changes')
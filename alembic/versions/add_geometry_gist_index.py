@@ -0,0 +1,30 @@
+"""add geometry gist index
+
+Revision ID: add_geometry_gist_index
+Revises: add_type_column
+Create Date: 2024-05-10 09:12:41.118203
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'add_geometry_gist_index'
+down_revision: Union[str, None] = 'add_type_column'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # GiST index used by the bbox (&&) and ST_Intersects/ST_Within/ST_DWithin queries.
+    # GeoAlchemy2 creates an index with the same name on create_all, so only add it if missing.
+    op.execute('CREATE INDEX IF NOT EXISTS idx_cities_geometry ON cities USING GIST (geometry)')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute('DROP INDEX IF EXISTS idx_cities_geometry')
@@ -0,0 +1,45 @@
+"""add geometry summary columns
+
+Revision ID: add_geometry_summary_columns
+Revises: add_name_search_indexes
+Create Date: 2024-06-17 11:05:48.203916
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'add_geometry_summary_columns'
+down_revision: Union[str, None] = 'add_name_search_indexes'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# column -> (type, expression), see models.GeoData
+COLUMNS = {
+    'bbox_minx': ('double precision', 'ST_XMin(geometry)'),
+    'bbox_miny': ('double precision', 'ST_YMin(geometry)'),
+    'bbox_maxx': ('double precision', 'ST_XMax(geometry)'),
+    'bbox_maxy': ('double precision', 'ST_YMax(geometry)'),
+    'centroid_x': ('double precision', 'ST_X(ST_Centroid(geometry))'),
+    'centroid_y': ('double precision', 'ST_Y(ST_Centroid(geometry))'),
+    'area': ('double precision', 'ST_Area(geography(geometry))'),
+    'length': ('double precision', 'ST_Length(geography(geometry))'),
+    'npoints': ('integer', 'ST_NPoints(geometry)'),
+}
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Stored generated columns are backfilled by the table rewrite; a single
+    # ALTER TABLE rewrites (and locks) the table once for all of them
+    op.execute('ALTER TABLE cities ' + ', '.join(
+        f'ADD COLUMN {name} {type_} GENERATED ALWAYS AS ({expression}) STORED'
+        for name, (type_, expression) in COLUMNS.items()
+    ))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute('ALTER TABLE cities ' + ', '.join(f'DROP COLUMN {name}' for name in reversed(list(COLUMNS))))
@@ -0,0 +1,36 @@
+"""add name search indexes
+
+Revision ID: add_name_search_indexes
+Revises: add_change_log
+Create Date: 2024-06-10 14:22:05.917342
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'add_name_search_indexes'
+down_revision: Union[str, None] = 'add_change_log'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    # Fuzzy matching (pg_trgm <% and similarity)
+    op.create_index(
+        'ix_cities_name_trgm', 'cities', ['name'],
+        postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'},
+    )
+    # Prefix range scans already in result order
+    op.create_index('ix_cities_name_prefix', 'cities', [sa.text('lower(name) COLLATE "C"')])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_cities_name_prefix', table_name='cities')
+    op.drop_index('ix_cities_name_trgm', table_name='cities')
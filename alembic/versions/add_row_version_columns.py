@@ -0,0 +1,31 @@
+"""add row version columns
+
+Revision ID: add_row_version_columns
+Revises: add_geometry_gist_index
+Create Date: 2024-05-14 16:03:27.540112
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'add_row_version_columns'
+down_revision: Union[str, None] = 'add_geometry_gist_index'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Existing rows start at version 1, stamped with the migration time
+    op.add_column('cities', sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+    op.add_column('cities', sa.Column('updated_at', sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('cities', 'updated_at')
+    op.drop_column('cities', 'version')
@@ -0,0 +1,39 @@
+"""add simplified geometry columns
+
+Revision ID: add_simplified_geometry_columns
+Revises: add_row_version_columns
+Create Date: 2024-05-21 10:12:44.318207
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from geoalchemy2 import Geometry
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'add_simplified_geometry_columns'
+down_revision: Union[str, None] = 'add_row_version_columns'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# zoom band -> ST_SimplifyPreserveTopology tolerance (degrees), see models.SIMPLIFIED_BANDS
+BANDS = {4: 0.05, 8: 0.005, 12: 0.0005}
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Stored generated columns: PostGIS keeps them in sync on every write
+    for zoom, tolerance in BANDS.items():
+        op.add_column('cities', sa.Column(
+            f'geometry_z{zoom}',
+            Geometry(geometry_type='GEOMETRY', srid=4326, spatial_index=False),
+            sa.Computed(f'ST_SimplifyPreserveTopology(geometry, {tolerance})', persisted=True),
+        ))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    for zoom in reversed(list(BANDS)):
+        op.drop_column('cities', f'geometry_z{zoom}')
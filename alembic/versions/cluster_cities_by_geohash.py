@@ -0,0 +1,48 @@
+"""cluster cities by geohash
+
+Revision ID: cluster_cities_by_geohash
+Revises:
+Create Date: 2024-06-24 10:12:37.481920
+
+First revision of the optional `layout` branch, see README "Storage
+Layout"; apply it with `alembic upgrade layout@head` (or up to this
+revision only, for the ordering without partitioning).
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'cluster_cities_by_geohash'
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = ('layout',)
+depends_on: Union[str, Sequence[str], None] = 'add_geometry_summary_columns'
+
+# Sort key along the geohash (Z-order) curve, from the stored centroid.
+# Coordinates are clamped because ST_GeoHash rejects values outside
+# lon/lat; the search_path is pinned so the index still builds when a
+# dump is restored with an empty one.
+GEOHASH_FUNCTION = """
+CREATE OR REPLACE FUNCTION cities_geohash(x double precision, y double precision) RETURNS text
+LANGUAGE sql IMMUTABLE PARALLEL SAFE SET search_path FROM CURRENT AS $$
+    SELECT ST_GeoHash(ST_SetSRID(ST_MakePoint(LEAST(GREATEST(x, -180), 180), LEAST(GREATEST(y, -90), 90)), 4326), 10)
+$$
+"""
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute(GEOHASH_FUNCTION)
+    op.execute('CREATE INDEX ix_cities_geohash ON cities (cities_geohash(centroid_x, centroid_y))')
+    # Rewrites the table in index order, under an ACCESS EXCLUSIVE lock;
+    # later runs are incremental, see `python -m app.layout recluster`
+    op.execute('CLUSTER cities USING ix_cities_geohash')
+    op.execute('ANALYZE cities')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute('DROP INDEX IF EXISTS ix_cities_geohash')
+    op.execute('DROP FUNCTION IF EXISTS cities_geohash(double precision, double precision)')
@@ -0,0 +1,177 @@
+"""partition cities
+
+Revision ID: partition_cities
+Revises: cluster_cities_by_geohash
+Create Date: 2024-06-25 14:30:02.118735
+
+Optional `layout` branch. Rebuilds `cities` as a partitioned table:
+
+- by `type`, one partition per geometry family (the single and Multi
+  types together) plus a default partition for any other value;
+- each of those by `cities_region(geometry)`: the cell of a
+  REGION_COLUMNS x REGION_ROWS lon/lat grid that contains the whole
+  bounding box, or -1 (the `_span` partition) when it crosses a cell
+  border or is empty.
+
+Filters on `type` prune the first level by themselves; bbox filters prune
+the second through the `cities_region(geometry) = ANY(cities_regions(bbox))`
+predicate crud adds when CITIES_PARTITIONED is set.
+
+A partition key computed from the geometry cannot be part of a primary
+key, so `id` is covered by a plain index; ids still come from the
+sequence. Rows are copied in geohash order, which leaves every partition
+clustered.
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'partition_cities'
+down_revision: Union[str, None] = 'cluster_cities_by_geohash'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+REGION_COLUMNS = 4
+REGION_ROWS = 2
+SPANNING_REGION = -1
+
+# partition suffix -> types
+FAMILIES = {
+    'point': ('Point', 'MultiPoint'),
+    'line': ('LineString', 'MultiLineString'),
+    'polygon': ('Polygon', 'MultiPolygon'),
+}
+DEFAULT_FAMILY = 'other'
+
+# Columns that are written; the generated ones are recomputed on insert
+COLUMNS = 'id, name, type, geometry, version, updated_at'
+
+FUNCTIONS = [
+    f"""
+    CREATE OR REPLACE FUNCTION cities_column(x double precision) RETURNS integer
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+        SELECT LEAST(GREATEST(floor((x + 180) / {360 // REGION_COLUMNS}), 0), {REGION_COLUMNS - 1})::integer
+    $$
+    """,
+    f"""
+    CREATE OR REPLACE FUNCTION cities_row(y double precision) RETURNS integer
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+        SELECT LEAST(GREATEST(floor((y + 90) / {180 // REGION_ROWS}), 0), {REGION_ROWS - 1})::integer
+    $$
+    """,
+    # The partition key. Pinned search_path, like cities_geohash, since
+    # restoring a dump evaluates it with an empty one.
+    f"""
+    CREATE OR REPLACE FUNCTION cities_region(g geometry) RETURNS integer
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE SET search_path FROM CURRENT AS $$
+        SELECT CASE
+            WHEN g IS NULL OR ST_IsEmpty(g) THEN {SPANNING_REGION}
+            WHEN cities_column(ST_XMin(g)) = cities_column(ST_XMax(g))
+             AND cities_row(ST_YMin(g)) = cities_row(ST_YMax(g))
+            THEN cities_column(ST_XMin(g)) + {REGION_COLUMNS} * cities_row(ST_YMin(g))
+            ELSE {SPANNING_REGION}
+        END
+    $$
+    """,
+    # Regions that can hold a feature overlapping the bbox. Immutable, so
+    # with constant arguments the planner folds it and prunes at plan time.
+    f"""
+    CREATE OR REPLACE FUNCTION cities_regions(
+        minx double precision, miny double precision, maxx double precision, maxy double precision
+    ) RETURNS integer[]
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+        SELECT array_append(array_agg(c + {REGION_COLUMNS} * r), {SPANNING_REGION})
+        FROM generate_series(cities_column(minx), cities_column(maxx)) AS c,
+             generate_series(cities_row(miny), cities_row(maxy)) AS r
+    $$
+    """,
+]
+DROP_FUNCTIONS = [
+    'DROP FUNCTION IF EXISTS cities_regions(double precision, double precision, double precision, double precision)',
+    'DROP FUNCTION IF EXISTS cities_region(geometry)',
+    'DROP FUNCTION IF EXISTS cities_row(double precision)',
+    'DROP FUNCTION IF EXISTS cities_column(double precision)',
+]
+
+# Same as the models' index=True columns, add_name_search_indexes,
+# add_geometry_gist_index and cluster_cities_by_geohash
+INDEXES = [
+    'CREATE INDEX ix_cities_id ON cities (id)',
+    'CREATE INDEX ix_cities_name ON cities (name)',
+    'CREATE INDEX ix_cities_type ON cities (type)',
+    'CREATE INDEX idx_cities_geometry ON cities USING GIST (geometry)',
+    'CREATE INDEX ix_cities_name_trgm ON cities USING gin (name gin_trgm_ops)',
+    'CREATE INDEX ix_cities_name_prefix ON cities (lower(name) COLLATE "C")',
+    'CREATE INDEX ix_cities_geohash ON cities (cities_geohash(centroid_x, centroid_y))',
+]
+
+# Same as add_change_log
+TRIGGERS = {
+    'cities_log_insert': ('INSERT', 'NEW TABLE AS new_rows'),
+    'cities_log_update': ('UPDATE', 'OLD TABLE AS old_rows NEW TABLE AS new_rows'),
+    'cities_log_delete': ('DELETE', 'OLD TABLE AS old_rows'),
+}
+
+
+def rebuild(table: str, partitioned: bool) -> None:
+    """Copy `cities` into `table` in geohash order and swap it in.
+
+    Writers are locked out for the duration, readers are not.
+    """
+    op.execute('LOCK TABLE cities IN EXCLUSIVE MODE')
+    op.execute(
+        f'CREATE TABLE {table} (LIKE cities INCLUDING DEFAULTS INCLUDING GENERATED INCLUDING STORAGE)'
+        + (' PARTITION BY LIST (type)' if partitioned else '')
+    )
+    if partitioned:
+        regions = [*range(REGION_COLUMNS * REGION_ROWS), SPANNING_REGION]
+        for family, types in [*FAMILIES.items(), (DEFAULT_FAMILY, None)]:
+            bounds = 'DEFAULT' if types is None else 'FOR VALUES IN (' + ', '.join(f"'{t}'" for t in types) + ')'
+            op.execute(
+                f'CREATE TABLE cities_{family} PARTITION OF {table} {bounds} '
+                'PARTITION BY LIST (cities_region(geometry))'
+            )
+            for region in regions:
+                suffix = 'span' if region == SPANNING_REGION else f'r{region}'
+                op.execute(f'CREATE TABLE cities_{family}_{suffix} PARTITION OF cities_{family} FOR VALUES IN ({region})')
+    op.execute(
+        f'INSERT INTO {table} ({COLUMNS}) SELECT {COLUMNS} FROM cities '
+        'ORDER BY cities_geohash(centroid_x, centroid_y)'
+    )
+    # The id sequence is owned by the old table and would be dropped with it
+    op.execute(f"""
+        DO $$ BEGIN
+            EXECUTE format('ALTER SEQUENCE %s OWNED BY {table}.id', pg_get_serial_sequence('cities', 'id'));
+        END $$
+    """)
+    op.execute('DROP TABLE cities')
+    op.execute(f'ALTER TABLE {table} RENAME TO cities')
+    if not partitioned:
+        op.execute('ALTER TABLE cities ADD CONSTRAINT cities_pkey PRIMARY KEY (id)')
+    for statement in INDEXES:
+        op.execute(statement)
+    for name, (event, referencing) in TRIGGERS.items():
+        op.execute(
+            f'CREATE TRIGGER {name} AFTER {event} ON cities REFERENCING {referencing} '
+            'FOR EACH STATEMENT EXECUTE FUNCTION log_cities_changes()'
+        )
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    for statement in FUNCTIONS:
+        op.execute(statement)
+    rebuild('cities_partitioned', partitioned=True)
+    op.execute('ANALYZE cities')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    rebuild('cities_unpartitioned', partitioned=False)
+    op.execute('ALTER TABLE cities CLUSTER ON ix_cities_geohash')
+    for statement in DROP_FUNCTIONS:
+        op.execute(statement)
+    op.execute('ANALYZE cities')
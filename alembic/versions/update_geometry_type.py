@@ -12,13 +12,15 @@ from geoalchemy2 import Geometry
 # revision identifiers, used by Alembic.
 revision = 'update_geometry_type'
 down_revision = None
-branch_labels = None
+# The main line; the optional storage layout is the `layout` branch
+branch_labels = ('schema',)
 depends_on = None
 
 
 def upgrade():
-    # Drop the existing table
-    op.drop_table('cities')
+    # Drop the existing table, if any: on a fresh database this is the
+    # first revision and creates it
+    op.execute('DROP TABLE IF EXISTS cities')
     
     # Create the table with the correct geometry type
     op.create_table(
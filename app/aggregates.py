@@ -0,0 +1,196 @@
+"""Dashboard aggregates computed in PostGIS.
+
+Every endpoint returns a compact summary (counts, extents, cell or cluster
+centres), so response size and Python work depend on the number of
+groups, not on the number of rows. Results are cached with the query bbox
+as their scope, so a write only invalidates the summaries it can change.
+"""
+import hashlib
+from typing import Optional
+
+import orjson
+from fastapi import HTTPException
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import crud, metrics, models
+from .cache import Rendered, cache
+
+MAX_GRID_CELLS = 10_000
+MIN_GRID_SIZE = 0.0001
+MAX_GEOHASH_PRECISION = 8
+MAX_KMEANS_CLUSTERS = 1000
+
+
+def _filters(bbox=None, type: Optional[str] = None):
+    filters = crud.query_filters(bbox)
+    if type is not None:
+        filters.append(models.GeoData.type == type)
+    return filters
+
+
+def _extent(row):
+    if row.minx is None:
+        return None
+    return [row.minx, row.miny, row.maxx, row.maxy]
+
+
+def _extent_columns(geometry=None):
+    if geometry is None:
+        # Table rows: aggregate the precomputed bbox columns, without
+        # reading any geometry
+        return (
+            func.min(models.GeoData.bbox_minx).label("minx"),
+            func.min(models.GeoData.bbox_miny).label("miny"),
+            func.max(models.GeoData.bbox_maxx).label("maxx"),
+            func.max(models.GeoData.bbox_maxy).label("maxy"),
+        )
+    extent = func.ST_Extent(geometry)
+    return (
+        func.ST_XMin(extent).label("minx"),
+        func.ST_YMin(extent).label("miny"),
+        func.ST_XMax(extent).label("maxx"),
+        func.ST_YMax(extent).label("maxy"),
+    )
+
+
+async def _cached(db: AsyncSession, name: str, params, bbox, statement, render):
+    key = f"agg:{name}:" + hashlib.sha1(orjson.dumps(params)).hexdigest()
+    rendered = cache.get(key)
+    if rendered is not None:
+        return rendered.body
+    generation = cache.generation()
+    with metrics.DB_SECONDS.time(operation=f"agg_{name}"):
+        rows = (await db.execute(statement)).all()
+    metrics.ROWS_RETURNED.observe(len(rows), operation=f"agg_{name}")
+    with metrics.SERIALIZE_SECONDS.time(operation=f"agg_{name}"):
+        body = orjson.dumps(render(rows))
+    cache.set(key, Rendered(body), {"extent": list(bbox) if bbox is not None else None}, since=generation)
+    return body
+
+
+async def type_counts(db: AsyncSession, bbox=None):
+    """Feature count and extent per `type`."""
+    statement = (
+        select(models.GeoData.type, func.count().label("count"), *_extent_columns())
+        .where(*_filters(bbox))
+        .group_by(models.GeoData.type)
+        .order_by(func.count().desc(), models.GeoData.type)
+    )
+    return await _cached(db, "types", [bbox], bbox, statement, lambda rows: {
+        "items": [{"type": row.type, "count": row.count, "extent": _extent(row)} for row in rows],
+    })
+
+
+async def extent(db: AsyncSession, bbox=None, type: Optional[str] = None):
+    """Total count and extent of the matching features."""
+    statement = select(func.count().label("count"), *_extent_columns()).where(*_filters(bbox, type))
+    return await _cached(db, "extent", [bbox, type], bbox, statement, lambda rows: {
+        "count": rows[0].count,
+        "extent": _extent(rows[0]),
+    })
+
+
+async def grid(
+    db: AsyncSession,
+    size: Optional[float] = None,
+    geohash: Optional[int] = None,
+    bbox=None,
+    type: Optional[str] = None,
+):
+    """Feature counts per grid cell of `size` degrees (ST_SnapToGrid on the
+    centroid) or per geohash prefix of `geohash` characters, with the mean
+    position of the features in each cell."""
+    if (size is None) == (geohash is None):
+        raise HTTPException(status_code=400, detail="Pass exactly one of size or geohash")
+    cx, cy = models.GeoData.centroid_x, models.GeoData.centroid_y
+    if geohash is not None:
+        cell = func.ST_GeoHash(func.ST_SetSRID(func.ST_MakePoint(cx, cy), 4326), geohash)
+        cell_columns = (cell.label("geohash"),)
+    else:
+        # Same cells as ST_SnapToGrid, from the precomputed centroid
+        cell_columns = (
+            (func.round(cx / size) * size).label("x"),
+            (func.round(cy / size) * size).label("y"),
+        )
+    # Cells are computed once per row in a subquery so the GROUP BY refers
+    # to plain columns rather than repeating the parameterized expression
+    points = (
+        select(*cell_columns, cx.label("cx"), cy.label("cy"))
+        .where(*_filters(bbox, type))
+        .subquery()
+    )
+    keys = [points.c[column.name] for column in cell_columns]
+    statement = (
+        select(
+            *keys,
+            func.count().label("count"),
+            func.avg(points.c.cx).label("mean_x"),
+            func.avg(points.c.cy).label("mean_y"),
+        )
+        .group_by(*keys)
+        .order_by(func.count().desc())
+        .limit(MAX_GRID_CELLS + 1)
+    )
+
+    def render(rows):
+        cells = [
+            {
+                **{key.name: getattr(row, key.name) for key in keys},
+                "count": row.count,
+                "center": [row.mean_x, row.mean_y],
+            }
+            for row in rows[:MAX_GRID_CELLS]
+        ]
+        return {"cells": cells, "truncated": len(rows) > MAX_GRID_CELLS}
+
+    return await _cached(db, "grid", [size, geohash, bbox, type], bbox, statement, render)
+
+
+async def clusters(
+    db: AsyncSession,
+    method: str = "kmeans",
+    k: int = 10,
+    eps: Optional[float] = None,
+    min_points: int = 5,
+    bbox=None,
+    type: Optional[str] = None,
+):
+    """Cluster the matching features with ST_ClusterKMeans (k clusters) or
+    ST_ClusterDBSCAN (eps degrees, min_points) and summarize each cluster."""
+    if method == "dbscan" and eps is None:
+        raise HTTPException(status_code=400, detail="dbscan clustering requires eps")
+    if method == "dbscan":
+        cluster = func.ST_ClusterDBSCAN(models.GeoData.geometry, eps, min_points).over()
+    else:
+        cluster = func.ST_ClusterKMeans(models.GeoData.geometry, k).over()
+    assigned = (
+        select(cluster.label("cluster"), models.GeoData.geometry.label("geometry"))
+        .where(*_filters(bbox, type))
+        .subquery()
+    )
+    center = func.ST_Centroid(func.ST_Collect(assigned.c.geometry))
+    statement = (
+        select(
+            assigned.c.cluster,
+            func.count().label("count"),
+            func.ST_X(center).label("x"),
+            func.ST_Y(center).label("y"),
+            *_extent_columns(assigned.c.geometry),
+        )
+        .group_by(assigned.c.cluster)
+        .order_by(assigned.c.cluster)
+    )
+
+    def render(rows):
+        # DBSCAN leaves points that belong to no cluster with a NULL id
+        noise = sum(row.count for row in rows if row.cluster is None)
+        items = [
+            {"cluster": row.cluster, "count": row.count, "center": [row.x, row.y], "extent": _extent(row)}
+            for row in rows
+            if row.cluster is not None
+        ]
+        return {"clusters": items, "noise": noise}
+
+    params = [method, k, eps, min_points, bbox, type]
+    return await _cached(db, "clusters", params, bbox, statement, render)
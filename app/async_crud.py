@@ -0,0 +1,414 @@
+"""Async versions of the crud functions, used by the async routes.
+
+Statements and serialization are shared with crud; writes use RETURNING
+so each call is a single round-trip instead of a write plus a re-select.
+Rendered responses are served from the response cache when possible, and
+every write invalidates the entries it can affect.
+
+When the in-memory replica is loaded (REPLICA_MODE=memory), reads are
+answered from it instead, without a database round-trip.
+
+Reads take the client's If-None-Match header. On a cache miss it is checked
+against the row versions alone, so a still-current client is answered
+without loading or serializing any geometry.
+"""
+import hashlib
+from collections import Counter
+from typing import Optional
+from fastapi import HTTPException
+from geoalchemy2 import Geometry
+from sqlalchemy import Integer, String, any_, column, delete, func, insert, literal, select, update, values
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+from . import crud, metrics, models, normalize, schemas
+from .cache import cache
+from .replica import replica
+
+
+def _use_replica(options: Optional[schemas.GeometryOptions] = None, size: Optional[schemas.SizeFilter] = None):
+    # The summary columns and size filters are computed by PostGIS, which
+    # the replica does not reproduce
+    if not replica.enabled:
+        return False
+    return (options is None or options.view is None) and (size is None or not size.key())
+
+
+async def _execute(db: AsyncSession, statement, operation: str, params=None):
+    """Execute and buffer the result, recording DB time and rows returned."""
+    with metrics.DB_SECONDS.time(operation=operation):
+        result = (await db.execute(statement, params)).freeze()
+    metrics.ROWS_RETURNED.observe(len(result.data), operation=operation)
+    return result()
+
+
+async def create_geo_data(db: AsyncSession, geo_data: schemas.GeoCreate):
+    """Insert a feature; returns the rendered feature and the normalization
+    steps applied to its geometry."""
+    geometry, changes = normalize.normalize_one(geo_data.geometry)
+    result = await _execute(
+        db,
+        insert(models.GeoData)
+        .values(
+            name=geo_data.name,
+            type=geo_data.type,
+            geometry=crud.geometry_element(geometry),
+        )
+        .returning(*crud.feature_columns(), *crud.bounds_columns()),
+        "create",
+    )
+    row = result.first()
+    await db.commit()
+    cache.invalidate([row.id], [crud.row_bounds(row)])
+    return crud.render_feature(row), changes
+
+
+async def get_geo_data(
+    db: AsyncSession,
+    geo_data_id: int,
+    if_none_match: Optional[str] = None,
+    options: Optional[schemas.GeometryOptions] = None,
+):
+    representation = options.key() if options else ""
+    fmt = crud.body_format(options)
+    if _use_replica(options):
+        row = replica.get(geo_data_id, options)
+        if row is not None:
+            return crud.render_feature(row, representation=representation, fmt=fmt)
+        # Possibly created since the last refresh; the database has the answer
+
+    key = f"feature:{geo_data_id}:{representation}"
+    rendered = cache.get(key)
+    if rendered is not None:
+        return rendered
+    generation = cache.generation()
+
+    if if_none_match:
+        result = await _execute(db, select(*crud.validator_columns()).where(models.GeoData.id == geo_data_id), "get_validators")
+        row = result.first()
+        if not row:
+            raise HTTPException(status_code=404, detail="Geo data not found")
+        if crud.etag_matches(if_none_match, crud.feature_etag(row, representation)):
+            return crud.render_feature(row, with_body=False, representation=representation)
+
+    result = await _execute(db, select(*crud.feature_columns(options)).where(models.GeoData.id == geo_data_id), "get")
+    row = result.first()
+    if not row:
+        raise HTTPException(status_code=404, detail="Geo data not found")
+
+    rendered = crud.render_feature(row, representation=representation, fmt=fmt)
+    cache.set(key, rendered, {"ids": [geo_data_id]}, since=generation)
+    return rendered
+
+
+async def _get_page(
+    db: AsyncSession,
+    key: str,
+    filters,
+    limit: int,
+    after_id: Optional[int],
+    if_none_match,
+    extent=None,
+    options: Optional[schemas.GeometryOptions] = None,
+):
+    rendered = cache.get(key)
+    if rendered is not None:
+        return rendered
+    generation = cache.generation()
+
+    if if_none_match:
+        statement = crud.keyset(select(*crud.validator_columns()).where(*filters), limit, after_id)
+        result = await _execute(db, statement, "page_validators")
+        rendered = crud.render_page(result.all(), limit, key, with_body=False)
+        if crud.etag_matches(if_none_match, rendered.etag):
+            return rendered
+
+    result = await _execute(db, crud.keyset(select(*crud.feature_columns(options)).where(*filters), limit, after_id), "page")
+    rows = result.all()
+    rendered = crud.render_page(rows, limit, key, fmt=crud.body_format(options))
+    cache.set(key, rendered, crud.page_scope(rows, limit, after_id, extent), since=generation)
+    return rendered
+
+
+async def list_geo_data(
+    db: AsyncSession,
+    limit: int = crud.DEFAULT_PAGE_SIZE,
+    after_id: Optional[int] = None,
+    if_none_match: Optional[str] = None,
+    options: Optional[schemas.GeometryOptions] = None,
+    size: Optional[schemas.SizeFilter] = None,
+):
+    key = f"list:{after_id}:{limit}:{options.key() if options else ''}:{size.key() if size else ''}"
+    if _use_replica(options, size):
+        rows = replica.query(limit=limit, after_id=after_id, options=options)
+        return crud.render_page(rows, limit, key, fmt=options.format if options else None)
+    return await _get_page(db, key, crud.size_filters(size), limit, after_id, if_none_match, options=options)
+
+
+async def query_geo_data(
+    db: AsyncSession,
+    bbox=None,
+    geo_query: Optional[schemas.GeoQuery] = None,
+    limit: int = crud.DEFAULT_PAGE_SIZE,
+    after_id: Optional[int] = None,
+    if_none_match: Optional[str] = None,
+    options: Optional[schemas.GeometryOptions] = None,
+    size: Optional[schemas.SizeFilter] = None,
+):
+    representation = options.key() if options else ""
+    params = (
+        f"{bbox}:{geo_query.model_dump_json() if geo_query else None}:{after_id}:{limit}:{representation}"
+        f":{size.key() if size else ''}"
+    )
+    key = "query:" + hashlib.sha1(params.encode()).hexdigest()
+    if _use_replica(options, size):
+        rows = replica.query(bbox, geo_query, limit, after_id, options)
+        return crud.render_page(rows, limit, key, fmt=options.format if options else None)
+    filters = crud.query_filters(bbox, geo_query, size)
+    extent = crud.query_extent(bbox, geo_query)
+    return await _get_page(db, key, filters, limit, after_id, if_none_match, extent, options)
+
+
+async def nearest_geo_data(
+    db: AsyncSession,
+    lon: float,
+    lat: float,
+    k: int = crud.DEFAULT_NEAREST,
+    type: Optional[str] = None,
+    name: Optional[str] = None,
+    options: Optional[schemas.GeometryOptions] = None,
+):
+    if replica.enabled:
+        rows = replica.nearest(lon, lat, k, type, name, options, crud.NEAREST_CANDIDATE_FACTOR)
+    else:
+        # Not cached: results are specific to the query point, and a write
+        # anywhere nearby can change them
+        radius = (await _execute(db, crud.nearest_radius_statement(lon, lat, k, type, name), "nearest_radius")).scalar()
+        result = await _execute(db, crud.nearest_statement(lon, lat, k, radius, type, name, options), "nearest")
+        rows = result.all()
+    with metrics.SERIALIZE_SECONDS.time(operation="nearest"):
+        return crud.nearest_json(rows)
+
+
+async def delete_geo_data(db: AsyncSession, geo_data_id: int):
+    result = await _execute(
+        db,
+        delete(models.GeoData)
+        .where(models.GeoData.id == geo_data_id)
+        .returning(models.GeoData.id, *crud.bounds_columns()),
+        "delete",
+    )
+    row = result.first()
+    if row is None:
+        await db.rollback()
+        raise HTTPException(status_code=404, detail="Geo data not found")
+    await db.commit()
+    cache.invalidate([geo_data_id], [crud.row_bounds(row)])
+    return {"message": "Geo data deleted successfully"}
+
+
+async def update_geo_data(db: AsyncSession, geo_data_id: int, geo_update: schemas.GeoCreate):
+    """Replace a feature; returns the rendered feature and the normalization
+    steps applied to its geometry."""
+    geometry, changes = normalize.normalize_one(geo_update.geometry)
+    # Joining the row to itself exposes the pre-update geometry in RETURNING,
+    # which is needed to invalidate cache entries covering the old location
+    old = aliased(models.GeoData)
+    result = await _execute(
+        db,
+        update(models.GeoData)
+        .where(models.GeoData.id == geo_data_id, old.id == models.GeoData.id)
+        .values(
+            name=geo_update.name,
+            type=geo_update.type,
+            geometry=crud.geometry_element(geometry),
+            version=models.GeoData.version + 1,
+            updated_at=func.now(),
+        )
+        .returning(*crud.feature_columns(), *crud.bounds_columns(), *crud.bounds_columns(old, "old")),
+        "update",
+    )
+    row = result.first()
+    if not row:
+        await db.rollback()
+        raise HTTPException(status_code=404, detail="Geo data not found")
+    await db.commit()
+    cache.invalidate([geo_data_id], [crud.row_bounds(row, "old"), crud.row_bounds(row)])
+    return crud.render_feature(row), changes
+
+
+# Rows per UPDATE ... FROM (VALUES ...) statement, which keeps each one well
+# under the 32767 bind parameter limit
+BATCH_UPDATE_CHUNK_SIZE = 1000
+
+
+def _batch_result(index, op, status, row=None, error=None):
+    return schemas.BatchResult(
+        index=index,
+        op=op.op,
+        status=status,
+        id=row.id if row is not None else getattr(op, "id", None),
+        version=row.version if row is not None else None,
+        error=error,
+    )
+
+
+async def _batch_create(db: AsyncSession, ops, results, bboxes):
+    # executemany + RETURNING is sent as multi-row INSERTs, with the rows
+    # returned in parameter order so they line up with `ops`
+    result = await _execute(
+        db,
+        insert(models.GeoData).returning(
+            models.GeoData.id, models.GeoData.version, *crud.bounds_columns(), sort_by_parameter_order=True
+        ),
+        "batch_create",
+        [
+            {"name": op.name, "type": op.type, "geometry": crud.geometry_element(geometry)}
+            for _, op, geometry in ops
+        ],
+    )
+    for (index, op, _), row in zip(ops, result.all()):
+        results[index] = _batch_result(index, op, 201, row)
+        bboxes.append(crud.row_bounds(row))
+
+
+async def _batch_update(db: AsyncSession, ops, results, bboxes):
+    found = {}
+    old = aliased(models.GeoData)
+    for start in range(0, len(ops), BATCH_UPDATE_CHUNK_SIZE):
+        chunk = ops[start:start + BATCH_UPDATE_CHUNK_SIZE]
+        batch = values(
+            column("id", Integer),
+            column("name", String),
+            column("type", String),
+            column("geometry", Geometry(srid=4326)),
+            name="batch",
+        ).data([(op.id, op.name, op.type, crud.geometry_element(geometry)) for _, op, geometry in chunk])
+        result = await _execute(
+            db,
+            update(models.GeoData)
+            .where(models.GeoData.id == batch.c.id, old.id == models.GeoData.id)
+            .values(
+                name=batch.c.name,
+                type=batch.c.type,
+                geometry=batch.c.geometry,
+                version=models.GeoData.version + 1,
+                updated_at=func.now(),
+            )
+            .returning(
+                models.GeoData.id,
+                models.GeoData.version,
+                *crud.bounds_columns(),
+                *crud.bounds_columns(old, "old"),
+            ),
+            "batch_update",
+        )
+        found.update((row.id, row) for row in result)
+    for index, op, _ in ops:
+        row = found.get(op.id)
+        if row is None:
+            results[index] = _batch_result(index, op, 404, error="Geo data not found")
+        else:
+            results[index] = _batch_result(index, op, 200, row)
+            bboxes.extend((crud.row_bounds(row, "old"), crud.row_bounds(row)))
+
+
+async def _batch_delete(db: AsyncSession, ops, results, bboxes):
+    ids = [op.id for _, op, _ in ops]
+    result = await _execute(
+        db,
+        delete(models.GeoData)
+        .where(models.GeoData.id == any_(literal(ids, ARRAY(Integer))))
+        .returning(models.GeoData.id, *crud.bounds_columns()),
+        "batch_delete",
+    )
+    found = {row.id: row for row in result}
+    for index, op, _ in ops:
+        row = found.get(op.id)
+        if row is None:
+            results[index] = _batch_result(index, op, 404, error="Geo data not found")
+        else:
+            results[index] = _batch_result(index, op, 200)
+            bboxes.append(crud.row_bounds(row))
+
+
+async def _run_batch_group(db: AsyncSession, runner, ops, results, bboxes, best_effort):
+    """Run one set-based statement group; in best-effort mode a database
+    error in the group is retried one operation at a time behind savepoints,
+    so only the offending operations fail."""
+    if not ops:
+        return
+    if not best_effort:
+        await runner(db, ops, results, bboxes)
+        return
+    try:
+        async with db.begin_nested():
+            await runner(db, ops, results, bboxes)
+    except DBAPIError:
+        for single in ops:
+            try:
+                async with db.begin_nested():
+                    await runner(db, [single], results, bboxes)
+            except DBAPIError as exc:
+                index, op, _ = single
+                results[index] = _batch_result(index, op, 400, error=str(exc.orig).strip())
+
+
+async def batch_geo_data(db: AsyncSession, batch: schemas.BatchRequest):
+    """Apply mixed create/update/delete operations in one transaction.
+
+    Each kind of operation is a single set-based statement (multi-row
+    INSERT ... RETURNING, UPDATE ... FROM (VALUES ...), DELETE ... WHERE
+    id = ANY(...)), run in that order. An id may be updated or deleted at
+    most once per batch. All create/update geometries are normalized
+    together before anything is written.
+    """
+    results = [None] * len(batch.operations)
+    groups = {"create": [], "update": [], "delete": []}
+    counts = Counter(op.id for op in batch.operations if op.op != "create")
+    writes = [index for index, op in enumerate(batch.operations) if op.op != "delete"]
+    normalized = normalize.normalize_schemas([batch.operations[index].geometry for index in writes])
+    geometries = dict(zip(writes, normalized.geometries))
+    changes = dict(zip(writes, normalized.changes))
+    errors = dict(zip(writes, normalized.errors))
+    for index, op in enumerate(batch.operations):
+        if op.op != "create" and counts[op.id] > 1:
+            results[index] = _batch_result(index, op, 409, error="Feature id appears more than once in the batch")
+        elif errors.get(index) is not None:
+            results[index] = _batch_result(index, op, 422, error=errors[index])
+        else:
+            groups[op.op].append((index, op, geometries.get(index)))
+
+    best_effort = batch.mode == "best_effort"
+    bboxes = []
+    try:
+        if best_effort or all(result is None for result in results):
+            await _run_batch_group(db, _batch_create, groups["create"], results, bboxes, best_effort)
+            await _run_batch_group(db, _batch_update, groups["update"], results, bboxes, best_effort)
+            await _run_batch_group(db, _batch_delete, groups["delete"], results, bboxes, best_effort)
+    except DBAPIError as exc:
+        await db.rollback()
+        raise HTTPException(status_code=409, detail=f"Batch rolled back: {str(exc.orig).strip()}")
+
+    failed = [result for result in results if result is not None and result.status >= 400]
+    if failed and not best_effort:
+        await db.rollback()
+        raise HTTPException(
+            status_code=409,
+            detail={"message": "Batch rolled back", "errors": [result.model_dump() for result in failed]},
+        )
+    await db.commit()
+
+    applied = [result for result in results if result.status < 400]
+    for result in applied:
+        result.normalized = changes.get(result.index) or None
+    cache.invalidate([result.id for result in applied], bboxes)
+    done = Counter(result.op for result in applied)
+    return schemas.BatchReport(
+        created=done["create"],
+        updated=done["update"],
+        deleted=done["delete"],
+        failed=len(failed),
+        results=results,
+    )
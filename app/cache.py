@@ -0,0 +1,375 @@
+"""Response cache for rendered features, pages and tiles.
+
+Every entry is stored with a *scope* describing what it depends on:
+
+- ``{"ids": [...]}`` for single features
+- ``{"id_range": [lo, hi], "extent": [minx, miny, maxx, maxy]}`` for list and
+  query pages (``hi`` is ``None`` on the last page, ``extent`` is ``None``
+  for unfiltered lists)
+- ``{"extent": [...]}`` for tiles
+
+Writes call ``invalidate(ids, bboxes)`` with the ids they touched and the
+bounding boxes of the old and new geometries, and only entries whose scope
+matches are dropped. ``ids=None`` means "new rows appended after every
+existing id" (bulk import), which hits only open-ended pages and extents.
+Writes from other processes are invalidated the same way by the change
+hub (app.changes), once they show up in the change log.
+
+A reader that misses calls ``generation()`` before reading the database
+and passes it to ``set(..., since=generation)``. Every invalidation bumps
+the generation and is remembered (the last CACHE_INVALIDATION_LOG of
+them); ``set`` drops the entry if one of the invalidations since the read
+started affects its scope. Otherwise a body read just before a commit
+could be cached after that commit's invalidation and stay stale until
+the TTL.
+
+Backends: an in-process LRU with size and TTL eviction (default) and a
+Redis-style backend that works with ``redis.Redis`` or the ``LocalRedis``
+stand-in. Configured with CACHE_BACKEND=lru|redis|none, CACHE_MAX_ENTRIES,
+CACHE_TTL (seconds) and REDIS_URL.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Iterable, NamedTuple, Optional
+
+import orjson
+
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "lru")
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "300"))
+REDIS_URL = os.getenv("REDIS_URL")
+CACHE_INVALIDATION_LOG = int(os.getenv("CACHE_INVALIDATION_LOG", "1000"))
+
+
+class Rendered(NamedTuple):
+    """A rendered response body with its validators.
+
+    `body` is None when only the validators were loaded (the client's copy
+    is still current and the response will be a 304).
+    """
+    body: Optional[bytes]
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+    def encode(self) -> bytes:
+        return orjson.dumps([self.etag, self.last_modified]) + b"\n" + self.body
+
+    @classmethod
+    def decode(cls, data: bytes):
+        header, body = data.split(b"\n", 1)
+        return cls(body, *orjson.loads(header))
+
+
+def _overlaps(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def affected(scope, ids: Optional[Iterable[int]], bboxes):
+    """Whether a write touching `ids` and `bboxes` can change an entry."""
+    if "ids" in scope:
+        return ids is not None and any(i in scope["ids"] for i in ids)
+
+    lo, hi = scope.get("id_range") or (None, None)
+    if ids is None:
+        in_range = hi is None
+    else:
+        in_range = any((lo is None or i >= lo) and (hi is None or i <= hi) for i in ids)
+    if not in_range:
+        return False
+
+    extent = scope.get("extent")
+    return extent is None or any(_overlaps(extent, bbox) for bbox in bboxes if bbox is not None)
+
+
+def invalidated_since(log, generation: int, since: int, scope) -> bool:
+    """Whether an invalidation after generation `since` affects `scope`.
+
+    `log` holds (generation, ids, bboxes) of the most recent invalidations;
+    when it no longer reaches back to `since`, the answer is yes.
+    """
+    if generation == since:
+        return False
+    if generation - since > len(log):
+        return True
+    return any(gen > since and affected(scope, ids, bboxes) for gen, ids, bboxes in log)
+
+
+class LRUBackend:
+    """In-process cache with LRU eviction past `max_entries` and a TTL."""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires_at, value, scope)
+        self.generation = 0
+        self.log = deque(maxlen=CACHE_INVALIDATION_LOG)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def current_generation(self):
+        return self.generation
+
+    def set(self, key, value, scope, since=None):
+        with self.lock:
+            if since is not None and invalidated_since(self.log, self.generation, since, scope):
+                return False
+            self.entries[key] = (time.monotonic() + self.ttl, value, scope)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            return True
+
+    def invalidate(self, ids, bboxes):
+        with self.lock:
+            self.generation += 1
+            self.log.append((self.generation, ids, bboxes))
+            stale = [key for key, (_, _, scope) in self.entries.items() if affected(scope, ids, bboxes)]
+            for key in stale:
+                del self.entries[key]
+        return len(stale)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class LocalRedis:
+    """The subset of the redis.Redis API used by RedisBackend, in memory.
+
+    Lets the Redis backend run in tests and single-node setups without a
+    Redis server.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.hashes = {}
+        self.lists = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                return None
+            if entry[1] is not None and entry[1] < time.monotonic():
+                del self.values[key]
+                return None
+            return entry[0]
+
+    def set(self, key, value, ex=None):
+        with self.lock:
+            self.values[key] = (value, time.monotonic() + ex if ex else None)
+
+    def delete(self, *keys):
+        with self.lock:
+            return sum(self.values.pop(key, None) is not None for key in keys)
+
+    def hset(self, name, key, value):
+        with self.lock:
+            self.hashes.setdefault(name, {})[key] = value
+
+    def hgetall(self, name):
+        with self.lock:
+            return dict(self.hashes.get(name, {}))
+
+    def hdel(self, name, *keys):
+        with self.lock:
+            fields = self.hashes.get(name, {})
+            return sum(fields.pop(key, None) is not None for key in keys)
+
+    def hlen(self, name):
+        with self.lock:
+            return len(self.hashes.get(name, {}))
+
+    def incr(self, key):
+        with self.lock:
+            value = int(self.values.get(key, (0, None))[0]) + 1
+            self.values[key] = (value, None)
+            return value
+
+    def lpush(self, name, *values):
+        with self.lock:
+            items = self.lists.setdefault(name, [])
+            items[:0] = reversed(values)
+            return len(items)
+
+    def ltrim(self, name, start, end):
+        with self.lock:
+            items = self.lists.get(name, [])
+            self.lists[name] = items[start:end + 1 if end != -1 else None]
+
+    def lrange(self, name, start, end):
+        with self.lock:
+            return list(self.lists.get(name, [])[start:end + 1 if end != -1 else None])
+
+
+class RedisBackend:
+    """Cache entries in Redis, with the scope index in a Redis hash so every
+    worker sharing the server sees (and invalidates) the same entries.
+
+    Each scope is stored with its key's expiry time, and expired ones are
+    pruned by `invalidate`, so the hash only holds live entries. The
+    generation counter and invalidation log are shared too.
+    """
+
+    def __init__(self, client, prefix="gis", ttl=CACHE_TTL):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+        self.scopes_key = f"{prefix}:scopes"
+        self.generation_key = f"{prefix}:generation"
+        self.log_key = f"{prefix}:invalidations"
+
+    def _key(self, key):
+        return f"{self.prefix}:{key}"
+
+    def get(self, key):
+        data = self.client.get(self._key(key))
+        return Rendered.decode(data) if data is not None else None
+
+    def current_generation(self):
+        return int(self.client.get(self.generation_key) or 0)
+
+    def _invalidated_since(self, since, scope):
+        log = [orjson.loads(entry) for entry in self.client.lrange(self.log_key, 0, -1)]
+        return invalidated_since(log, self.current_generation(), since, scope)
+
+    def set(self, key, value, scope, since=None):
+        if since is not None and self._invalidated_since(since, scope):
+            return False
+        expires_at = time.time() + self.ttl if self.ttl else None
+        self.client.set(self._key(key), value.encode(), ex=int(self.ttl) or None)
+        self.client.hset(self.scopes_key, key, orjson.dumps([expires_at, scope]))
+        # invalidate() logs before it scans the scopes: an invalidation it
+        # ran without seeing this entry is in the log by now
+        if since is not None and self._invalidated_since(since, scope):
+            self.client.delete(self._key(key))
+            self.client.hdel(self.scopes_key, key)
+            return False
+        return True
+
+    def invalidate(self, ids, bboxes):
+        generation = self.client.incr(self.generation_key)
+        self.client.lpush(self.log_key, orjson.dumps([generation, ids, bboxes]))
+        self.client.ltrim(self.log_key, 0, CACHE_INVALIDATION_LOG - 1)
+        now = time.time()
+        stale = []
+        expired = []
+        for key, entry in self.client.hgetall(self.scopes_key).items():
+            key = key.decode() if isinstance(key, bytes) else key
+            expires_at, scope = orjson.loads(entry)
+            if expires_at is not None and expires_at < now:
+                expired.append(key)
+            elif affected(scope, ids, bboxes):
+                stale.append(key)
+        if expired:
+            self.client.hdel(self.scopes_key, *expired)
+        if stale:
+            self.client.delete(*(self._key(key) for key in stale))
+            self.client.hdel(self.scopes_key, *stale)
+        return len(stale)
+
+    def clear(self):
+        keys = list(self.client.hgetall(self.scopes_key))
+        if keys:
+            self.client.delete(*(self._key(k.decode() if isinstance(k, bytes) else k) for k in keys))
+            self.client.hdel(self.scopes_key, *keys)
+
+    def __len__(self):
+        return self.client.hlen(self.scopes_key)
+
+
+class ResponseCache:
+    """Front end used by the read and write paths; counts hits and misses."""
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def get(self, key) -> Optional[Rendered]:
+        if self.backend is None:
+            return None
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def generation(self) -> Optional[int]:
+        """Token to pass to `set` for a body about to be read."""
+        if self.backend is None:
+            return None
+        return self.backend.current_generation()
+
+    def set(self, key, value: Rendered, scope, since: Optional[int] = None):
+        """Store `value`, unless a write since generation `since` affects it."""
+        if self.backend is not None:
+            self.backend.set(key, value, scope, since)
+
+    def invalidate(self, ids: Optional[Iterable[int]], bboxes=()):
+        if self.backend is not None:
+            ids = list(ids) if ids is not None else None
+            self.invalidations += self.backend.invalidate(ids, list(bboxes))
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self.backend).__name__ if self.backend is not None else None,
+            "entries": len(self.backend) if self.backend is not None else 0,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "invalidated": self.invalidations,
+        }
+
+
+def shared_across_processes(name=CACHE_BACKEND, redis_url=REDIS_URL) -> bool:
+    """Whether every worker process sees the same entries (and invalidations).
+
+    The LRU and the LocalRedis stand-in live in one process: with several
+    workers, a write only clears the cache of the worker that handled it
+    at once, and the others serve stale bodies until the change feed
+    reaches them.
+    """
+    return name == "none" or (name == "redis" and bool(redis_url))
+
+
+def build_backend(name=CACHE_BACKEND):
+    if name == "none":
+        return None
+    if name == "redis":
+        if REDIS_URL:
+            import redis  # optional dependency, only needed for a real server
+
+            return RedisBackend(redis.Redis.from_url(REDIS_URL))
+        return RedisBackend(LocalRedis())
+    return LRUBackend()
+
+
+cache = ResponseCache(build_backend())
@@ -0,0 +1,354 @@
+"""Change log and change feed for incremental sync.
+
+Statement-level triggers on `cities` (models.CHANGE_LOG_DDL) append one
+`cities_changes` row per created, updated or deleted feature and send a
+NOTIFY on CHANGES_CHANNEL. Every write path (single writes, batches, bulk
+COPY, raw SQL) is therefore logged in the writing transaction.
+
+Sequence numbers follow commit order. Rows are logged with their
+transaction id and no seq; `sequence()` numbers, under an advisory lock,
+the rows of every transaction older than the oldest one still running. A
+seq is only handed out once no change with a lower one can still commit,
+so a client that has seen seq N misses nothing by asking for `since=N`.
+The price is that a change shows up only after every transaction that was
+already running when it was written has finished.
+
+Rows older than CHANGE_RETENTION_DAYS are pruned. A `since` before the
+oldest kept row gets 410, and the client has to resync from the list
+endpoint.
+
+Numbering and pruning run in the background, never on the read path: the
+ChangeHub of every worker calls `sequence()` on each notification and
+poll (the advisory lock lets one of them at a time do the work), and a
+`sequence()` that numbered rows sends a NOTIFY of its own, which wakes
+the hubs of the other workers to read them.
+
+WebSocket subscribers are fed by one ChangeHub per process: it LISTENs on
+a dedicated connection, and on every notification (or every
+CHANGES_POLL_INTERVAL seconds, which also covers PgBouncer setups where
+LISTEN is unavailable) reads the new changes once and hands each to the
+subscribers whose bbox it overlaps.
+
+The hub also keeps the response cache in step with writes made anywhere
+else: other workers, the bulk loader CLI, app.layout or plain SQL. Every
+change it reads invalidates the cached entries for its feature id and
+bbox. It runs from startup (main.lifespan).
+"""
+import asyncio
+import contextlib
+import logging
+import os
+from typing import Optional
+
+import orjson
+from fastapi import HTTPException, WebSocket, WebSocketDisconnect, status
+from sqlalchemy import func, select, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.orm import Session
+
+from . import crud, database, metrics, models
+from .cache import cache
+
+CHANGES_CHANNEL = "cities_changes"
+CHANGE_RETENTION_DAYS = float(os.getenv("CHANGE_RETENTION_DAYS", "7"))
+CHANGES_POLL_INTERVAL = float(os.getenv("CHANGES_POLL_INTERVAL", "1"))
+CHANGES_QUEUE_SIZE = int(os.getenv("CHANGES_QUEUE_SIZE", "1000"))
+# pg_try_advisory_xact_lock key serializing sequence()
+SEQUENCE_LOCK = 0x63697479
+# WebSocket close codes
+WS_CHANGES_PRUNED = 4410
+WS_TRY_AGAIN_LATER = 1013
+
+SEQUENCE_SQL = text("""
+    WITH pending AS (
+        SELECT change_id, row_number() OVER (ORDER BY xid, change_id) AS n
+        FROM cities_changes
+        WHERE seq IS NULL
+          AND xid < CAST(CAST(pg_snapshot_xmin(pg_current_snapshot()) AS text) AS bigint)
+    ),
+    head AS (SELECT coalesce(max(seq), 0) AS seq FROM cities_changes)
+    UPDATE cities_changes SET seq = head.seq + pending.n
+    FROM pending, head
+    WHERE cities_changes.change_id = pending.change_id
+""")
+
+# The newest row is kept so the position survives a quiet retention period
+PRUNE_SQL = text("""
+    DELETE FROM cities_changes
+    WHERE changed_at < now() - make_interval(secs => :retention)
+      AND seq < (SELECT max(seq) FROM cities_changes)
+""")
+
+logger = logging.getLogger(__name__)
+
+
+async def sequence(db: AsyncSession):
+    """Number the changes that can no longer be preceded by a commit and
+    prune expired ones; a no-op while another worker is doing it."""
+    with metrics.DB_SECONDS.time(operation="changes_sequence"):
+        locked = (await db.execute(select(func.pg_try_advisory_xact_lock(SEQUENCE_LOCK)))).scalar()
+        if locked:
+            if (await db.execute(SEQUENCE_SQL)).rowcount:
+                await db.execute(select(func.pg_notify(CHANGES_CHANNEL, "")))
+            await db.execute(PRUNE_SQL, {"retention": CHANGE_RETENTION_DAYS * 86400})
+        await db.commit()
+
+
+def sequence_sync(db: Session):
+    """sequence() for sync sessions (the memory replica)."""
+    with metrics.DB_SECONDS.time(operation="changes_sequence"):
+        if db.scalar(select(func.pg_try_advisory_xact_lock(SEQUENCE_LOCK))):
+            if db.execute(SEQUENCE_SQL).rowcount:
+                db.execute(select(func.pg_notify(CHANGES_CHANNEL, "")))
+            db.execute(PRUNE_SQL, {"retention": CHANGE_RETENTION_DAYS * 86400})
+        db.commit()
+
+
+def changes_statement(since: int, until: Optional[int], limit: int, bbox=None):
+    """Changes after `since` (up to `until`), each with the current state of
+    its feature, or NULLs when it has been deleted since."""
+    change = models.GeoDataChange
+    statement = (
+        select(
+            change.seq,
+            change.op,
+            change.feature_id.label("id"),
+            change.version,
+            change.changed_at,
+            change.bbox_minx,
+            change.bbox_miny,
+            change.bbox_maxx,
+            change.bbox_maxy,
+            models.GeoData.id.label("current_id"),
+            models.GeoData.name,
+            func.GeometryType(models.GeoData.geometry).label("geometry_type"),
+            func.ST_AsGeoJSON(models.GeoData.geometry, crud.GEOJSON_MAX_DECIMALS).label("geojson"),
+        )
+        .outerjoin(models.GeoData, (models.GeoData.id == change.feature_id) & (change.op != "delete"))
+        .where(change.seq > since)
+        .order_by(change.seq)
+        .limit(limit + 1)
+    )
+    if until is not None:
+        statement = statement.where(change.seq <= until)
+    if bbox is not None:
+        minx, miny, maxx, maxy = bbox
+        statement = statement.where(
+            change.bbox_maxx >= minx,
+            change.bbox_minx <= maxx,
+            change.bbox_maxy >= miny,
+            change.bbox_miny <= maxy,
+        )
+    return statement
+
+
+def change_item(row) -> dict:
+    return {
+        "seq": row.seq,
+        "op": row.op,
+        "id": row.id,
+        "version": row.version,
+        "changed_at": row.changed_at,
+        "feature": orjson.Fragment(crud.row_json(row)) if row.current_id is not None else None,
+    }
+
+
+async def read_changes(db: AsyncSession, since: Optional[int], limit: int = crud.DEFAULT_PAGE_SIZE, bbox=None):
+    """(items, next, more) for the changes after `since`.
+
+    Without `since` there are no items and `next` is the current position,
+    the starting point for a client about to do a full sync. Only reads:
+    the hub numbers new changes in the background.
+    """
+    change = models.GeoDataChange
+    oldest, head = (await db.execute(select(func.min(change.seq), func.max(change.seq)))).one()
+    head = head or 0
+    if since is None:
+        return [], head, False
+    if oldest is not None and since < oldest - 1:
+        raise HTTPException(
+            status_code=410,
+            detail=f"Changes after {since} have been pruned; resync from /geo-data/list/",
+        )
+    head = max(head, since)
+    with metrics.DB_SECONDS.time(operation="changes"):
+        rows = (await db.execute(changes_statement(since, head, limit, bbox))).all()
+    metrics.ROWS_RETURNED.observe(len(rows), operation="changes")
+    more = len(rows) > limit
+    # A short page has seen everything up to head, even if the bbox
+    # filtered it all out
+    next_seq = rows[limit - 1].seq if more else head
+    return [change_item(row) for row in rows[:limit]], next_seq, more
+
+
+async def changes_since(db: AsyncSession, since: Optional[int], limit: int = crud.DEFAULT_PAGE_SIZE, bbox=None) -> bytes:
+    items, next_seq, more = await read_changes(db, since, limit, bbox)
+    with metrics.SERIALIZE_SECONDS.time(operation="changes"):
+        return orjson.dumps({"changes": items, "next": next_seq, "more": more})
+
+
+def _overlaps(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+class Subscription:
+    """Queue of encoded changes for one WebSocket client."""
+
+    def __init__(self, bbox=None):
+        self.bbox = bbox
+        self.queue = asyncio.Queue(CHANGES_QUEUE_SIZE)
+        self.overflowed = False
+
+    def offer(self, seq: int, bounds, message: bytes):
+        if self.overflowed:
+            # Nothing after the gap is queued, so what is queued can still
+            # be delivered before the client is told to resume
+            return
+        if self.bbox is not None and (bounds is None or not _overlaps(bounds, self.bbox)):
+            return
+        try:
+            self.queue.put_nowait((seq, message))
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+
+class ChangeHub:
+    """Reads new changes once per process and fans them out to subscribers."""
+
+    def __init__(self):
+        self.subscribers = set()
+        self._reset()
+
+    def _reset(self):
+        self.position = None
+        self.task = None
+        self.ready = asyncio.Event()
+        self.wake = asyncio.Event()
+
+    def start(self, engine):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run(engine))
+
+    def subscribe(self, engine, bbox=None) -> Subscription:
+        self.start(engine)
+        subscription = Subscription(bbox)
+        self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self.subscribers.discard(subscription)
+
+    async def run(self, engine):
+        while True:
+            try:
+                await self._listen(engine)
+            except Exception:
+                logger.exception("Change feed listener failed")
+                await asyncio.sleep(CHANGES_POLL_INTERVAL)
+
+    async def _listen(self, engine):
+        sessions = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+        async with contextlib.AsyncExitStack() as stack:
+            if not database.DB_PGBOUNCER:
+                # Transaction pooling would hand the LISTEN to another client
+                listener = await stack.enter_async_context(engine.connect())
+                raw = (await listener.get_raw_connection()).driver_connection
+                await raw.add_listener(CHANGES_CHANNEL, lambda *args: self.wake.set())
+            while True:
+                self.wake.clear()
+                async with sessions() as db:
+                    await sequence(db)
+                    if self.subscribers or self.position is None or cache.enabled:
+                        await self.publish(db)
+                # Also polled: rows held back by a running transaction are
+                # not numbered yet when their NOTIFY arrives
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self.wake.wait(), CHANGES_POLL_INTERVAL)
+
+    async def publish(self, db: AsyncSession):
+        if self.position is None:
+            self.position = (await db.execute(select(func.coalesce(func.max(models.GeoDataChange.seq), 0)))).scalar()
+            self.ready.set()
+        while True:
+            rows = (await db.execute(changes_statement(self.position, None, crud.MAX_PAGE_SIZE))).all()
+            page = rows[:crud.MAX_PAGE_SIZE]
+            bounds = [crud.row_bounds(row) for row in page]
+            if page:
+                # The worker that made a change has invalidated already;
+                # this reaches the other workers and writes from outside the app
+                cache.invalidate([row.id for row in page], [bbox for bbox in bounds if bbox is not None])
+            for row, bbox in zip(page, bounds):
+                message = orjson.dumps(change_item(row))
+                for subscription in list(self.subscribers):
+                    subscription.offer(row.seq, bbox, message)
+                self.position = row.seq
+            if len(rows) <= crud.MAX_PAGE_SIZE:
+                return
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.task
+        self._reset()
+
+
+hub = ChangeHub()
+
+
+async def _wait_disconnect(websocket: WebSocket):
+    while (await websocket.receive())["type"] != "websocket.disconnect":
+        pass
+
+
+async def _push(websocket: WebSocket, db: AsyncSession, subscription: Subscription, since: Optional[int]):
+    await hub.ready.wait()
+    last = hub.position
+    if since is not None:
+        # Everything after hub.position reaches the queue, so replaying
+        # until the feed head leaves no gap; queued duplicates are skipped
+        last = since
+        while True:
+            try:
+                items, last, more = await read_changes(db, last, crud.MAX_PAGE_SIZE, subscription.bbox)
+            except HTTPException as exc:
+                await websocket.close(code=WS_CHANGES_PRUNED, reason=exc.detail)
+                return
+            for item in items:
+                await websocket.send_text(orjson.dumps(item).decode())
+            if not more:
+                break
+        # Don't hold a connection for the lifetime of the socket
+        await db.close()
+    while True:
+        if subscription.overflowed and subscription.queue.empty():
+            await websocket.close(code=WS_TRY_AGAIN_LATER, reason=f"Subscriber fell behind; reconnect with since={last}")
+            return
+        seq, message = await subscription.queue.get()
+        if seq <= last:
+            continue
+        await websocket.send_text(message.decode())
+        last = seq
+
+
+async def serve(websocket: WebSocket, db: AsyncSession, since: Optional[int] = None, bbox: Optional[str] = None):
+    """Send the changes after `since` (if given), then push new ones as
+    they are committed until the client disconnects."""
+    try:
+        bbox = crud.parse_bbox(bbox) if bbox is not None else None
+    except HTTPException as exc:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=exc.detail)
+        return
+    await websocket.accept()
+    subscription = hub.subscribe(db.bind, bbox)
+    push = asyncio.create_task(_push(websocket, db, subscription, since))
+    closed = asyncio.create_task(_wait_disconnect(websocket))
+    try:
+        done, pending = await asyncio.wait({push, closed}, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        if push in done:
+            with contextlib.suppress(WebSocketDisconnect):
+                push.result()
+    finally:
+        hub.unsubscribe(subscription)
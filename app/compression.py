@@ -0,0 +1,282 @@
+"""Response compression negotiated from Accept-Encoding.
+
+Supports gzip (stdlib), brotli (``brotli``) and zstd (``zstandard``); both
+libraries are in requirements.txt, and an encoding whose library is missing
+is not offered.
+Configured with COMPRESSION_ENCODINGS (comma separated, in server
+preference order, empty to disable) and COMPRESSION_MIN_SIZE (bytes;
+smaller bodies are sent as is, compressing them costs more than it saves).
+
+Complete bodies with a strong ETag (features and pages) are compressed
+once per encoding and the result is kept in a byte-bounded LRU keyed by
+the ETag, so a hot response is not recompressed on every request. The
+ETag changes with every row version, so entries never go stale; they are
+evicted once COMPRESSION_CACHE_BYTES is exceeded. Streamed bodies are
+compressed chunk by chunk and flushed after each chunk, so the client
+still receives rows as they are read.
+"""
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+from . import metrics
+
+COMPRESSION_ENCODINGS = [
+    encoding.strip() for encoding in os.getenv("COMPRESSION_ENCODINGS", "br,zstd,gzip").split(",") if encoding.strip()
+]
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_CACHE_BYTES = int(os.getenv("COMPRESSION_CACHE_BYTES", str(64 << 20)))
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+ZSTD_LEVEL = 3
+
+COMPRESSIBLE_TYPES = (
+    "application/json",
+    "application/geo+json",
+    "application/x-ndjson",
+    "application/vnd.geo-features",
+    "application/vnd.mapbox-vector-tile",
+    "text/",
+)
+
+
+class _Gzip:
+    def __init__(self):
+        self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class _Brotli:
+    def __init__(self):
+        import brotli
+
+        self.compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data):
+        return self.compressor.process(data) + self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+class _Zstd:
+    def __init__(self):
+        import zstandard
+
+        self.module = zstandard
+        self.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    def compress(self, data):
+        return self.compressor.compress(data) + self.compressor.flush(self.module.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+COMPRESSORS = {"gzip": _Gzip, "br": _Brotli, "zstd": _Zstd}
+
+
+def _available(encoding):
+    try:
+        COMPRESSORS[encoding]()
+    except (KeyError, ImportError):
+        return False
+    return True
+
+
+ENCODINGS = [encoding for encoding in COMPRESSION_ENCODINGS if _available(encoding)]
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    with metrics.SERIALIZE_SECONDS.time(operation=f"compress_{encoding}"):
+        compressor = COMPRESSORS[encoding]()
+        return compressor.compress(body) + compressor.finish()
+
+
+def negotiate(accept_encoding, encodings=None):
+    """The encoding to use for an Accept-Encoding header, or None for identity.
+
+    The highest q-value wins; ties go to the earlier entry in `encodings`.
+    """
+    encodings = ENCODINGS if encodings is None else encodings
+    if not accept_encoding or not encodings:
+        return None
+    weights = {}
+    for part in accept_encoding.split(","):
+        coding, *params = part.split(";")
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[coding.strip().lower()] = q
+    default = weights.get("*", 0.0)
+    best, best_q = None, 0.0
+    for encoding in encodings:
+        q = weights.get(encoding, default)
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def compressible(headers) -> bool:
+    if b"content-encoding" in headers:
+        return False
+    content_type = headers.get(b"content-type", b"").decode("latin-1")
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+class VariantCache:
+    """Byte-bounded LRU of compressed bodies keyed by (ETag, encoding)."""
+
+    def __init__(self, max_bytes: int = COMPRESSION_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            body = self.entries.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return body
+
+    def set(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self.entries[key] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {"entries": len(self.entries), "bytes": self.size, "hits": self.hits, "misses": self.misses}
+
+
+variants = VariantCache()
+
+
+def _strong_etag(headers):
+    etag = headers.get(b"etag")
+    return etag if etag is not None and not etag.startswith(b"W/") else None
+
+
+class CompressionMiddleware:
+    """ASGI middleware compressing responses the client accepts encoded."""
+
+    def __init__(self, app, min_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.min_size = min_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not ENCODINGS:
+            await self.app(scope, receive, send)
+            return
+        request_headers = dict(scope.get("headers") or [])
+        encoding = negotiate(request_headers.get(b"accept-encoding", b"").decode("latin-1"))
+
+        response_start = None
+        compressor = None
+        passthrough = False
+
+        async def compressing_send(message):
+            nonlocal response_start, compressor, passthrough
+            if message["type"] == "http.response.start":
+                # Held back until the first body chunk shows whether the
+                # body is complete (and how large) or streamed
+                response_start = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if compressor is not None:
+                body = compressor.compress(body) if body else b""
+                if not more_body:
+                    body += compressor.finish()
+                await send({"type": "http.response.body", "body": body, "more_body": more_body})
+                return
+
+            headers = dict(response_start.get("headers", []))
+            eligible = compressible(headers) and response_start["status"] not in (204, 304)
+            if eligible:
+                response_start["headers"] = _add_vary(response_start.get("headers", []))
+            if encoding is None or not eligible or (not more_body and len(body) < self.min_size):
+                passthrough = True
+                await send(response_start)
+                await send(message)
+                return
+
+            if more_body:
+                compressor = COMPRESSORS[encoding]()
+                body = compressor.compress(body)
+            else:
+                body = self._compress_complete(body, encoding, headers)
+            response_start["headers"] = _encoded_headers(response_start["headers"], encoding, len(body), more_body)
+            await send(response_start)
+            await send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+        await self.app(scope, receive, compressing_send)
+
+    def _compress_complete(self, body, encoding, headers):
+        etag = _strong_etag(headers)
+        if etag is None:
+            return compress(body, encoding)
+        key = (etag, headers.get(b"content-type"), encoding)
+        compressed = variants.get(key)
+        if compressed is None:
+            compressed = compress(body, encoding)
+            variants.set(key, compressed)
+        return compressed
+
+
+def _add_vary(headers):
+    for i, (name, value) in enumerate(headers):
+        if name.lower() == b"vary":
+            if b"accept-encoding" not in value.lower():
+                headers = list(headers)
+                headers[i] = (name, value + b", Accept-Encoding")
+            return headers
+    return [*headers, (b"vary", b"Accept-Encoding")]
+
+
+def _encoded_headers(headers, encoding, length, streamed):
+    headers = [(name, value) for name, value in headers if name.lower() != b"content-length"]
+    # The encoded bytes differ from the identity body, so the validator is
+    # weakened; If-None-Match uses the weak comparison and still matches
+    headers = [
+        (name, b"W/" + value if name.lower() == b"etag" and not value.startswith(b"W/") else value)
+        for name, value in headers
+    ]
+    headers.append((b"content-encoding", encoding.encode()))
+    if not streamed:
+        headers.append((b"content-length", str(length).encode()))
+    return headers
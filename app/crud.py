@@ -1,101 +1,569 @@
+import hashlib
+import math
+import struct
+from datetime import timezone
+from email.utils import format_datetime
+from typing import Optional
+import orjson
+from sqlalchemy import and_, func, or_, select
 from sqlalchemy.orm import Session
-from shapely.geometry import shape, Point, LineString, Polygon, MultiPoint, MultiLineString, MultiPolygon
-from geoalchemy2.shape import from_shape, to_shape
+from shapely.geometry import shape
+from geoalchemy2.shape import from_shape
 from fastapi import HTTPException
-from . import models, schemas
-from geojson_pydantic import Point as GeoPoint, LineString as GeoLineString, Polygon as GeoPolygon, MultiPoint as GeoMultiPoint, MultiLineString as GeoMultiLineString, MultiPolygon as GeoMultiPolygon
-
-def wkb_to_geojson(wkb_element):
-    """Convert WKB geometry to GeoJSON format."""
-    shapely_geometry = to_shape(wkb_element)
-    
-    if isinstance(shapely_geometry, Point):
-        # For Point, we need to convert the coordinates to a list
-        coords = [float(x) for x in shapely_geometry.coords[0]]
-        return GeoPoint(type="Point", coordinates=coords)
-    elif isinstance(shapely_geometry, LineString):
-        # For LineString, convert each coordinate tuple to a list
-        coords = [[float(x) for x in coord] for coord in shapely_geometry.coords]
-        return GeoLineString(type="LineString", coordinates=coords)
-    elif isinstance(shapely_geometry, Polygon):
-        # For Polygon, convert exterior coordinates
-        coords = [[float(x) for x in coord] for coord in shapely_geometry.exterior.coords]
-        return GeoPolygon(type="Polygon", coordinates=[coords])
-    elif isinstance(shapely_geometry, MultiPoint):
-        # For MultiPoint, convert each point's coordinates
-        coords = [[float(x) for x in p.coords[0]] for p in shapely_geometry.geoms]
-        return GeoMultiPoint(type="MultiPoint", coordinates=coords)
-    elif isinstance(shapely_geometry, MultiLineString):
-        # For MultiLineString, convert each line's coordinates
-        coords = [[[float(x) for x in coord] for coord in line.coords] for line in shapely_geometry.geoms]
-        return GeoMultiLineString(type="MultiLineString", coordinates=coords)
-    elif isinstance(shapely_geometry, MultiPolygon):
-        # For MultiPolygon, convert each polygon's exterior coordinates
-        # Each polygon's coordinates need to be wrapped in an extra list
-        coords = [[[[float(x) for x in coord] for coord in poly.exterior.coords]] for poly in shapely_geometry.geoms]
-        return GeoMultiPolygon(type="MultiPolygon", coordinates=coords)
+from . import layout, metrics, models, schemas
+from .cache import Rendered
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+DEFAULT_NEAREST = 10
+MAX_NEAREST = 1000
+# The GiST index orders by planar (degree) distance; fetch this many times k
+# candidates to find a geodesic search radius, see nearest_radius_statement
+NEAREST_CANDIDATE_FACTOR = 4
+# For geodesic_bounds: no geodesic on the WGS84 spheroid is shorter than its
+# angle (at the centre) times the polar radius, and geodetic and geocentric
+# latitude differ by at most about 0.19 degrees
+WGS84_POLAR_RADIUS_M = 6_356_752.3
+LATITUDE_MARGIN = 0.2
+STREAM_BATCH_SIZE = 1000
+# Enough digits to round-trip a float64 coordinate (ST_AsGeoJSON defaults to 9)
+GEOJSON_MAX_DECIMALS = 15
+
+# GeometryType() returns upper case names, GeoJSON uses CamelCase
+GEOMETRY_TYPES = {
+    "POINT": "Point",
+    "LINESTRING": "LineString",
+    "POLYGON": "Polygon",
+    "MULTIPOINT": "MultiPoint",
+    "MULTILINESTRING": "MultiLineString",
+    "MULTIPOLYGON": "MultiPolygon",
+}
+
+# Response media type per GeometryOptions.format; None is the JSON layout
+FORMAT_MEDIA_TYPES = {
+    None: "application/json",
+    "wkb": "application/vnd.ogc.wkb",
+    "ewkb": "application/vnd.postgis.ewkb",
+    "flatgeobuf": "application/flatgeobuf",
+    "features": "application/vnd.geo-features",
+}
+ACCEPTED_MEDIA_TYPES = {
+    "application/geo+json": None,
+    "*/*": None,
+    "application/*": None,
+    **{media_type: fmt for fmt, media_type in FORMAT_MEDIA_TYPES.items()},
+}
+# A bare geometry cannot carry a page of features
+SINGLE_FEATURE_FORMATS = {"wkb", "ewkb"}
+
+# Feature stream record header: length of the rest of the record, id,
+# version, name length (then name, type length, type and WKB follow)
+FEATURE_RECORD_HEADER = struct.Struct("<IqIH")
+TYPE_LENGTH = struct.Struct("<H")
+
+
+def output_geometry(options: Optional[schemas.GeometryOptions] = None):
+    """The geometry expression to render, after zoom band and simplification."""
+    geometry = models.GeoData.geometry
+    if options is None:
+        return geometry
+    if options.zoom is not None:
+        band = next((z for z in sorted(models.SIMPLIFIED_BANDS) if options.zoom <= z), None)
+        if band is not None:
+            geometry = getattr(models.GeoData, f"geometry_z{band}")
+    if options.simplify:
+        geometry = func.ST_SimplifyPreserveTopology(geometry, options.simplify)
+    return geometry
+
+
+def feature_columns(options: Optional[schemas.GeometryOptions] = None):
+    """Columns for the fast read path.
+
+    PostGIS renders the geometry as GeoJSON text, so rows never go through
+    Shapely or pydantic on the way out. `options` reduces the geometry
+    (zoom band, simplification, coordinate precision) before rendering.
+    """
+    if options is not None and options.view == "summary":
+        return (*validator_columns(), models.GeoData.name, models.GeoData.type, *summary_columns())
+    geometry = output_geometry(options)
+    if options is not None and options.format is not None:
+        # Binary formats get the WKB straight from PostGIS; it is copied to
+        # the response as is, without being decoded
+        if options.precision is not None:
+            geometry = func.ST_SnapToGrid(geometry, 10 ** -options.precision)
+        encode = func.ST_AsEWKB if options.format == "ewkb" else func.ST_AsBinary
+        rendered = encode(geometry).label("wkb")
     else:
-        raise ValueError(f"Unsupported geometry type: {type(shapely_geometry)}")
-
-
-def geo_output(geo_data: models.GeoData):
-    # Determine the geometry type from the geometry itself
-    shapely_geometry = to_shape(geo_data.geometry)
-    geometry_type = type(shapely_geometry).__name__
-    
-    return schemas.GeoOut(
-        id=geo_data.id,
-        name=geo_data.name,
-        type=geometry_type,  # Use the actual geometry type
-        geometry=wkb_to_geojson(geo_data.geometry)
+        precision = GEOJSON_MAX_DECIMALS
+        if options is not None and options.precision is not None:
+            precision = options.precision
+        rendered = func.ST_AsGeoJSON(geometry, precision).label("geojson")
+    return (
+        *validator_columns(),
+        models.GeoData.name,
+        func.GeometryType(models.GeoData.geometry).label("geometry_type"),
+        rendered,
+    )
+
+
+def summary_columns():
+    """The precomputed size and location columns; reading them never
+    touches the geometry."""
+    return (
+        models.GeoData.bbox_minx,
+        models.GeoData.bbox_miny,
+        models.GeoData.bbox_maxx,
+        models.GeoData.bbox_maxy,
+        models.GeoData.centroid_x,
+        models.GeoData.centroid_y,
+        models.GeoData.area,
+        models.GeoData.length,
+        models.GeoData.npoints,
+    )
+
+
+def body_format(options: Optional[schemas.GeometryOptions] = None) -> Optional[str]:
+    """What encode_feature/encode_page render: the negotiated format, or
+    "summary" for the summary view (always JSON)."""
+    if options is None:
+        return None
+    return "summary" if options.view == "summary" else options.format
+
+
+def validator_columns():
+    """The small columns ETag / Last-Modified are derived from."""
+    return (models.GeoData.id, models.GeoData.version, models.GeoData.updated_at)
+
+
+def http_date(value):
+    return format_datetime(value.astimezone(timezone.utc), usegmt=True) if value is not None else None
+
+
+def feature_etag(row, representation: str = "") -> str:
+    # The representation (simplify/precision/zoom) is part of a strong ETag,
+    # since each one is a different body
+    suffix = f".{representation}" if representation else ""
+    return f'"{row.id}.{row.version}{suffix}"'
+
+
+def page_etag(rows, limit: int, params: str) -> str:
+    """Strong ETag of a page: the request parameters plus the id and
+    version of every row on it, so any edit, insert or delete on the page
+    changes it."""
+    digest = hashlib.sha1(params.encode())
+    for row in rows[:limit]:
+        digest.update(f"{row.id}.{row.version},".encode())
+    digest.update(b"more" if len(rows) > limit else b"end")
+    return f'"{digest.hexdigest()}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: Optional[str]) -> bool:
+    """If-None-Match uses the weak comparison (RFC 9110 13.1.2)."""
+    if not if_none_match or etag is None:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags)
+
+
+def negotiate_format(accept: Optional[str], page: bool = False, skip=frozenset()) -> Optional[str]:
+    """Pick the response format for an Accept header.
+
+    Returns the most preferred (highest q, then first listed) supported
+    format, leaving out the formats in `skip`; None means JSON, which is
+    also the answer when the header is missing. Raises 406 when nothing
+    acceptable is supported.
+    """
+    if not accept:
+        return None
+    best, best_q = None, 0.0
+    for part in accept.split(","):
+        media_type, *params = part.split(";")
+        fmt = ACCEPTED_MEDIA_TYPES.get(media_type.strip().lower(), "")
+        if fmt == "" or fmt in skip or (page and fmt in SINGLE_FEATURE_FORMATS):
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > best_q:
+            best, best_q = fmt, q
+    if best_q == 0.0:
+        supported = [
+            t for f, t in FORMAT_MEDIA_TYPES.items() if f not in skip and not (page and f in SINGLE_FEATURE_FORMATS)
+        ]
+        raise HTTPException(status_code=406, detail=f"Supported media types: {', '.join(supported)}")
+    return best
+
+
+def render_feature(row, with_body: bool = True, representation: str = "", fmt: Optional[str] = None) -> Rendered:
+    body = None
+    if with_body:
+        with metrics.SERIALIZE_SECONDS.time(operation="feature"):
+            body = encode_feature(row, fmt)
+    return Rendered(body, feature_etag(row, representation), http_date(row.updated_at))
+
+
+def render_page(rows, limit: int, params: str, with_body: bool = True, fmt: Optional[str] = None) -> Rendered:
+    updated = [row.updated_at for row in rows[:limit]]
+    body = None
+    if with_body:
+        with metrics.SERIALIZE_SECONDS.time(operation="page"):
+            body = encode_page(rows, limit, fmt)
+    return Rendered(body, page_etag(rows, limit, params), http_date(max(updated)) if updated else None)
+
+
+def _geometry_fragment(row):
+    return orjson.Fragment(row.geojson) if row.geojson is not None else None
+
+
+def _geometry_type(row):
+    return GEOMETRY_TYPES.get(row.geometry_type, row.geometry_type)
+
+
+def row_json(row) -> bytes:
+    """Serialize a feature_columns() row in the GeoOut layout."""
+    return orjson.dumps({
+        "name": row.name,
+        "type": _geometry_type(row),
+        "id": row.id,
+        "geometry": _geometry_fragment(row),
+    })
+
+
+def summary_json(row) -> bytes:
+    """Serialize a summary view row in the FeatureSummary layout."""
+    return orjson.dumps({
+        "id": row.id,
+        "name": row.name,
+        "type": row.type,
+        "bbox": list(row_bounds(row)) if row.bbox_minx is not None else None,
+        "centroid": [row.centroid_x, row.centroid_y] if row.centroid_x is not None else None,
+        "area": row.area,
+        "length": row.length,
+        "npoints": row.npoints,
+    })
+
+
+def nearest_json(rows) -> bytes:
+    """Serialize nearest_statement() rows as {"items": [...]} with distances in metres."""
+    return orjson.dumps({
+        "items": [
+            {
+                "name": row.name,
+                "type": _geometry_type(row),
+                "id": row.id,
+                "geometry": _geometry_fragment(row),
+                "distance": row.distance,
+            }
+            for row in rows
+        ],
+    })
+
+
+def feature_json(row) -> bytes:
+    """Serialize a feature_columns() row as a GeoJSON Feature."""
+    return orjson.dumps({
+        "type": "Feature",
+        "id": row.id,
+        "properties": {"name": row.name, "type": _geometry_type(row)},
+        "geometry": _geometry_fragment(row),
+    })
+
+
+def feature_record(row) -> bytes:
+    """One length-prefixed feature stream record for a binary feature_columns() row."""
+    # Unnamed features (bulk imports without properties.name) get an empty name
+    name = (row.name or "").encode()
+    type_name = (_geometry_type(row) or "").encode()
+    wkb = bytes(row.wkb)
+    size = FEATURE_RECORD_HEADER.size - 4 + len(name) + TYPE_LENGTH.size + len(type_name) + len(wkb)
+    return b"".join((
+        FEATURE_RECORD_HEADER.pack(size, row.id, row.version, len(name)),
+        name,
+        TYPE_LENGTH.pack(len(type_name)),
+        type_name,
+        wkb,
+    ))
+
+
+def encode_feature(row, fmt: Optional[str] = None) -> bytes:
+    """Body of a single feature in the negotiated format."""
+    if fmt is None:
+        return row_json(row)
+    if fmt == "summary":
+        return summary_json(row)
+    if fmt in SINGLE_FEATURE_FORMATS:
+        return bytes(row.wkb)
+    return encode_page([row], 1, fmt)
+
+
+def encode_page(rows, limit: int, fmt: Optional[str] = None) -> bytes:
+    """Body of a page in the negotiated format.
+
+    Binary pages have no room for the next cursor: a full page (`limit`
+    features) continues after the id of its last feature.
+    """
+    if fmt is None:
+        return page_json(rows, limit)
+    if fmt == "summary":
+        return page_json(rows, limit, summary_json)
+    if fmt == "features":
+        return b"".join(feature_record(row) for row in rows[:limit])
+
+    from .export import FlatGeobufFeature, flatgeobuf_bytes
+
+    return flatgeobuf_bytes(
+        FlatGeobufFeature(row.id, row.name, _geometry_type(row), row.wkb) for row in rows[:limit]
     )
 
 
-def create_geo_data(db: Session, geo_data: schemas.GeoCreate):
-    shapely_geometry = shape(geo_data.geometry.model_dump())
-    db_geo = models.GeoData(
-            name=geo_data.name,
-            type=geo_data.type,
-            geometry=from_shape(shapely_geometry, srid=4326)
+def bounds_columns(entity=models.GeoData, prefix="bbox"):
+    """Bounding box of `entity.geometry` as four labeled columns, read from
+    the precomputed bbox columns."""
+    return (
+        entity.bbox_minx.label(f"{prefix}_minx"),
+        entity.bbox_miny.label(f"{prefix}_miny"),
+        entity.bbox_maxx.label(f"{prefix}_maxx"),
+        entity.bbox_maxy.label(f"{prefix}_maxy"),
     )
-    db.add(db_geo)
-    db.commit()
-    db.refresh(db_geo)
-    
-    return geo_output(db_geo)
+
+
+def row_bounds(row, prefix="bbox"):
+    bounds = tuple(getattr(row, f"{prefix}_{name}") for name in ("minx", "miny", "maxx", "maxy"))
+    return None if bounds[0] is None else bounds
+
+
+def page_scope(rows, limit: int, after_id: Optional[int], extent=None):
+    """Cache scope of a keyset page: the ids it spans and the area it covers."""
+    lo = after_id + 1 if after_id is not None else None
+    hi = rows[limit - 1].id if len(rows) > limit else None
+    return {"id_range": [lo, hi], "extent": list(extent) if extent is not None else None}
+
+
+def query_extent(bbox=None, geo_query: Optional[schemas.GeoQuery] = None):
+    """Area outside of which a write cannot change the query result."""
+    if geo_query is None:
+        return bbox
+    minx, miny, maxx, maxy = shape(geo_query.geometry.model_dump()).bounds
+    distance = geo_query.distance or 0.0
+    return minx - distance, miny - distance, maxx + distance, maxy + distance
+
+
+def _feature_row(db: Session, geo_data_id: int):
+    return db.query(*feature_columns()).filter(models.GeoData.id == geo_data_id).first()
+
+
+def geometry_from_schema(geometry):
+    """Convert a geojson_pydantic geometry to a WKBElement."""
+    return geometry_element(shape(geometry.model_dump()))
+
+
+def geometry_element(shapely_geometry):
+    """WKBElement for storing a (normalized) Shapely geometry."""
+    return from_shape(shapely_geometry, srid=4326)
 
 
 def get_geo_data(db: Session, geo_data_id: int):
-    geo_data = db.query(models.GeoData).filter(models.GeoData.id == geo_data_id).first()
-    if not geo_data:
+    row = _feature_row(db, geo_data_id)
+    if not row:
         raise HTTPException(status_code=404, detail="Geo data not found")
-   
-    return geo_output(geo_data)
 
+    return row_json(row)
 
-def list_geo_data(db: Session):
-    geo_data = db.query(models.GeoData).all()
-    return [geo_output(geo) for geo in geo_data]
 
+def keyset(query, limit: int, after_id: Optional[int]):
+    # Keyset pagination on the primary key: each page is an index range scan
+    # instead of an OFFSET that re-reads every preceding row. Works on both
+    # ORM queries and select() statements (used by async_crud).
+    query = query.order_by(models.GeoData.id)
+    if after_id is not None:
+        query = query.filter(models.GeoData.id > after_id)
+    # One extra row tells whether there is a next page
+    return query.limit(limit + 1)
 
-def delete_geo_data(db: Session, geo_data_id: int):
-    geo_data = db.query(models.GeoData).filter(models.GeoData.id == geo_data_id).first()
-    if not geo_data:
-        raise HTTPException(status_code=404, detail="Geo data not found")
-    db.delete(geo_data)
-    db.commit()
-    return {"message": "Geo data deleted successfully"}
 
+def page_json(rows, limit: int, serialize=row_json) -> bytes:
+    next_cursor = rows[limit - 1].id if len(rows) > limit else None
+    # Same layout as schemas.GeoPage (SummaryPage with summary_json),
+    # assembled from pre-rendered geometries
+    items = b",".join(serialize(row) for row in rows[:limit])
+    return b'{"items":[' + items + b'],"next":' + orjson.dumps(next_cursor) + b"}"
 
-def update_geo_data(db: Session, geo_data_id: int, geo_update: schemas.GeoCreate):
-    db_geo = db.query(models.GeoData).filter(models.GeoData.id == geo_data_id).first()
-    if not db_geo:
-        raise HTTPException(status_code=404, detail="Geo data not found")
-    db_geo.name = geo_update.name
-    db_geo.type = geo_update.type
-    db_geo.geometry = from_shape(shape(geo_update.geometry.model_dump()), srid=4326)
-    db.commit()
-    db.refresh(db_geo)
-    return geo_output(db_geo)
 
+def list_geo_data(db: Session, limit: int = DEFAULT_PAGE_SIZE, after_id: Optional[int] = None):
+    return page_json(keyset(db.query(*feature_columns()), limit, after_id).all(), limit)
+
+
+def parse_bbox(bbox: str):
+    """Parse a "minx,miny,maxx,maxy" string into a tuple of floats."""
+    try:
+        minx, miny, maxx, maxy = (float(v) for v in bbox.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="bbox must be 'minx,miny,maxx,maxy'")
+    if minx > maxx or miny > maxy:
+        raise HTTPException(status_code=400, detail="bbox min values must not exceed max values")
+    return minx, miny, maxx, maxy
+
+
+def bbox_filter(bbox):
+    """Index-backed filter for rows whose bounding box overlaps `bbox`."""
+    envelope = func.ST_MakeEnvelope(*bbox, 4326)
+    overlaps = models.GeoData.geometry.op("&&")(envelope)
+    if layout.CITIES_PARTITIONED:
+        return and_(overlaps, layout.region_filter(models.GeoData.geometry, bbox))
+    return overlaps
+
+
+def geodesic_bounds(lon: float, lat: float, distance: float) -> list:
+    """Lon/lat boxes that together hold every point within `distance`
+    metres of (lon, lat); two when they cross the antimeridian, and all
+    longitudes when they reach a pole."""
+    angle = distance / WGS84_POLAR_RADIUS_M
+    reach = math.degrees(angle) + LATITUDE_MARGIN
+    miny, maxy = max(-90.0, lat - reach), min(90.0, lat + reach)
+    if abs(lat) + reach >= 90:
+        return [(-180.0, miny, 180.0, maxy)]
+    # Widest longitude span of a small circle of that angle
+    spread = math.degrees(math.asin(min(1.0, math.sin(angle) / math.cos(math.radians(lat)))))
+    minx, maxx = lon - spread, lon + spread
+    if minx < -180:
+        return [(minx + 360, miny, 180.0, maxy), (-180.0, miny, maxx, maxy)]
+    if maxx > 180:
+        return [(minx, miny, 180.0, maxy), (-180.0, miny, maxx - 360, maxy)]
+    return [(minx, miny, maxx, maxy)]
+
+
+def spatial_filter(geo_query: schemas.GeoQuery):
+    """Translate a GeoQuery into a PostGIS predicate that can use the GiST index."""
+    geometry = geometry_from_schema(geo_query.geometry)
+    if geo_query.predicate == "within":
+        return func.ST_Within(models.GeoData.geometry, geometry)
+    if geo_query.predicate == "dwithin":
+        return func.ST_DWithin(models.GeoData.geometry, geometry, geo_query.distance)
+    return func.ST_Intersects(models.GeoData.geometry, geometry)
+
+
+def size_filters(size: Optional[schemas.SizeFilter] = None):
+    """Filters on the precomputed area, length and npoints columns."""
+    filters = []
+    if size is None:
+        return filters
+    for name in ("area", "length", "npoints"):
+        column = getattr(models.GeoData, name)
+        low, high = getattr(size, f"min_{name}"), getattr(size, f"max_{name}")
+        if low is not None:
+            filters.append(column >= low)
+        if high is not None:
+            filters.append(column <= high)
+    return filters
+
+
+def query_filters(
+    bbox=None,
+    geo_query: Optional[schemas.GeoQuery] = None,
+    size: Optional[schemas.SizeFilter] = None,
+):
+    filters = []
+    if bbox is not None:
+        filters.append(bbox_filter(bbox))
+    if geo_query is not None:
+        filters.append(spatial_filter(geo_query))
+    filters.extend(size_filters(size))
+    return filters
+
+
+def _nearest_terms(lon: float, lat: float, type: Optional[str], name: Optional[str]):
+    point = func.ST_SetSRID(func.ST_MakePoint(lon, lat), 4326)
+    distance = func.ST_Distance(func.geography(models.GeoData.geometry), func.geography(point))
+    filters = []
+    if type is not None:
+        filters.append(models.GeoData.type == type)
+    if name is not None:
+        filters.append(models.GeoData.name == name)
+    return point, distance, filters
+
+
+def nearest_radius_statement(
+    lon: float,
+    lat: float,
+    k: int = DEFAULT_NEAREST,
+    type: Optional[str] = None,
+    name: Optional[str] = None,
+):
+    """Geodesic distance (metres on the spheroid) within which at least k
+    features lie, or NULL when fewer than k match at all.
+
+    A KNN scan: ORDER BY geometry <-> point walks the GiST index and stops
+    after k * NEAREST_CANDIDATE_FACTOR rows, so the cost doesn't grow with
+    the table. The scan is planar, in degrees, so away from the equator its
+    candidates need not be the geodesically nearest; they only bound the
+    radius that nearest_statement searches.
+    """
+    point, distance, filters = _nearest_terms(lon, lat, type, name)
+    candidates = (
+        select(distance.label("distance"))
+        .where(*filters)
+        .order_by(models.GeoData.geometry.op("<->")(point))
+        .limit(k * NEAREST_CANDIDATE_FACTOR)
+        .subquery()
+    )
+    return select(candidates.c.distance).order_by(candidates.c.distance).offset(k - 1).limit(1)
+
+
+def nearest_statement(
+    lon: float,
+    lat: float,
+    k: int = DEFAULT_NEAREST,
+    radius: Optional[float] = None,
+    type: Optional[str] = None,
+    name: Optional[str] = None,
+    options: Optional[schemas.GeometryOptions] = None,
+):
+    """The k features closest to (lon, lat) by geodesic distance, nearest
+    first, searching within `radius` metres (from nearest_radius_statement;
+    None when fewer than k features match, which are then all ranked).
+
+    The radius becomes lon/lat boxes (geodesic_bounds) for the GiST index
+    and an ST_DWithin on the spheroid.
+    """
+    point, distance, filters = _nearest_terms(lon, lat, type, name)
+    if radius is not None:
+        filters.append(or_(*(bbox_filter(bbox) for bbox in geodesic_bounds(lon, lat, radius))))
+        filters.append(func.ST_DWithin(func.geography(models.GeoData.geometry), func.geography(point), radius))
+    return (
+        select(*feature_columns(options), distance.label("distance"))
+        .where(*filters)
+        .order_by(distance, models.GeoData.id)
+        .limit(k)
+    )
+
+
+def stream_geo_data(db: Session, fmt: str = "geojson", options: Optional[schemas.GeometryOptions] = None):
+    """Yield every row as a chunked GeoJSON FeatureCollection or NDJSON.
+
+    Rows are fetched from a server-side cursor in batches of STREAM_BATCH_SIZE,
+    so memory use does not depend on the size of the table.
+    """
+    # The request scoped session is closed before the response body is sent,
+    # so the stream opens its own session on the same engine.
+    with Session(bind=db.get_bind()) as stream_db:
+        rows = (
+            stream_db.query(*feature_columns(options))
+            .order_by(models.GeoData.id)
+            .yield_per(STREAM_BATCH_SIZE)
+        )
+        if fmt == "ndjson":
+            for row in rows:
+                yield feature_json(row) + b"\n"
+            return
 
+        yield b'{"type":"FeatureCollection","features":['
+        separator = b""
+        for row in rows:
+            yield separator + feature_json(row)
+            separator = b","
+        yield b"]}"
@@ -1,7 +1,11 @@
-from sqlalchemy import create_engine
+from sqlalchemy import Engine, create_engine, exc
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine, async_sessionmaker
 from sqlalchemy.orm import sessionmaker, declarative_base
 from sqlalchemy.ext.declarative import declarative_base as old_declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
 import os
+import time
+from typing import NamedTuple, Optional
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -13,15 +17,170 @@ DB_PORT = os.getenv("POSTGRES_PORT", "5432")
 DB_HOST = os.getenv("POSTGRES_HOST", "localhost")
 
 DATABASE_URL = f"postgresql+psycopg2://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+ASYNC_DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+
+# Connection pool settings, per engine and per worker process
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+# Milliseconds, 0 disables the timeout
+DB_STATEMENT_TIMEOUT = int(os.getenv("DB_STATEMENT_TIMEOUT", "0"))
+# Behind PgBouncer (transaction pooling) the app keeps no pool of its own,
+# sends no startup options and disables asyncpg's prepared statement cache
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "false").lower() in ("1", "true", "yes")
+
+
+class CheckoutTimingMixin:
+    """Records how long callers wait for a connection from the pool."""
+
+    checkouts = 0
+    checkout_timeouts = 0
+    wait_time_total = 0.0
+    wait_time_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.checkout_timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            self.checkouts += 1
+            self.wait_time_total += waited
+            self.wait_time_max = max(self.wait_time_max, waited)
+
+
+class TimedQueuePool(CheckoutTimingMixin, QueuePool):
+    pass
+
+
+class TimedAsyncQueuePool(CheckoutTimingMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def pool_options(poolclass):
+    if DB_PGBOUNCER:
+        return {"poolclass": NullPool, "pool_pre_ping": DB_POOL_PRE_PING}
+    return {
+        "poolclass": poolclass,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+
+
+def connect_args(is_async=False):
+    args = {}
+    if is_async and DB_PGBOUNCER:
+        args["statement_cache_size"] = 0
+    if DB_STATEMENT_TIMEOUT and not DB_PGBOUNCER:
+        if is_async:
+            args["server_settings"] = {"statement_timeout": str(DB_STATEMENT_TIMEOUT)}
+        else:
+            args["options"] = f"-c statement_timeout={DB_STATEMENT_TIMEOUT}"
+    return args
+
+
+def pool_stats(engine):
+    pool = engine.pool
+    stats = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            checked_in=pool.checkedin(),
+            overflow=max(pool.overflow(), 0),
+            max_overflow=DB_MAX_OVERFLOW,
+            checkouts=pool.checkouts,
+            checkout_timeouts=pool.checkout_timeouts,
+            wait_time_total_ms=round(pool.wait_time_total * 1000, 3),
+            wait_time_max_ms=round(pool.wait_time_max * 1000, 3),
+        )
+    return stats
+
+
+# Used by the async routes; the sync engine still serves streaming, bulk
+# import and the CLI tools.
+if DB_PGBOUNCER:
+    ASYNC_DATABASE_URL += "?prepared_statement_cache_size=0"
+
+
+class Engines(NamedTuple):
+    engine: Engine
+    SessionLocal: sessionmaker
+    async_engine: AsyncEngine
+    AsyncSessionLocal: async_sessionmaker
+
+
+_engines: Optional[Engines] = None
+
+
+def engines() -> Engines:
+    """This process's engines and session factories, created on first use.
+
+    Creating an engine opens no connection, but it is still deferred until
+    a worker needs it: importing the app (e.g. in a preloading master)
+    stays free of database state.
+    """
+    global _engines
+    if _engines is None:
+        engine = create_engine(DATABASE_URL, connect_args=connect_args(), **pool_options(TimedQueuePool))
+        async_engine = create_async_engine(
+            ASYNC_DATABASE_URL, connect_args=connect_args(is_async=True), **pool_options(TimedAsyncQueuePool)
+        )
+        _engines = Engines(
+            engine,
+            sessionmaker(autocommit=False, autoflush=False, bind=engine),
+            async_engine,
+            async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False),
+        )
+    return _engines
+
+
+async def dispose():
+    """Close this process's pools; the next engines() call starts afresh."""
+    global _engines
+    if _engines is not None:
+        await _engines.async_engine.dispose()
+        _engines.engine.dispose()
+        _engines = None
+
+
+def _after_fork_in_child():
+    # Pooled connections opened before a fork belong to the parent. The
+    # child drops them from its pools without closing them, which would
+    # break the parent's sockets, and opens its own.
+    if _engines is not None:
+        _engines.engine.dispose(close=False)
+        _engines.async_engine.sync_engine.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def __getattr__(name):
+    # database.engine, database.SessionLocal etc. resolve to the lazily
+    # created objects
+    if name in Engines._fields:
+        return getattr(engines(), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 base = declarative_base()
 
 def get_db():
-    db = SessionLocal()
+    db = engines().SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+async def get_async_db():
+    async with engines().AsyncSessionLocal() as db:
+        yield db
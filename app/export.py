@@ -0,0 +1,272 @@
+"""Table exports to GeoParquet and FlatGeobuf.
+
+Rows are read from a server-side cursor in EXPORT_BATCH_SIZE batches with
+the geometry as WKB straight from PostGIS, so memory use is bounded by one
+batch whatever the table size.
+
+- GeoParquet (needs ``pyarrow``, in requirements.txt): one row group per batch, WKB geometry
+  column, a ``bbox`` struct covering column and GeoParquet 1.1 metadata.
+  Written to the output as each row group completes, so it streams.
+- FlatGeobuf (needs GDAL's ``osgeo.ogr``, optional and not in the image,
+  since the bindings must match the system libgdal): written with a packed Hilbert
+  R-tree index. The index sits at the start of the file and covers every
+  feature, so GDAL builds it on close and the file is streamed afterwards.
+
+CLI usage:
+    python -m app.export cities.parquet
+    python -m app.export cities.fgb --bbox 5,45,10,48 --type Point
+"""
+import argparse
+import functools
+import os
+import sys
+import tempfile
+from typing import NamedTuple, Optional
+
+import orjson
+from fastapi import HTTPException
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from . import crud, models
+
+EXPORT_BATCH_SIZE = 65_536
+READ_CHUNK_SIZE = 1 << 20
+EXPORT_FORMATS = {
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+    "flatgeobuf": ("application/flatgeobuf", "fgb"),
+}
+
+
+class FlatGeobufFeature(NamedTuple):
+    """The fields write_flatgeobuf() reads from each row."""
+    id: int
+    name: str
+    type: str
+    wkb: bytes
+
+
+def require(fmt: str):
+    """Import the optional writer library for `fmt`, or fail with 501."""
+    try:
+        if fmt == "parquet":
+            import pyarrow.parquet  # noqa: F401
+        else:
+            from osgeo import ogr  # noqa: F401
+    except ImportError:
+        library = "pyarrow" if fmt == "parquet" else "GDAL (osgeo)"
+        raise HTTPException(status_code=501, detail=f"{fmt} export requires {library} to be installed")
+
+
+@functools.lru_cache(maxsize=None)
+def available(fmt: str) -> bool:
+    """Whether the writer library for `fmt` is installed."""
+    try:
+        require(fmt)
+    except HTTPException:
+        return False
+    return True
+
+
+def export_statement(bbox=None, type: Optional[str] = None):
+    statement = select(
+        models.GeoData.id,
+        models.GeoData.name,
+        models.GeoData.type,
+        func.ST_AsBinary(models.GeoData.geometry).label("wkb"),
+        *crud.bounds_columns(),
+    ).order_by(models.GeoData.id)
+    if bbox is not None:
+        statement = statement.where(crud.bbox_filter(bbox))
+    if type is not None:
+        statement = statement.where(models.GeoData.type == type)
+    return statement
+
+
+def iter_batches(db: Session, bbox=None, type: Optional[str] = None, batch_size: int = EXPORT_BATCH_SIZE):
+    result = db.execute(export_statement(bbox, type).execution_options(yield_per=batch_size))
+    yield from result.partitions()
+
+
+class _Sink:
+    """Write-only file object that hands back what was written since the
+    last drain, so a ParquetWriter can be streamed."""
+
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def geoparquet_metadata():
+    return orjson.dumps({
+        "version": "1.1.0",
+        "primary_column": "geometry",
+        "columns": {
+            "geometry": {
+                "encoding": "WKB",
+                "geometry_types": [],
+                "covering": {
+                    "bbox": {
+                        "xmin": ["bbox", "xmin"],
+                        "ymin": ["bbox", "ymin"],
+                        "xmax": ["bbox", "xmax"],
+                        "ymax": ["bbox", "ymax"],
+                    }
+                },
+            }
+        },
+    })
+
+
+def write_geoparquet(batches):
+    """Yield the bytes of a GeoParquet file, one row group per batch."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    bbox_type = pa.struct([(name, pa.float64()) for name in ("xmin", "ymin", "xmax", "ymax")])
+    schema = pa.schema(
+        [
+            ("id", pa.int64()),
+            ("name", pa.string()),
+            ("type", pa.string()),
+            ("geometry", pa.binary()),
+            ("bbox", bbox_type),
+        ],
+        metadata={"geo": geoparquet_metadata()},
+    )
+    sink = _Sink()
+    with pq.ParquetWriter(sink, schema, compression="zstd", write_statistics=True) as writer:
+        for rows in batches:
+            bbox = pa.StructArray.from_arrays(
+                [
+                    pa.array([row.bbox_minx for row in rows], pa.float64()),
+                    pa.array([row.bbox_miny for row in rows], pa.float64()),
+                    pa.array([row.bbox_maxx for row in rows], pa.float64()),
+                    pa.array([row.bbox_maxy for row in rows], pa.float64()),
+                ],
+                fields=list(bbox_type),
+            )
+            table = pa.Table.from_arrays(
+                [
+                    pa.array([row.id for row in rows], pa.int64()),
+                    pa.array([row.name for row in rows], pa.string()),
+                    pa.array([row.type for row in rows], pa.string()),
+                    pa.array([bytes(row.wkb) for row in rows], pa.binary()),
+                    bbox,
+                ],
+                schema=schema,
+            )
+            writer.write_table(table, row_group_size=len(rows))
+            yield sink.drain()
+    yield sink.drain()
+
+
+def write_flatgeobuf(batches, path, spatial_index: bool = True):
+    """Write a FlatGeobuf file, by default with a packed spatial index, to `path`."""
+    from osgeo import ogr, osr
+
+    ogr.UseExceptions()
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    index = "YES" if spatial_index else "NO"
+    dataset = ogr.GetDriverByName("FlatGeobuf").CreateDataSource(path)
+    try:
+        layer = dataset.CreateLayer(models.GeoData.__tablename__, srs, ogr.wkbUnknown, options=[f"SPATIAL_INDEX={index}"])
+        layer.CreateField(ogr.FieldDefn("id", ogr.OFTInteger64))
+        layer.CreateField(ogr.FieldDefn("name", ogr.OFTString))
+        layer.CreateField(ogr.FieldDefn("type", ogr.OFTString))
+        definition = layer.GetLayerDefn()
+        for rows in batches:
+            for row in rows:
+                feature = ogr.Feature(definition)
+                feature.SetField("id", row.id)
+                feature.SetField("name", row.name)
+                feature.SetField("type", row.type)
+                feature.SetGeometryDirectly(ogr.CreateGeometryFromWkb(bytes(row.wkb)))
+                layer.CreateFeature(feature)
+    finally:
+        dataset = None  # closing writes the index
+
+
+def flatgeobuf_bytes(features) -> bytes:
+    """A FlatGeobuf file of `features` (FlatGeobufFeature rows), without an
+    index; used for API responses, which are at most one page."""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "features.fgb")
+        write_flatgeobuf([features], path, spatial_index=False)
+        with open(path, "rb") as f:
+            return f.read()
+
+
+def stream_export(db: Session, fmt: str, bbox=None, type: Optional[str] = None, batch_size: int = EXPORT_BATCH_SIZE):
+    """Yield the export file's bytes; used by the export endpoint."""
+    # The request scoped session is closed before the body is sent
+    with Session(bind=db.get_bind()) as export_db:
+        batches = iter_batches(export_db, bbox, type, batch_size)
+        if fmt == "parquet":
+            yield from write_geoparquet(batches)
+            return
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "export.fgb")
+            write_flatgeobuf(batches, path)
+            with open(path, "rb") as f:
+                while chunk := f.read(READ_CHUNK_SIZE):
+                    yield chunk
+
+
+def export(db: Session, path: str, fmt: str, bbox=None, type: Optional[str] = None, batch_size: int = EXPORT_BATCH_SIZE):
+    batches = iter_batches(db, bbox, type, batch_size)
+    if fmt == "parquet":
+        with open(path, "wb") as f:
+            for chunk in write_geoparquet(batches):
+                f.write(chunk)
+    else:
+        write_flatgeobuf(batches, path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the cities table to GeoParquet or FlatGeobuf.")
+    parser.add_argument("path", help="output file")
+    parser.add_argument("--format", choices=list(EXPORT_FORMATS), help="defaults to the file extension")
+    parser.add_argument("--bbox", help="minx,miny,maxx,maxy")
+    parser.add_argument("--type", help="only export rows of this type")
+    parser.add_argument("--batch-size", type=int, default=EXPORT_BATCH_SIZE, help="rows per row group / fetch")
+    args = parser.parse_args(argv)
+
+    fmt = args.format or ("flatgeobuf" if args.path.endswith(".fgb") else "parquet")
+    try:
+        require(fmt)
+        bbox = crud.parse_bbox(args.bbox) if args.bbox else None
+    except HTTPException as exc:
+        parser.error(exc.detail)
+
+    from .database import SessionLocal
+
+    with SessionLocal() as db:
+        export(db, args.path, fmt, bbox, args.type, args.batch_size)
+    print(f"Wrote {args.path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
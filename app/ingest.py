@@ -0,0 +1,369 @@
+"""Bulk loading of GeoJSON FeatureCollections and NDJSON into `cities`.
+
+Input is parsed incrementally, geometries are validated and normalized a
+batch at a time with vectorized Shapely 2 calls (see app.normalize), and
+each batch is written with a single PostgreSQL COPY and committed on its
+own. Memory use is bounded by the batch size, not by the size of the
+input.
+
+CLI usage:
+    python -m app.ingest cities.geojson
+    python -m app.ingest cities.ndjson --batch-size 10000
+    cat cities.ndjson | python -m app.ingest - --format ndjson
+"""
+import argparse
+import codecs
+import io
+import json
+import re
+import sys
+
+import numpy as np
+import orjson
+import shapely
+from sqlalchemy.orm import Session
+
+from . import normalize, schemas
+from .cache import cache
+from .normalize import SUPPORTED_GEOMETRY_TYPES
+
+DEFAULT_BATCH_SIZE = 5000
+READ_CHUNK_SIZE = 1 << 16
+# Uploaded bodies above this size are spooled to disk while they are received
+SPOOL_SIZE = 8 * 1024 * 1024
+# Cap the error list so a broken multi-GB file can't exhaust memory
+MAX_REPORTED_ERRORS = 1000
+# Largest single value (feature) read ahead before the input is rejected
+MAX_VALUE_SIZE = 256 * 1024 * 1024
+
+# What the reader looks for to find where a value ends
+_STRUCTURE = re.compile(r'["{}\[\]]')
+_STRING_END = re.compile(r'["\\]')
+_SCALAR_END = re.compile(r'[\s,:\]}]')
+
+COPY_SQL = "COPY cities (name, type, geometry) FROM STDIN"
+INSERT_SQL = "INSERT INTO cities (name, type, geometry) VALUES (%s, %s, %s::geometry)"
+
+
+class _JSONStream:
+    """Minimal pull parser over a text or binary file object.
+
+    Only the structure around the top-level "features" array is walked by
+    hand; every value (including each feature) is decoded with the stdlib
+    JSON decoder from a buffer that holds just the unread tail of the input.
+    A value that doesn't decode is skipped, up to its closing bracket, so
+    one malformed feature doesn't cost the rest of the input.
+    """
+
+    def __init__(self, stream, chunk_size=READ_CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+
+    def _fill(self, size):
+        chunk = self.stream.read(size)
+        if isinstance(chunk, bytes):
+            chunk = self.text_decoder.decode(chunk, final=not chunk)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill(self.chunk_size):
+                return ""
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Expected '{char}' at offset {self.pos} of the input buffer")
+        self.pos += 1
+
+    def value(self):
+        """Decode the next value.
+
+        Raises JSONDecodeError, with the value skipped, when it is
+        malformed, and ValueError when the input ends (or MAX_VALUE_SIZE is
+        reached) before the value does.
+        """
+        if not self.peek():
+            raise ValueError("Unexpected end of input")
+        try:
+            obj, end = self.decoder.raw_decode(self.buf, self.pos)
+        except json.JSONDecodeError:
+            # Most likely the value continues past the buffer
+            pass
+        else:
+            # A number at the end of the buffer may have been cut short
+            if end < len(self.buf) or self.eof or not isinstance(obj, (int, float)):
+                self.pos = end
+                return obj
+        end = self._value_end()
+        text, self.pos = self.buf[self.pos:end], end
+        return self.decoder.decode(text)
+
+    def _value_end(self):
+        """Offset just past the value at `pos`, reading ahead as needed.
+
+        Only strings and brackets are tracked (the decoder checks the rest),
+        so a malformed value still has an end to skip to.
+        """
+        scalar = self.buf[self.pos] not in '{["'
+        depth = 0
+        in_string = False
+        i = self.pos
+        size = self.chunk_size
+        while True:
+            pattern = _SCALAR_END if scalar else _STRING_END if in_string else _STRUCTURE
+            match = pattern.search(self.buf, i)
+            if match is None:
+                if len(self.buf) - self.pos > MAX_VALUE_SIZE:
+                    raise ValueError(f"Value larger than {MAX_VALUE_SIZE} bytes")
+                offset = max(i, len(self.buf)) - self.pos
+                # Doubling, so very large features don't go quadratic
+                if not self._fill(size):
+                    if scalar:
+                        return len(self.buf)
+                    raise ValueError("Unexpected end of input inside a value")
+                size *= 2
+                i = self.pos + offset
+                continue
+            if scalar:
+                return match.start()
+            char, i = match.group(), match.end()
+            if in_string:
+                if char == "\\":
+                    i += 1
+                    continue
+                in_string = False
+            elif char == '"':
+                in_string = True
+                continue
+            else:
+                depth += 1 if char in "{[" else -1
+            if depth == 0:
+                return i
+
+
+def iter_feature_collection(stream, chunk_size=READ_CHUNK_SIZE):
+    """Yield the features of a FeatureCollection one at a time; a malformed
+    feature is yielded as its decode error, like in iter_ndjson."""
+    reader = _JSONStream(stream, chunk_size)
+    reader.expect("{")
+    while reader.peek() != "}":
+        key = reader.value()
+        reader.expect(":")
+        if key != "features":
+            reader.value()  # type, bbox, crs, ... are small and unused
+        else:
+            reader.expect("[")
+            while reader.peek() != "]":
+                try:
+                    feature = reader.value()
+                except json.JSONDecodeError as exc:
+                    # Skipped by the reader; only this feature fails
+                    feature = exc
+                yield feature
+                if reader.peek() == ",":
+                    reader.pos += 1
+            reader.expect("]")
+        if reader.peek() == ",":
+            reader.pos += 1
+    reader.expect("}")
+
+
+def iter_ndjson(stream):
+    """Yield one feature per non-blank line of newline-delimited GeoJSON.
+
+    A line that isn't valid JSON is yielded as the decode error, so the
+    loader can report it and carry on with the next line.
+    """
+    for line in stream:
+        if line.strip():
+            try:
+                yield orjson.loads(line)
+            except orjson.JSONDecodeError as exc:
+                yield exc
+
+
+def _copy_escape(value):
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+class BulkLoader:
+    """Validates features in batches and loads them with COPY."""
+
+    def __init__(self, db: Session, batch_size: int = DEFAULT_BATCH_SIZE, response_cache=cache):
+        self.db = db
+        self.batch_size = batch_size
+        # None outside the server, whose workers learn of the rows from the change feed
+        self.response_cache = response_cache
+        self.report = schemas.BulkImportReport()
+
+    def error(self, index, message):
+        self.report.failed += 1
+        if len(self.report.errors) < MAX_REPORTED_ERRORS:
+            self.report.errors.append(schemas.BulkImportError(index=index, error=message))
+
+    def load(self, features):
+        batch = []
+        try:
+            for index, feature in enumerate(features):
+                batch.append((index, feature))
+                if len(batch) >= self.batch_size:
+                    # Cleared first, so the handler below never loads it twice
+                    full, batch = batch, []
+                    self.load_batch(full)
+        except ValueError:
+            # The input can't be read past this point; keep what came before
+            if batch:
+                self.load_batch(batch)
+            raise
+        if batch:
+            self.load_batch(batch)
+        return self.report
+
+    def prepare(self, batch):
+        """Turn a batch of raw features into (index, name, type, ewkb_hex) rows
+        plus the extent covered by those rows."""
+        indexes, properties, geometries = [], [], []
+        for index, feature in batch:
+            if isinstance(feature, Exception):
+                self.error(index, f"Malformed JSON: {feature}")
+                continue
+            geometry = feature.get("geometry") if isinstance(feature, dict) else None
+            if not isinstance(geometry, dict):
+                self.error(index, "Feature has no geometry")
+                continue
+            if geometry.get("type") not in SUPPORTED_GEOMETRY_TYPES:
+                self.error(index, f"Unsupported geometry type: {geometry.get('type')}")
+                continue
+            indexes.append(index)
+            props = feature.get("properties")
+            properties.append(props if isinstance(props, dict) else {})
+            geometries.append(orjson.dumps(geometry))
+
+        if not indexes:
+            return [], None
+
+        # Parse, validate and normalize the whole batch in GEOS at once
+        shapes = shapely.from_geojson(np.asarray(geometries, dtype=object), on_invalid="ignore")
+        missing = shapely.is_missing(shapes)
+        present = np.flatnonzero(~missing)
+        normalized = normalize.normalize(shapes[present])
+        shapes[present] = normalized.geometries
+        errors = dict(zip(present.tolist(), normalized.errors))
+        changes = dict(zip(present.tolist(), normalized.changes))
+        shapes = shapely.set_srid(shapes, 4326)
+        ewkb = shapely.to_wkb(shapes, hex=True, include_srid=True)
+
+        loadable = ~shapely.is_missing(shapes)
+        extent = tuple(shapely.total_bounds(shapes[loadable]).tolist()) if loadable.any() else None
+
+        rows = []
+        for i, index in enumerate(indexes):
+            if missing[i]:
+                self.error(index, "Invalid GeoJSON geometry")
+            elif errors[i] is not None:
+                self.error(index, errors[i])
+            else:
+                for step in changes[i]:
+                    self.report.normalized[step] = self.report.normalized.get(step, 0) + 1
+                props = properties[i]
+                rows.append((index, props.get("name"), props.get("type") or shapes[i].geom_type, ewkb[i]))
+        return rows, extent
+
+    def load_batch(self, batch):
+        rows, extent = self.prepare(batch)
+        self.report.batches += 1
+        if not rows:
+            return
+        try:
+            self.copy_rows(rows)
+            self.db.commit()
+            self.report.inserted += len(rows)
+        except Exception:
+            self.db.rollback()
+            self.insert_rows(rows)
+        if self.response_cache is not None:
+            # New rows get ids past every existing one, so only open-ended pages
+            # and entries overlapping the batch extent can be stale
+            self.response_cache.invalidate(None, [extent])
+
+    def copy_rows(self, rows):
+        data = io.StringIO()
+        for _, name, geometry_type, ewkb in rows:
+            data.write(f"{_copy_escape(name)}\t{_copy_escape(geometry_type)}\t{ewkb}\n")
+        data.seek(0)
+        cursor = self.db.connection().connection.cursor()
+        try:
+            cursor.copy_expert(COPY_SQL, data)
+        finally:
+            cursor.close()
+
+    def insert_rows(self, rows):
+        """Fallback when COPY rejects a batch: insert row by row behind
+        savepoints so that only the offending features are reported."""
+        cursor = self.db.connection().connection.cursor()
+        try:
+            for index, name, geometry_type, ewkb in rows:
+                cursor.execute("SAVEPOINT bulk_row")
+                try:
+                    cursor.execute(INSERT_SQL, (name, geometry_type, ewkb))
+                except Exception as exc:
+                    cursor.execute("ROLLBACK TO SAVEPOINT bulk_row")
+                    self.error(index, str(exc).strip())
+                else:
+                    cursor.execute("RELEASE SAVEPOINT bulk_row")
+                    self.report.inserted += 1
+        finally:
+            cursor.close()
+        self.db.commit()
+
+
+def bulk_import(db: Session, stream, fmt: str = "geojson", batch_size: int = DEFAULT_BATCH_SIZE, response_cache=cache):
+    """Load a FeatureCollection (fmt="geojson") or NDJSON stream into cities."""
+    features = iter_ndjson(stream) if fmt == "ndjson" else iter_feature_collection(stream)
+    loader = BulkLoader(db, batch_size=batch_size, response_cache=response_cache)
+    try:
+        return loader.load(features)
+    except ValueError as exc:
+        # Malformed JSON structure: keep what was committed, report the rest
+        loader.error(-1, f"Malformed input: {exc}")
+        return loader.report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk load GeoJSON features into the cities table.")
+    parser.add_argument("path", help="FeatureCollection or NDJSON file, '-' for stdin")
+    parser.add_argument("--format", choices=["geojson", "ndjson"], help="defaults to the file extension")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    fmt = args.format
+    if fmt is None:
+        fmt = "ndjson" if args.path.endswith((".ndjson", ".geojsonl", ".geojsons", ".jsonl")) else "geojson"
+
+    from .database import SessionLocal
+
+    stream = sys.stdin.buffer if args.path == "-" else open(args.path, "rb")
+    with stream, SessionLocal() as db:
+        report = bulk_import(db, stream, fmt=fmt, batch_size=args.batch_size, response_cache=None)
+    print(report.model_dump_json(indent=2))
+    return 0 if report.failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
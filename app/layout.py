@@ -0,0 +1,180 @@
+"""Optional storage layout of `cities`: geohash order and partitioning.
+
+The layout is applied by the `layout` Alembic branch (README "Storage
+Layout"):
+
+- ``cluster_cities_by_geohash``: an index on the geohash of each row's
+  centroid, and the table rewritten in that order, so the rows a bbox query
+  reads sit on few, adjacent pages.
+- ``partition_cities``: partitions by `type` and, below that, by
+  ``cities_region(geometry)``, a coarse lon/lat grid cell.
+
+Rows written after the rewrite land wherever there is free space, so the
+order decays. `recluster` restores it one partition at a time, worst
+ordered first (by the correlation of the geohash index with the physical
+order, as measured by ANALYZE), so each run only locks the partitions it
+rewrites, each for as long as that one takes.
+
+With CITIES_PARTITIONED set, bbox filters (crud.bbox_filter, tiles) also
+compare the partition key against the regions the bbox overlaps, which is
+what lets the planner skip the other partitions. `type` filters need
+nothing extra.
+
+CLI usage:
+    python -m app.layout status
+    python -m app.layout recluster --threshold 0.9 --max-partitions 4
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from typing import NamedTuple, Optional
+
+from sqlalchemy import any_, func, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import OperationalError
+
+CITIES_PARTITIONED = os.getenv("CITIES_PARTITIONED", "false").lower() in ("1", "true", "yes")
+GEOHASH_INDEX = "ix_cities_geohash"
+# Partitions whose geohash order correlates less than this with their
+# physical order are reclustered
+RECLUSTER_THRESHOLD = 0.9
+# Smaller partitions are cheap to read in any order
+RECLUSTER_MIN_ROWS = 10_000
+# Give up on a partition rather than queue every reader behind the lock
+RECLUSTER_LOCK_TIMEOUT = "5s"
+
+# Used in raw SQL (tiles); :minx, :miny, :maxx, :maxy are the bbox
+REGION_SQL = "cities_region({geometry}) = ANY(cities_regions(:minx, :miny, :maxx, :maxy))"
+
+# Every leaf (or the table itself, when it is not partitioned) with its
+# geohash index and how well ordered it is
+LEAVES_SQL = text("""
+    SELECT leaf.relname AS table_name,
+           idx.relname AS index_name,
+           greatest(leaf.reltuples, 0)::bigint AS rows,
+           pg_total_relation_size(leaf.oid) AS bytes,
+           (SELECT s.correlation FROM pg_stats s
+            WHERE s.schemaname = ns.nspname AND s.tablename = idx.relname) AS correlation
+    FROM pg_partition_tree(CAST(:index AS regclass)) tree
+    JOIN pg_index i ON i.indexrelid = tree.relid
+    JOIN pg_class idx ON idx.oid = i.indexrelid
+    JOIN pg_class leaf ON leaf.oid = i.indrelid
+    JOIN pg_namespace ns ON ns.oid = idx.relnamespace
+    WHERE tree.isleaf
+    ORDER BY leaf.relname
+""")
+
+logger = logging.getLogger(__name__)
+
+
+class Leaf(NamedTuple):
+    table_name: str
+    index_name: str
+    rows: int
+    bytes: int
+    correlation: Optional[float]
+
+    def ordered(self, threshold: float = RECLUSTER_THRESHOLD) -> bool:
+        return self.correlation is not None and abs(self.correlation) >= threshold
+
+
+def region_filter(geometry, bbox):
+    """Partition pruning predicate for rows overlapping `bbox`; always true
+    for them, so it never changes a result."""
+    return func.cities_region(geometry) == any_(func.cities_regions(*bbox))
+
+
+def region_params(bbox) -> dict:
+    return dict(zip(("minx", "miny", "maxx", "maxy"), bbox))
+
+
+def leaves(connection: Connection, analyze: bool = False) -> list:
+    """The partitions holding rows (or just `cities`), with their order."""
+    if connection.execute(text("SELECT to_regclass(:index)"), {"index": GEOHASH_INDEX}).scalar() is None:
+        raise RuntimeError(f"{GEOHASH_INDEX} does not exist; apply the layout migrations (alembic upgrade layout@head)")
+    result = [Leaf(*row) for row in connection.execute(LEAVES_SQL, {"index": GEOHASH_INDEX})]
+    if analyze:
+        for leaf in result:
+            connection.execute(text(f'ANALYZE "{leaf.table_name}"'))
+        result = [Leaf(*row) for row in connection.execute(LEAVES_SQL, {"index": GEOHASH_INDEX})]
+    return result
+
+
+def recluster(
+    engine: Engine,
+    threshold: float = RECLUSTER_THRESHOLD,
+    max_partitions: Optional[int] = None,
+    min_rows: int = RECLUSTER_MIN_ROWS,
+    lock_timeout: str = RECLUSTER_LOCK_TIMEOUT,
+    dry_run: bool = False,
+) -> list:
+    """CLUSTER the partitions that have drifted out of geohash order.
+
+    Each partition is rewritten in its own transaction, worst ordered
+    first. Returns (leaf, outcome) pairs, outcome being "clustered",
+    "skipped: ..." or "planned" with `dry_run`.
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        candidates = sorted(
+            (leaf for leaf in leaves(connection, analyze=True) if leaf.rows >= min_rows and not leaf.ordered(threshold)),
+            key=lambda leaf: abs(leaf.correlation or 0),
+        )[:max_partitions]
+        if dry_run:
+            return [(leaf, "planned") for leaf in candidates]
+        connection.execute(text("SELECT set_config('lock_timeout', :timeout, false)"), {"timeout": lock_timeout})
+        outcomes = []
+        for leaf in candidates:
+            start = time.perf_counter()
+            try:
+                connection.execute(text(f'CLUSTER "{leaf.table_name}" USING "{leaf.index_name}"'))
+            except OperationalError as exc:
+                # Most likely the lock timeout; the next run tries again
+                logger.warning("Skipped %s: %s", leaf.table_name, exc.orig)
+                outcomes.append((leaf, f"skipped: {str(exc.orig).strip()}"))
+                continue
+            connection.execute(text(f'ANALYZE "{leaf.table_name}"'))
+            logger.info("Clustered %s in %.1f s", leaf.table_name, time.perf_counter() - start)
+            outcomes.append((leaf, "clustered"))
+        return outcomes
+
+
+def _print_leaves(rows):
+    print(f"{'partition':<24}{'rows':>12}{'MiB':>10}{'order':>8}  outcome")
+    for leaf, outcome in rows:
+        correlation = "-" if leaf.correlation is None else f"{leaf.correlation:.3f}"
+        print(f"{leaf.table_name:<24}{leaf.rows:>12}{leaf.bytes / (1 << 20):>10.1f}{correlation:>8}  {outcome}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect and maintain the geohash order of the cities table.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    status = commands.add_parser("status", help="show each partition's size and order")
+    status.add_argument("--analyze", action="store_true", help="refresh the statistics first")
+    run = commands.add_parser("recluster", help="CLUSTER the partitions that are out of order")
+    run.add_argument("--threshold", type=float, default=RECLUSTER_THRESHOLD, help="minimum |correlation| to leave alone")
+    run.add_argument("--max-partitions", type=int, help="stop after this many partitions")
+    run.add_argument("--min-rows", type=int, default=RECLUSTER_MIN_ROWS)
+    run.add_argument("--lock-timeout", default=RECLUSTER_LOCK_TIMEOUT, help="skip partitions locked for longer")
+    run.add_argument("--dry-run", action="store_true", help="only list the partitions that would be clustered")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    from .database import engine
+
+    try:
+        if args.command == "status":
+            with engine.connect() as connection:
+                rows = [(leaf, "") for leaf in leaves(connection, analyze=args.analyze)]
+                connection.commit()
+        else:
+            rows = recluster(engine, args.threshold, args.max_partitions, args.min_rows, args.lock_timeout, args.dry_run)
+    except RuntimeError as exc:
+        parser.error(str(exc))
+    _print_leaves(rows)
+    return 1 if any(outcome.startswith("skipped") for _, outcome in rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,28 +1,364 @@
-from fastapi import FastAPI, Depends
+import asyncio
+import logging
+import os
+import tempfile
+from contextlib import asynccontextmanager
+from typing import Literal, Optional
+from fastapi import APIRouter, FastAPI, Depends, Header, HTTPException, Query, Request, WebSocket
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from . import models, schemas, crud, database
+from . import schemas, crud, aggregates, async_crud, changes, compression, database, export, ingest, metrics, normalize, replica, search, tiles
+from .cache import Rendered, cache
 
-models.base.metadata.create_all(bind=database.engine)
+# The schema is managed by Alembic (alembic upgrade schema@head), not created here:
+# importing or starting the app needs no database.
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
 
-@app.post("/geo-data/create/", response_model=schemas.GeoOut)
-def create_geo_data(geo_data: schemas.GeoCreate, db: Session = Depends(database.get_db)):
-    return crud.create_geo_data(db, geo_data)
+async def refresh_replica():
+    while True:
+        await asyncio.sleep(replica.REPLICA_REFRESH_INTERVAL)
+        try:
+            await asyncio.to_thread(replica.replica.refresh)
+        except Exception:
+            # Keep serving the last snapshot; the next refresh catches up
+            logger.exception("Replica refresh failed")
 
-@app.get("/geo-data/{geo_data_id}", response_model=schemas.GeoOut)
-def get_geo_data(geo_data_id: int, db: Session = Depends(database.get_db)):
-    return crud.get_geo_data(db, geo_data_id)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Runs in each worker after the fork, so every worker gets its own pools
+    sessions = database.engines()
+    refresher = None
+    if replica.REPLICA_MODE == "memory":
+        await asyncio.to_thread(replica.replica.load, sessions.SessionLocal)
+        refresher = asyncio.create_task(refresh_replica())
+    # Numbers and prunes the change log, and invalidates this worker's
+    # cache on writes made anywhere else
+    changes.hub.start(sessions.async_engine)
+    yield
+    if refresher is not None:
+        refresher.cancel()
+    await changes.hub.stop()
+    await database.dispose()
 
-@app.get("/geo-data/list/", response_model=list[schemas.GeoOut])
-def list_geo_data(db: Session = Depends(database.get_db)):
-    return crud.list_geo_data(db)
+router = APIRouter()
 
-@app.delete("/geo-data/{geo_data_id}", response_model=dict)
-def delete_geo_data(geo_data_id: int, db: Session = Depends(database.get_db)):
-    return crud.delete_geo_data(db, geo_data_id)
+STREAM_MEDIA_TYPES = {"geojson": "application/geo+json", "ndjson": "application/x-ndjson"}
 
-@app.put("/geo-data/{geo_data_id}", response_model=schemas.GeoOut)
-def update_geo_data(geo_data_id: int, geo_data: schemas.GeoCreate, db: Session = Depends(database.get_db)):
-    return crud.update_geo_data(db, geo_data_id, geo_data)
+def rendered_response(
+    rendered: Rendered,
+    if_none_match: Optional[str] = None,
+    options: Optional[schemas.GeometryOptions] = None,
+    headers: Optional[dict] = None,
+):
+    # crud renders the body with orjson; returning a Response skips the
+    # response_model re-validation (response_model is kept for the docs)
+    headers = dict(headers or {})
+    media_type = "application/json"
+    if options is not None:
+        # The body depends on the Accept header
+        headers["Vary"] = "Accept"
+        media_type = crud.FORMAT_MEDIA_TYPES[options.format]
+    if rendered.etag:
+        headers["ETag"] = rendered.etag
+    if rendered.last_modified:
+        headers["Last-Modified"] = rendered.last_modified
+    if rendered.body is None or crud.etag_matches(if_none_match, rendered.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=rendered.body, media_type=media_type, headers=headers)
 
+def geometry_options(
+    simplify: Optional[float] = Query(None, ge=0, description="ST_SimplifyPreserveTopology tolerance in degrees"),
+    precision: Optional[int] = Query(None, ge=0, le=crud.GEOJSON_MAX_DECIMALS, description="Decimal digits per coordinate"),
+    zoom: Optional[int] = Query(None, ge=0, le=tiles.MAX_ZOOM, description="Serve the precomputed geometry for this zoom band"),
+):
+    return schemas.GeometryOptions(simplify=simplify, precision=precision, zoom=zoom)
+
+def negotiated_options(page: bool):
+    """geometry_options plus the response format from the Accept header."""
+    def dependency(
+        options: schemas.GeometryOptions = Depends(geometry_options),
+        accept: Optional[str] = Header(None),
+        view: Optional[Literal["summary"]] = Query(None, description="summary: precomputed bbox, centroid and size instead of the geometry"),
+    ):
+        # Without GDAL, FlatGeobuf is simply not on offer
+        skip = frozenset() if export.available("flatgeobuf") else frozenset({"flatgeobuf"})
+        fmt = crud.negotiate_format(accept, page, skip)
+        if view is not None and fmt is not None:
+            raise HTTPException(status_code=406, detail="The summary view is only available as application/json")
+        return options.model_copy(update={"format": fmt, "view": view})
+    return dependency
+
+feature_options = negotiated_options(page=False)
+page_options = negotiated_options(page=True)
+
+def size_filter(
+    min_area: Optional[float] = Query(None, ge=0, description="Geodesic area in square metres"),
+    max_area: Optional[float] = Query(None, ge=0, description="Geodesic area in square metres"),
+    min_length: Optional[float] = Query(None, ge=0, description="Geodesic length in metres"),
+    max_length: Optional[float] = Query(None, ge=0, description="Geodesic length in metres"),
+    min_npoints: Optional[int] = Query(None, ge=0),
+    max_npoints: Optional[int] = Query(None, ge=0),
+):
+    return schemas.SizeFilter(
+        min_area=min_area,
+        max_area=max_area,
+        min_length=min_length,
+        max_length=max_length,
+        min_npoints=min_npoints,
+        max_npoints=max_npoints,
+    )
+
+@router.post("/geo-data/create/", response_model=schemas.GeoOut)
+async def create_geo_data(geo_data: schemas.GeoCreate, db: AsyncSession = Depends(database.get_async_db)):
+    rendered, steps = await async_crud.create_geo_data(db, geo_data)
+    return rendered_response(rendered, headers=normalize.changes_header(steps))
+
+@router.post("/geo-data/bulk/", response_model=schemas.BulkImportReport)
+async def bulk_import_geo_data(
+    request: Request,
+    format: Literal["geojson", "ndjson"] = "geojson",
+    batch_size: int = Query(ingest.DEFAULT_BATCH_SIZE, ge=1, le=100_000),
+    db: Session = Depends(database.get_db),
+):
+    with tempfile.SpooledTemporaryFile(max_size=ingest.SPOOL_SIZE) as body:
+        async for chunk in request.stream():
+            body.write(chunk)
+        body.seek(0)
+        return await run_in_threadpool(ingest.bulk_import, db, body, format, batch_size)
+
+@router.post("/geo-data/batch/", response_model=schemas.BatchReport)
+async def batch_geo_data(batch: schemas.BatchRequest, db: AsyncSession = Depends(database.get_async_db)):
+    return await async_crud.batch_geo_data(db, batch)
+
+# Declared before /geo-data/{geo_data_id}, which would otherwise match them
+@router.get("/geo-data/search", response_model=schemas.SearchResult)
+async def search_geo_data(
+    q: str = Query(..., min_length=1, max_length=200),
+    mode: Literal["prefix", "fuzzy"] = "prefix",
+    limit: int = Query(search.DEFAULT_SEARCH_RESULTS, ge=1, le=search.MAX_SEARCH_RESULTS),
+    bbox: Optional[str] = Query(None, description="minx,miny,maxx,maxy"),
+    type: Optional[str] = None,
+    db: AsyncSession = Depends(database.get_async_db),
+):
+    bbox = crud.parse_bbox(bbox) if bbox is not None else None
+    body = await search.search(db, q, mode, limit, bbox, type)
+    return Response(content=body, media_type="application/json")
+
+@router.get("/geo-data/changes", response_model=schemas.ChangeFeed)
+async def list_changes(
+    since: Optional[int] = Query(None, ge=0, description="Last seq seen; omit to get the current position"),
+    limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE),
+    bbox: Optional[str] = Query(None, description="minx,miny,maxx,maxy"),
+    db: AsyncSession = Depends(database.get_async_db),
+):
+    bbox = crud.parse_bbox(bbox) if bbox is not None else None
+    body = await changes.changes_since(db, since, limit, bbox)
+    return Response(content=body, media_type="application/json")
+
+@router.websocket("/geo-data/changes/ws")
+async def subscribe_changes(
+    websocket: WebSocket,
+    since: Optional[int] = Query(None, ge=0),
+    bbox: Optional[str] = Query(None),
+    db: AsyncSession = Depends(database.get_async_db),
+):
+    await changes.serve(websocket, db, since, bbox)
+
+@router.get("/geo-data/{geo_data_id}", response_model=schemas.GeoOut)
+async def get_geo_data(
+    geo_data_id: int,
+    options: schemas.GeometryOptions = Depends(feature_options),
+    if_none_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(database.get_async_db),
+):
+    rendered = await async_crud.get_geo_data(db, geo_data_id, if_none_match, options)
+    return rendered_response(rendered, if_none_match, options)
+
+@router.get("/geo-data/list/", response_model=schemas.GeoPage)
+async def list_geo_data(
+    options: schemas.GeometryOptions = Depends(page_options),
+    size: schemas.SizeFilter = Depends(size_filter),
+    limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE),
+    after_id: Optional[int] = None,
+    if_none_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(database.get_async_db),
+):
+    rendered = await async_crud.list_geo_data(
+        db, limit=limit, after_id=after_id, if_none_match=if_none_match, options=options, size=size
+    )
+    return rendered_response(rendered, if_none_match, options)
+
+@router.get("/geo-data/list/stream")
+def stream_geo_data(
+    options: schemas.GeometryOptions = Depends(geometry_options),
+    format: Literal["geojson", "ndjson"] = "geojson",
+    db: Session = Depends(database.get_db),
+):
+    return StreamingResponse(crud.stream_geo_data(db, format, options), media_type=STREAM_MEDIA_TYPES[format])
+
+@router.get("/geo-data/export/", response_class=StreamingResponse)
+def export_geo_data(
+    format: Literal["parquet", "flatgeobuf"] = "parquet",
+    bbox: Optional[str] = Query(None, description="minx,miny,maxx,maxy"),
+    type: Optional[str] = None,
+    db: Session = Depends(database.get_db),
+):
+    export.require(format)
+    bbox = crud.parse_bbox(bbox) if bbox is not None else None
+    media_type, extension = export.EXPORT_FORMATS[format]
+    return StreamingResponse(
+        export.stream_export(db, format, bbox, type),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="cities.{extension}"'},
+    )
+
+@router.get("/geo-data/query/", response_model=schemas.GeoPage)
+async def query_geo_data(
+    options: schemas.GeometryOptions = Depends(page_options),
+    size: schemas.SizeFilter = Depends(size_filter),
+    bbox: str = Query(..., description="minx,miny,maxx,maxy"),
+    limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE),
+    after_id: Optional[int] = None,
+    if_none_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(database.get_async_db),
+):
+    rendered = await async_crud.query_geo_data(
+        db,
+        bbox=crud.parse_bbox(bbox),
+        limit=limit,
+        after_id=after_id,
+        if_none_match=if_none_match,
+        options=options,
+        size=size,
+    )
+    return rendered_response(rendered, if_none_match, options)
+
+@router.post("/geo-data/query/", response_model=schemas.GeoPage)
+async def spatial_query_geo_data(
+    geo_query: schemas.GeoQuery,
+    options: schemas.GeometryOptions = Depends(page_options),
+    size: schemas.SizeFilter = Depends(size_filter),
+    bbox: Optional[str] = Query(None, description="minx,miny,maxx,maxy"),
+    limit: int = Query(crud.DEFAULT_PAGE_SIZE, ge=1, le=crud.MAX_PAGE_SIZE),
+    after_id: Optional[int] = None,
+    if_none_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(database.get_async_db),
+):
+    bbox = crud.parse_bbox(bbox) if bbox is not None else None
+    rendered = await async_crud.query_geo_data(
+        db,
+        bbox=bbox,
+        geo_query=geo_query,
+        limit=limit,
+        after_id=after_id,
+        if_none_match=if_none_match,
+        options=options,
+        size=size,
+    )
+    return rendered_response(rendered, if_none_match, options)
+
+@router.get("/geo-data/nearest/", response_model=schemas.NearestResult)
+async def nearest_geo_data(
+    lon: float = Query(..., ge=-180, le=180),
+    lat: float = Query(..., ge=-90, le=90),
+    k: int = Query(crud.DEFAULT_NEAREST, ge=1, le=crud.MAX_NEAREST),
+    type: Optional[str] = None,
+    name: Optional[str] = None,
+    options: schemas.GeometryOptions = Depends(geometry_options),
+    db: AsyncSession = Depends(database.get_async_db),
+):
+    body = await async_crud.nearest_geo_data(db, lon, lat, k, type=type, name=name, options=options)
+    return Response(content=body, media_type="application/json")
+
+@router.get("/geo-data/stats/types", response_model=schemas.TypeCounts)
+async def type_counts(
+    bbox: Optional[str] = Query(None, description="minx,miny,maxx,maxy"),
+    db: AsyncSession = Depends(database.get_async_db),
+):
+    bbox = crud.parse_bbox(bbox) if bbox is not None else None
+    return Response(content=await aggregates.type_counts(db, bbox), media_type="application/json")
+
+@router.get("/geo-data/stats/extent", response_model=schemas.ExtentSummary)
+async def extent_summary(
+    bbox: Optional[str] = Query(None, description="minx,miny,maxx,maxy"),
+    type: Optional[str] = None,
+    db: AsyncSession = Depends(database.get_async_db),
+):
+    bbox = crud.parse_bbox(bbox) if bbox is not None else None
+    return Response(content=await aggregates.extent(db, bbox, type), media_type="application/json")
+
+@router.get("/geo-data/stats/grid", response_model=schemas.GridSummary)
+async def grid_summary(
+    size: Optional[float] = Query(None, ge=aggregates.MIN_GRID_SIZE, le=360, description="Cell size in degrees"),
+    geohash: Optional[int] = Query(None, ge=1, le=aggregates.MAX_GEOHASH_PRECISION, description="Geohash precision"),
+    bbox: Optional[str] = Query(None, description="minx,miny,maxx,maxy"),
+    type: Optional[str] = None,
+    db: AsyncSession = Depends(database.get_async_db),
+):
+    bbox = crud.parse_bbox(bbox) if bbox is not None else None
+    body = await aggregates.grid(db, size=size, geohash=geohash, bbox=bbox, type=type)
+    return Response(content=body, media_type="application/json")
+
+@router.get("/geo-data/stats/clusters", response_model=schemas.ClusterSummary)
+async def cluster_summary(
+    method: Literal["kmeans", "dbscan"] = "kmeans",
+    k: int = Query(10, ge=1, le=aggregates.MAX_KMEANS_CLUSTERS),
+    eps: Optional[float] = Query(None, gt=0, description="DBSCAN neighbour distance in degrees"),
+    min_points: int = Query(5, ge=1),
+    bbox: Optional[str] = Query(None, description="minx,miny,maxx,maxy"),
+    type: Optional[str] = None,
+    db: AsyncSession = Depends(database.get_async_db),
+):
+    bbox = crud.parse_bbox(bbox) if bbox is not None else None
+    body = await aggregates.clusters(db, method, k=k, eps=eps, min_points=min_points, bbox=bbox, type=type)
+    return Response(content=body, media_type="application/json")
+
+@router.delete("/geo-data/{geo_data_id}", response_model=dict)
+async def delete_geo_data(geo_data_id: int, db: AsyncSession = Depends(database.get_async_db)):
+    return await async_crud.delete_geo_data(db, geo_data_id)
+
+@router.put("/geo-data/{geo_data_id}", response_model=schemas.GeoOut)
+async def update_geo_data(geo_data_id: int, geo_data: schemas.GeoCreate, db: AsyncSession = Depends(database.get_async_db)):
+    rendered, steps = await async_crud.update_geo_data(db, geo_data_id, geo_data)
+    return rendered_response(rendered, headers=normalize.changes_header(steps))
+
+@router.get("/tiles/{z}/{x}/{y}.mvt", response_class=Response)
+async def get_tile(z: int, x: int, y: int, db: AsyncSession = Depends(database.get_async_db)):
+    return Response(content=await tiles.get_tile(db, z, x, y), media_type=tiles.MVT_MEDIA_TYPE)
+
+@router.get("/pool/stats", response_model=dict)
+def get_pool_stats():
+    # Pools are per process, so report the worker pid alongside the numbers
+    return {
+        "pid": os.getpid(),
+        "sync": database.pool_stats(database.engine),
+        "async": database.pool_stats(database.async_engine),
+    }
+
+@router.get("/cache/stats", response_model=dict)
+def get_cache_stats():
+    return {**cache.stats(), "compressed_variants": compression.variants.stats()}
+
+@router.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@router.get("/replica/stats", response_model=dict)
+def get_replica_stats():
+    return {"pid": os.getpid(), **replica.replica.stats()}
+
+def create_app() -> FastAPI:
+    """Build the application; `gunicorn "app.main:create_app()"` and
+    `uvicorn --factory app.main:create_app` call this in each worker."""
+    app = FastAPI(lifespan=lifespan)
+    # Added first so it runs inside MetricsMiddleware, which then records the
+    # encoded response size
+    app.add_middleware(compression.CompressionMiddleware)
+    app.add_middleware(metrics.MetricsMiddleware)
+    app.include_router(router)
+    return app
+
+app = create_app()
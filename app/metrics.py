@@ -0,0 +1,178 @@
+"""Prometheus-style metrics and the opt-in request profiler.
+
+Histograms are kept in process and rendered in the Prometheus text format
+(0.0.4) by ``GET /metrics``; like the pool stats they are per worker, so
+scrape each worker or run one worker per container.
+
+The profiler is compiled in but inert unless PROFILE_TOKEN is set. A
+request carrying ``X-Profile: <token>`` is then run under cProfile and the
+stats are written to PROFILE_DIR as a ``.prof`` file (open with pstats or
+snakeviz); the file name is returned in the ``X-Profile-File`` header. Only
+one request is profiled at a time, others run normally. Async handlers
+share the event loop thread, so the profile also shows whatever else ran
+on the loop while the request was waiting.
+"""
+import cProfile
+import os
+import re
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+PROFILE_DIR = os.getenv("PROFILE_DIR", tempfile.gettempdir())
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+ROW_BUCKETS = (0, 1, 10, 50, 100, 500, 1000, 5000, 10000)
+
+
+class Histogram:
+    """Cumulative-bucket histogram with labels."""
+
+    def __init__(self, name, documentation, labelnames, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.series = {}  # label values -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = {key: list(values) for key, values in self.series.items()}
+        for key, values in sorted(series.items()):
+            labels = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key)]
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                bucket_labels = ",".join(labels + [f'le="{bound}"'])
+                lines.append(f"{self.name}_bucket{{{bucket_labels}}} {cumulative}")
+            bucket_labels = ",".join(labels + ['le="+Inf"'])
+            lines.append(f"{self.name}_bucket{{{bucket_labels}}} {values[-1]}")
+            suffix = "{" + ",".join(labels) + "}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {values[-2]}")
+            lines.append(f"{self.name}_count{suffix} {values[-1]}")
+        return "\n".join(lines)
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Request latency by route.", ("method", "route", "status")
+)
+RESPONSE_BYTES = Histogram(
+    "http_response_size_bytes", "Response body size by route.", ("method", "route"), SIZE_BUCKETS
+)
+DB_SECONDS = Histogram("db_query_duration_seconds", "Database round-trip time by operation.", ("operation",))
+ROWS_RETURNED = Histogram("db_rows_returned", "Rows returned by operation.", ("operation",), ROW_BUCKETS)
+SERIALIZE_SECONDS = Histogram(
+    "serialization_duration_seconds", "Time spent rendering response bodies by operation.", ("operation",)
+)
+
+REGISTRY = (REQUEST_SECONDS, RESPONSE_BYTES, DB_SECONDS, ROWS_RETURNED, SERIALIZE_SECONDS)
+
+
+def render():
+    return "\n".join(histogram.render() for histogram in REGISTRY) + "\n"
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency and response size per route.
+
+    Timing runs until the last body chunk is sent, so streamed responses
+    are measured in full. The route label is the path template, never the
+    raw URL, to keep label cardinality bounded.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+        size = 0
+        profile_file = None
+
+        async def observe(message):
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if profile_file is not None:
+                    message["headers"] = [*message.get("headers", []), (b"x-profile-file", profile_file.encode())]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            headers = dict(scope.get("headers") or [])
+            if profiling_requested(headers.get(b"x-profile", b"").decode("latin-1") or None):
+                with profile(scope["path"]) as path:
+                    profile_file = os.path.basename(path) if path else None
+                    await self.app(scope, receive, observe)
+            else:
+                await self.app(scope, receive, observe)
+        finally:
+            route = scope.get("route")
+            labels = {"method": scope["method"], "route": getattr(route, "path", "unmatched")}
+            REQUEST_SECONDS.observe(time.perf_counter() - start, status=status, **labels)
+            RESPONSE_BYTES.observe(size, **labels)
+
+
+_profile_lock = threading.Lock()
+
+
+def profiling_requested(header_value):
+    return PROFILE_TOKEN is not None and header_value == PROFILE_TOKEN
+
+
+@contextmanager
+def profile(route):
+    """Run the block under cProfile if no other request is being profiled.
+
+    Yields the path the stats will be written to, or None when skipped.
+    """
+    if not _profile_lock.acquire(blocking=False):
+        yield None
+        return
+    name = re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "root"
+    path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{name}.prof")
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+        try:
+            yield path
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path)
+    finally:
+        _profile_lock.release()
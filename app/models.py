@@ -1,7 +1,27 @@
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import DDL, BigInteger, Column, Computed, DateTime, Float, Identity, Index, Integer, String, event, func, text
+from sqlalchemy.orm import deferred
 from geoalchemy2 import Geometry
 from app.database import base
 
+# Precomputed simplified geometries: highest zoom of the band -> tolerance in degrees.
+# Requests at or below a band's zoom can be served from its column.
+SIMPLIFIED_BANDS = {4: 0.05, 8: 0.005, 12: 0.0005}
+
+
+def simplified_geometry(tolerance):
+    # Stored generated column, so every write path (ORM, COPY, raw SQL) keeps it current.
+    # Deferred so ORM loads of a row don't pull the extra geometries.
+    return deferred(Column(
+        Geometry(geometry_type="GEOMETRY", srid=4326, spatial_index=False),
+        Computed(f"ST_SimplifyPreserveTopology(geometry, {tolerance})", persisted=True),
+    ))
+
+
+def generated(type_, expression):
+    # Stored generated column: a cheap summary of the geometry that reads
+    # never have to detoast the geometry for
+    return Column(type_, Computed(expression, persisted=True))
+
 
 class GeoData(base):
     __tablename__ = "cities"
@@ -10,5 +30,104 @@ class GeoData(base):
     name = Column(String, index=True)
     type = Column(String, index=True)
     geometry = Column(Geometry(geometry_type="GEOMETRY", srid=4326))
+    # Bumped on every write; used for ETag / Last-Modified validators
+    version = Column(Integer, nullable=False, server_default="1")
+    updated_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    geometry_z4 = simplified_geometry(SIMPLIFIED_BANDS[4])
+    geometry_z8 = simplified_geometry(SIMPLIFIED_BANDS[8])
+    geometry_z12 = simplified_geometry(SIMPLIFIED_BANDS[12])
+    bbox_minx = generated(Float, "ST_XMin(geometry)")
+    bbox_miny = generated(Float, "ST_YMin(geometry)")
+    bbox_maxx = generated(Float, "ST_XMax(geometry)")
+    bbox_maxy = generated(Float, "ST_YMax(geometry)")
+    centroid_x = generated(Float, "ST_X(ST_Centroid(geometry))")
+    centroid_y = generated(Float, "ST_Y(ST_Centroid(geometry))")
+    # Geodesic, in square metres and metres (0 for points; polygons have no length)
+    area = generated(Float, "ST_Area(geography(geometry))")
+    length = generated(Float, "ST_Length(geography(geometry))")
+    npoints = generated(Integer, "ST_NPoints(geometry)")
+
+    # Name search, see app.search: trigram GIN for fuzzy matches, and a
+    # byte-ordered B-tree on the lowercased name for sorted prefix matches
+    __table_args__ = (
+        Index("ix_cities_name_trgm", "name", postgresql_using="gin", postgresql_ops={"name": "gin_trgm_ops"}),
+        Index("ix_cities_name_prefix", func.lower(name).collate("C")),
+    )
+
+
+event.listen(GeoData.__table__, "before_create", DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+
+
+class GeoDataChange(base):
+    """Change log of `cities`, written by the triggers in CHANGE_LOG_DDL."""
+    __tablename__ = "cities_changes"
+
+    change_id = Column(BigInteger, Identity(), primary_key=True)
+    # Feed position; NULL until changes.sequence() numbers the row in commit order
+    seq = Column(BigInteger, unique=True)
+    # Writing transaction, see changes.sequence()
+    xid = Column(BigInteger, nullable=False, server_default=text("CAST(CAST(pg_current_xact_id() AS text) AS bigint)"))
+    op = Column(String, nullable=False)
+    feature_id = Column(Integer, nullable=False)
+    version = Column(Integer)
+    # Bounding box of the old and new geometry together
+    bbox_minx = Column(Float)
+    bbox_miny = Column(Float)
+    bbox_maxx = Column(Float)
+    bbox_maxy = Column(Float)
+    changed_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now(), index=True)
+
+    __table_args__ = (Index("ix_cities_changes_pending", "xid", postgresql_where=text("seq IS NULL")),)
+
 
+# Statement-level triggers, so a bulk COPY logs its rows with one INSERT ... SELECT
+# from the transition table. The same SQL is in the add_change_log migration.
+CHANGE_LOG_DDL = [
+    """
+    CREATE OR REPLACE FUNCTION log_cities_changes() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO cities_changes (op, feature_id, version, bbox_minx, bbox_miny, bbox_maxx, bbox_maxy)
+            SELECT 'create', id, version,
+                   ST_XMin(geometry), ST_YMin(geometry), ST_XMax(geometry), ST_YMax(geometry)
+            FROM new_rows;
+        ELSIF TG_OP = 'UPDATE' THEN
+            INSERT INTO cities_changes (op, feature_id, version, bbox_minx, bbox_miny, bbox_maxx, bbox_maxy)
+            SELECT 'update', n.id, n.version,
+                   LEAST(ST_XMin(o.geometry), ST_XMin(n.geometry)), LEAST(ST_YMin(o.geometry), ST_YMin(n.geometry)),
+                   GREATEST(ST_XMax(o.geometry), ST_XMax(n.geometry)), GREATEST(ST_YMax(o.geometry), ST_YMax(n.geometry))
+            FROM new_rows n JOIN old_rows o ON o.id = n.id;
+        ELSE
+            INSERT INTO cities_changes (op, feature_id, version, bbox_minx, bbox_miny, bbox_maxx, bbox_maxy)
+            SELECT 'delete', id, version,
+                   ST_XMin(geometry), ST_YMin(geometry), ST_XMax(geometry), ST_YMax(geometry)
+            FROM old_rows;
+        END IF;
+        IF FOUND THEN
+            PERFORM pg_notify('cities_changes', '');
+        END IF;
+        RETURN NULL;
+    END
+    $$
+    """,
+    """
+    CREATE TRIGGER cities_log_insert AFTER INSERT ON cities
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION log_cities_changes()
+    """,
+    """
+    CREATE TRIGGER cities_log_update AFTER UPDATE ON cities
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION log_cities_changes()
+    """,
+    """
+    CREATE TRIGGER cities_log_delete AFTER DELETE ON cities
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION log_cities_changes()
+    """,
+]
 
+# create_all() (tests, fresh databases) installs the triggers with the log table
+GeoDataChange.__table__.add_is_dependent_on(GeoData.__table__)
+for statement in CHANGE_LOG_DDL:
+    event.listen(GeoDataChange.__table__, "after_create", DDL(statement))
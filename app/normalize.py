@@ -0,0 +1,115 @@
+"""Geometry validation and normalization on the write path.
+
+Every geometry that is stored goes through `normalize`, one batch at a
+time with vectorized Shapely 2 calls (a single create or update is a batch
+of one). The steps, in order:
+
+1. ``deduplicated``: consecutive repeated vertices are removed.
+2. ``snapped``: coordinates are snapped to GEOMETRY_PRECISION decimal
+   digits, when that is set.
+3. ``repaired``: invalid geometries are rebuilt with ``make_valid``
+   (structure method, so polygons stay polygonal; a self-intersecting
+   Polygon may become a MultiPolygon). With GEOMETRY_INVALID=reject they
+   are refused instead.
+4. ``oriented``: polygon rings follow RFC 7946, exterior rings counter-
+   clockwise and holes clockwise.
+
+Each geometry reports the steps that changed it. Geometries that are empty
+after these steps (e.g. collapsed to nothing by snapping), or whose repair
+produced an unsupported type, are rejected with an error.
+"""
+import os
+from typing import NamedTuple, Optional
+
+import numpy as np
+import shapely
+from fastapi import HTTPException
+from shapely.geometry import shape
+
+GEOMETRY_INVALID = os.getenv("GEOMETRY_INVALID", "repair")
+GEOMETRY_PRECISION = int(os.environ["GEOMETRY_PRECISION"]) if os.getenv("GEOMETRY_PRECISION") else None
+
+SUPPORTED_GEOMETRY_TYPES = {"Point", "LineString", "Polygon", "MultiPoint", "MultiLineString", "MultiPolygon"}
+
+
+class Normalized(NamedTuple):
+    """Per-input results of `normalize`; `geometries[i]` is None when
+    `errors[i]` is set."""
+    geometries: np.ndarray
+    changes: list
+    errors: list
+
+
+def _changed(before, after):
+    return ~shapely.equals_exact(before, after, tolerance=0)
+
+
+def normalize(
+    geometries,
+    precision: Optional[int] = GEOMETRY_PRECISION,
+    repair: bool = GEOMETRY_INVALID == "repair",
+) -> Normalized:
+    """Validate and normalize an array of Shapely geometries."""
+    geometries = np.asarray(geometries, dtype=object)
+    changes = [[] for _ in range(len(geometries))]
+    errors = [None] * len(geometries)
+
+    def record(indexes, step):
+        for i in indexes:
+            changes[i].append(step)
+
+    result = shapely.remove_repeated_points(geometries)
+    removed = shapely.get_num_coordinates(result) != shapely.get_num_coordinates(geometries)
+    record(np.flatnonzero(removed), "deduplicated")
+
+    if precision is not None:
+        # Pointwise snapping works on invalid input too; anything it breaks
+        # is fixed (or rejected) by the validity step below
+        snapped = shapely.set_precision(result, 10 ** -precision, mode="pointwise")
+        record(np.flatnonzero(_changed(result, snapped)), "snapped")
+        result = snapped
+
+    invalid = ~shapely.is_valid(result) & ~shapely.is_empty(result)
+    if invalid.any():
+        if repair:
+            result[invalid] = shapely.make_valid(result[invalid], method="structure", keep_collapsed=False)
+            record(np.flatnonzero(invalid), "repaired")
+        else:
+            for i in np.flatnonzero(invalid):
+                errors[i] = f"Invalid geometry: {shapely.is_valid_reason(result[i])}"
+
+    polygonal = np.flatnonzero(np.isin(shapely.get_type_id(result), (3, 6)))  # Polygon, MultiPolygon
+    if len(polygonal):
+        oriented = shapely.orient_polygons(result[polygonal], exterior_cw=False)
+        record(polygonal[_changed(result[polygonal], oriented)], "oriented")
+        result[polygonal] = oriented
+
+    empty = shapely.is_empty(result)
+    for i, geometry in enumerate(result):
+        if errors[i] is not None:
+            continue
+        if empty[i]:
+            errors[i] = "Geometry is empty after normalization"
+        elif geometry.geom_type not in SUPPORTED_GEOMETRY_TYPES:
+            errors[i] = f"Normalization produced an unsupported {geometry.geom_type}"
+    result[[error is not None for error in errors]] = None
+    return Normalized(result, changes, errors)
+
+
+def normalize_schemas(geometries) -> Normalized:
+    """`normalize` for geojson_pydantic geometries from request bodies."""
+    return normalize([shape(geometry.model_dump()) for geometry in geometries])
+
+
+def normalize_one(geometry):
+    """Normalize one request geometry; returns (shapely geometry, changes)
+    or raises 422."""
+    normalized = normalize_schemas([geometry])
+    if normalized.errors[0] is not None:
+        raise HTTPException(status_code=422, detail=normalized.errors[0])
+    return normalized.geometries[0], normalized.changes[0]
+
+
+def changes_header(changes) -> dict:
+    """Response header listing the normalization steps applied, if any."""
+    return {"X-Geometry-Normalized": ",".join(changes)} if changes else {}
@@ -0,0 +1,427 @@
+"""In-memory read replica of `cities` for database-free spatial reads.
+
+With REPLICA_MODE=memory the app loads every row at startup into numpy
+arrays (ids, versions, names, types) and a Shapely 2 geometry array
+indexed by a ``shapely.STRtree``. Feature, list, bbox/predicate query and
+k-NN reads are then answered from RAM, rendered through the same crud
+serializers as the PostGIS path. Writes still go to Postgres, which stays
+the source of truth.
+
+STRtrees are immutable, so the data is kept in two *segments*: a large
+base segment and a small delta segment. Every REPLICA_REFRESH_INTERVAL
+seconds the features logged in `cities_changes` (app.changes) after the
+replica's position are re-read, the stale copies (and deleted rows) are
+masked out of the segments, and only the delta (plus its tree) is
+rebuilt. The change log numbers changes in commit order, so a
+transaction that commits late is still picked up. Once the delta grows
+past REPLICA_MERGE_ROWS both are merged into a new base. Each refresh
+swaps in a new immutable snapshot, so readers never see a half-applied
+refresh.
+
+Reads therefore lag writes until the next refresh, the writer's own
+included: a moved or deleted feature is served as it was, and lists,
+queries and nearest searches miss new features. A feature fetched by id
+that the replica does not have is read from PostgreSQL instead, so a
+create followed by a GET of the new id does not answer 404.
+"""
+import os
+import threading
+import time
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+import numpy as np
+import shapely
+from shapely.geometry import shape
+from sqlalchemy import func, select
+
+from . import changes, crud, models, schemas
+
+REPLICA_MODE = os.getenv("REPLICA_MODE", "off")
+REPLICA_REFRESH_INTERVAL = float(os.getenv("REPLICA_REFRESH_INTERVAL", "5"))
+REPLICA_MERGE_ROWS = int(os.getenv("REPLICA_MERGE_ROWS", "50000"))
+LOAD_BATCH_SIZE = 50_000
+EARTH_RADIUS_M = 6_371_008.8
+GEOS_TYPE_NAMES = {
+    0: "POINT",
+    1: "LINESTRING",
+    3: "POLYGON",
+    4: "MULTIPOINT",
+    5: "MULTILINESTRING",
+    6: "MULTIPOLYGON",
+    7: "GEOMETRYCOLLECTION",
+}
+
+
+class ReplicaRow(NamedTuple):
+    """Same fields as a crud.feature_columns() row; `wkb` replaces `geojson`
+    for binary formats."""
+    id: int
+    version: int
+    updated_at: datetime
+    name: str
+    geometry_type: str
+    geojson: Optional[str]
+    wkb: Optional[bytes] = None
+
+
+class NearestRow(NamedTuple):
+    """Same fields as a crud.nearest_statement() row."""
+    id: int
+    version: int
+    updated_at: datetime
+    name: str
+    geometry_type: str
+    geojson: str
+    distance: float
+
+
+def _row_columns():
+    return (
+        models.GeoData.id,
+        models.GeoData.version,
+        models.GeoData.updated_at,
+        models.GeoData.name,
+        models.GeoData.type,
+        func.ST_AsBinary(models.GeoData.geometry).label("wkb"),
+    )
+
+
+class _Segment:
+    """Rows sorted by id, with an STRtree over their geometries and a mask
+    of rows that have been superseded or deleted since."""
+
+    def __init__(self, ids, versions, updated_at, names, types, geometries, alive=None):
+        self.ids = ids
+        self.versions = versions
+        self.updated_at = updated_at
+        self.names = names
+        self.types = types
+        self.geometries = geometries
+        self.tree = shapely.STRtree(geometries)
+        self.alive = alive if alive is not None else np.ones(len(ids), dtype=bool)
+
+    @staticmethod
+    def columns(rows):
+        """Column arrays for a batch of _row_columns() rows."""
+        return (
+            np.fromiter((row.id for row in rows), dtype=np.int64, count=len(rows)),
+            np.fromiter((row.version for row in rows), dtype=np.int64, count=len(rows)),
+            np.array([row.updated_at for row in rows], dtype=object),
+            np.array([row.name for row in rows], dtype=object),
+            np.array([row.type for row in rows], dtype=object),
+            shapely.from_wkb(np.array([bytes(row.wkb) for row in rows], dtype=object)),
+        )
+
+    @classmethod
+    def from_rows(cls, rows):
+        return cls(*cls.columns(sorted(rows, key=lambda row: row.id)))
+
+    @classmethod
+    def concat(cls, segments):
+        """Merge the live rows of `segments` into one segment."""
+        parts = [(segment, np.flatnonzero(segment.alive)) for segment in segments]
+        ids = np.concatenate([segment.ids[keep] for segment, keep in parts])
+        order = np.argsort(ids, kind="stable")
+
+        def column(name):
+            return np.concatenate([getattr(segment, name)[keep] for segment, keep in parts])[order]
+
+        return cls(ids[order], column("versions"), column("updated_at"), column("names"), column("types"), column("geometries"))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def live_count(self):
+        return int(self.alive.sum())
+
+    def locate(self, ids):
+        """Positions of `ids` in this segment, -1 where absent or dead."""
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(self.ids):
+            return np.full(len(ids), -1)
+        positions = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+        found = (self.ids[positions] == ids) & self.alive[positions]
+        return np.where(found, positions, -1)
+
+    def without(self, ids):
+        """Copy sharing the arrays and tree, with `ids` masked out."""
+        positions = self.locate(ids)
+        positions = positions[positions >= 0]
+        if not len(positions):
+            return self
+        segment = object.__new__(_Segment)
+        segment.__dict__.update(self.__dict__)
+        segment.alive = self.alive.copy()
+        segment.alive[positions] = False
+        return segment
+
+
+class _Snapshot(NamedTuple):
+    segments: tuple
+    # Change log seq the segments are up to date with
+    position: int
+    loaded_at: float
+
+
+def _reduce(geometries, options: Optional[schemas.GeometryOptions]):
+    """Apply GeometryOptions the way crud.output_geometry() does in PostGIS."""
+    if options is None:
+        return geometries
+    if options.zoom is not None:
+        band = next((z for z in sorted(models.SIMPLIFIED_BANDS) if options.zoom <= z), None)
+        if band is not None:
+            geometries = shapely.simplify(geometries, models.SIMPLIFIED_BANDS[band], preserve_topology=True)
+    if options.simplify:
+        geometries = shapely.simplify(geometries, options.simplify, preserve_topology=True)
+    if options.precision is not None:
+        geometries = shapely.set_precision(geometries, 10 ** -options.precision, mode="pointwise")
+    return geometries
+
+
+def _haversine(lon1, lat1, lon2, lat2):
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+def _geodesic_distances(geometries, lon, lat):
+    """Distance on the sphere from (lon, lat) to the closest point of each geometry."""
+    closest = shapely.get_coordinates(shapely.get_point(shapely.shortest_line(geometries, shapely.Point(lon, lat)), 0))
+    return _haversine(closest[:, 0], closest[:, 1], lon, lat)
+
+
+class MemoryReplica:
+    """Loads, refreshes and queries the in-memory copy of `cities`."""
+
+    def __init__(self, merge_rows: int = REPLICA_MERGE_ROWS):
+        self.merge_rows = merge_rows
+        self.snapshot: Optional[_Snapshot] = None
+        self.session_factory = None
+        self.refreshes = 0
+        self.refresh_lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.snapshot is not None
+
+    def _fetch(self, db, ids):
+        """Current rows of `ids`; deleted ones are simply absent."""
+        rows = []
+        for start in range(0, len(ids), LOAD_BATCH_SIZE):
+            query = select(*_row_columns()).where(models.GeoData.id.in_(ids[start:start + LOAD_BATCH_SIZE]))
+            rows.extend(db.execute(query))
+        return rows
+
+    def load(self, session_factory):
+        """Read the whole table and build the base segment.
+
+        Rows are converted to arrays one server-side batch at a time, so
+        the Python row objects for the whole table never exist at once.
+        """
+        self.session_factory = session_factory
+        with session_factory() as db:
+            self.snapshot = self._load(db)
+
+    def _load(self, db):
+        # The position is read first: every change up to it has committed,
+        # so the table read below includes it. Later changes may be included
+        # too; applying them again on refresh is harmless.
+        changes.sequence_sync(db)
+        position = db.scalar(select(func.coalesce(func.max(models.GeoDataChange.seq), 0)))
+        chunks = []
+        query = select(*_row_columns()).order_by(models.GeoData.id)
+        result = db.execute(query.execution_options(yield_per=LOAD_BATCH_SIZE))
+        for partition in result.partitions():
+            chunks.append(_Segment.columns(partition))
+        if chunks:
+            base = _Segment(*(np.concatenate(column) for column in zip(*chunks)))
+        else:
+            base = _Segment.from_rows([])
+        return _Snapshot((base, _Segment.from_rows([])), position, time.time())
+
+    def refresh(self):
+        """Apply the inserts, updates and deletes logged since the last refresh."""
+        if self.snapshot is None:
+            return
+        with self.refresh_lock, self.session_factory() as db:
+            snapshot = self.snapshot
+            change = models.GeoDataChange
+            changes.sequence_sync(db)
+            oldest = db.scalar(select(func.min(change.seq)))
+            if oldest is not None and snapshot.position < oldest - 1:
+                # Changes after the position have been pruned; start over
+                self.snapshot = self._load(db)
+                self.refreshes += 1
+                return
+            logged = db.execute(select(change.seq, change.feature_id).where(change.seq > snapshot.position)).all()
+            ids = sorted({row.feature_id for row in logged})
+            rows = self._fetch(db, ids)
+
+            base, delta = snapshot.segments
+            changed = [row for row in rows if row.version > self._version(row.id)]
+            deleted = np.setdiff1d(np.asarray(ids, dtype=np.int64), [row.id for row in rows])
+            stale = [row.id for row in changed] + deleted.tolist()
+            base, delta = base.without(stale), delta.without(stale)
+
+            if changed or delta.live_count() != len(delta):
+                delta = _Segment.concat([delta, _Segment.from_rows(changed)])
+            if len(delta) > self.merge_rows:
+                base, delta = _Segment.concat([base, delta]), _Segment.from_rows([])
+
+            position = max((row.seq for row in logged), default=snapshot.position)
+            self.snapshot = _Snapshot((base, delta), position, time.time())
+            self.refreshes += 1
+
+    def _version(self, geo_data_id):
+        for segment in self.snapshot.segments:
+            position = segment.locate([geo_data_id])[0]
+            if position >= 0:
+                return segment.versions[position]
+        return 0
+
+    def _rows(self, hits, options=None, distances=None):
+        """Render (segment, position) hits as crud-compatible rows."""
+        if not hits:
+            return []
+        geometries = np.array([segment.geometries[position] for segment, position in hits], dtype=object)
+        type_ids = shapely.get_type_id(geometries).tolist()
+        geometries = _reduce(geometries, options)
+        fmt = options.format if options is not None else None
+        if fmt is None:
+            geojson, wkb = shapely.to_geojson(geometries).tolist(), [None] * len(hits)
+        else:
+            if fmt == "ewkb":
+                geometries = shapely.set_srid(geometries, 4326)
+            geojson, wkb = [None] * len(hits), shapely.to_wkb(geometries, include_srid=fmt == "ewkb").tolist()
+        rows = []
+        for i, (segment, position) in enumerate(hits):
+            fields = (
+                int(segment.ids[position]),
+                int(segment.versions[position]),
+                segment.updated_at[position],
+                segment.names[position],
+                GEOS_TYPE_NAMES.get(type_ids[i]),
+                geojson[i],
+            )
+            rows.append(NearestRow(*fields, distances[i]) if distances is not None else ReplicaRow(*fields, wkb[i]))
+        return rows
+
+    def get(self, geo_data_id: int, options: Optional[schemas.GeometryOptions] = None):
+        for segment in self.snapshot.segments:
+            position = segment.locate([geo_data_id])[0]
+            if position >= 0:
+                return self._rows([(segment, position)], options)[0]
+        return None
+
+    def _matches(self, segment, bbox=None, geo_query: Optional[schemas.GeoQuery] = None):
+        """Positions of live rows in `segment` that pass the query filters."""
+        if bbox is None and geo_query is None:
+            positions = np.arange(len(segment))
+        else:
+            positions = None
+            if bbox is not None:
+                positions = segment.tree.query(shapely.box(*bbox))
+            if geo_query is not None:
+                geometry = shape(geo_query.geometry.model_dump())
+                if geo_query.predicate == "within":
+                    # ST_Within(row, g) is ST_Contains(g, row)
+                    hits = segment.tree.query(geometry, predicate="contains")
+                elif geo_query.predicate == "dwithin":
+                    hits = segment.tree.query(geometry, predicate="dwithin", distance=geo_query.distance)
+                else:
+                    hits = segment.tree.query(geometry, predicate="intersects")
+                positions = hits if positions is None else np.intersect1d(positions, hits)
+        return positions[segment.alive[positions]]
+
+    def query(
+        self,
+        bbox=None,
+        geo_query: Optional[schemas.GeoQuery] = None,
+        limit: int = 100,
+        after_id: Optional[int] = None,
+        options: Optional[schemas.GeometryOptions] = None,
+    ):
+        """Keyset page of matching rows, limit + 1 like crud.keyset()."""
+        hits = []
+        for segment in self.snapshot.segments:
+            positions = self._matches(segment, bbox, geo_query)
+            if after_id is not None:
+                positions = positions[segment.ids[positions] > after_id]
+            positions = positions[np.argsort(segment.ids[positions], kind="stable")][:limit + 1]
+            hits.extend((segment, position) for position in positions)
+        hits.sort(key=lambda hit: hit[0].ids[hit[1]])
+        return self._rows(hits[:limit + 1], options)
+
+    def nearest(
+        self,
+        lon: float,
+        lat: float,
+        k: int = 10,
+        type: Optional[str] = None,
+        name: Optional[str] = None,
+        options: Optional[schemas.GeometryOptions] = None,
+        candidate_factor: int = 4,
+    ):
+        """k nearest rows by distance on the sphere, nearest first.
+
+        Like crud.nearest_radius_statement() and crud.nearest_statement():
+        the planar nearest candidates, gathered with STRtree dwithin
+        searches of growing radius (in degrees), give a geodesic radius
+        holding at least k rows, and every row within it is then ranked.
+        """
+        point = shapely.Point(lon, lat)
+        wanted = k * candidate_factor
+        radius = 0.01
+        while True:
+            hits = self._hits([point], type, name, predicate="dwithin", distance=radius)
+            if len(hits) >= wanted or radius >= 360:
+                break
+            radius *= 4
+        if not hits:
+            return []
+
+        geometries = np.array([segment.geometries[position] for segment, position in hits], dtype=object)
+        keep = np.argsort(shapely.distance(geometries, point), kind="stable")[:wanted]
+        hits = [hits[i] for i in keep]
+        distances = _geodesic_distances(geometries[keep], lon, lat)
+        if len(hits) >= k:
+            radius = np.sort(distances)[k - 1]
+            boxes = [shapely.box(*bbox) for bbox in crud.geodesic_bounds(lon, lat, radius)]
+            hits = self._hits(boxes, type, name)
+            geometries = np.array([segment.geometries[position] for segment, position in hits], dtype=object)
+            distances = _geodesic_distances(geometries, lon, lat)
+        ids = np.array([segment.ids[position] for segment, position in hits])
+        order = np.lexsort((ids, distances))[:k]
+        return self._rows([hits[i] for i in order], options, distances[order].tolist())
+
+    def _hits(self, geometries, type=None, name=None, **query):
+        """(segment, position) of the live rows an STRtree query with any
+        of `geometries` finds, filtered on exact type and name."""
+        hits = []
+        for segment in self.snapshot.segments:
+            positions = np.unique(np.concatenate([segment.tree.query(geometry, **query) for geometry in geometries]))
+            positions = positions[segment.alive[positions]]
+            if type is not None:
+                positions = positions[segment.types[positions] == type]
+            if name is not None:
+                positions = positions[segment.names[positions] == name]
+            hits.extend((segment, position) for position in positions)
+        return hits
+
+    def stats(self):
+        if self.snapshot is None:
+            return {"enabled": False}
+        base, delta = self.snapshot.segments
+        return {
+            "enabled": True,
+            "rows": base.live_count() + delta.live_count(),
+            "base_rows": len(base),
+            "delta_rows": len(delta),
+            "refreshes": self.refreshes,
+            "position": self.snapshot.position,
+            "age_seconds": round(time.time() - self.snapshot.loaded_at, 3),
+        }
+
+
+replica = MemoryReplica()
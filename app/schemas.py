@@ -1,7 +1,13 @@
-from pydantic import BaseModel, ConfigDict
-from typing import Union
+from datetime import datetime
+from pydantic import BaseModel, ConfigDict, Field, model_validator
+from typing import Annotated, Literal, Optional, Union
 from geojson_pydantic import Point, LineString, Polygon, MultiPoint, MultiLineString, MultiPolygon
 
+Geometry = Union[Point, LineString, Polygon, MultiPoint, MultiLineString, MultiPolygon]
+
+MAX_BATCH_OPERATIONS = 10_000
+
+
 class GeoBase(BaseModel):
     name: str
     type: str
@@ -9,11 +15,219 @@ class GeoBase(BaseModel):
 
 
 class GeoCreate(GeoBase):
-    geometry: Union[Point, LineString, Polygon, MultiPoint, MultiLineString, MultiPolygon]
+    geometry: Geometry
 
 
 class GeoOut(GeoBase):
     id: int
-    geometry: Union[Point, LineString, Polygon, MultiPoint, MultiLineString, MultiPolygon]
+    geometry: Geometry
+
+
+class GeometryOptions(BaseModel):
+    """Read-time geometry reduction, applied in PostGIS."""
+    simplify: Optional[float] = Field(None, ge=0, description="ST_SimplifyPreserveTopology tolerance in degrees")
+    precision: Optional[int] = Field(None, ge=0, le=15, description="Decimal digits per coordinate")
+    zoom: Optional[int] = Field(None, ge=0, le=22, description="Serve the precomputed geometry for this zoom band")
+    # Binary response format negotiated from the Accept header; None is JSON
+    format: Optional[Literal["wkb", "ewkb", "flatgeobuf", "features"]] = None
+    # "summary" renders the precomputed size and location columns instead
+    # of the geometry
+    view: Optional[Literal["summary"]] = None
+
+    def key(self) -> str:
+        """Short representation id used in cache keys and ETags ("" = full detail)."""
+        parts = [f"{name[0]}{value}" for name, value in self.model_dump().items() if value is not None]
+        return "".join(parts)
+
+
+class GeoPage(BaseModel):
+    items: list[GeoOut]
+    next: Optional[int] = None
+
+
+class SizeFilter(BaseModel):
+    """Bounds on the precomputed size columns; None leaves a side open."""
+    min_area: Optional[float] = Field(None, ge=0, description="Square metres")
+    max_area: Optional[float] = Field(None, ge=0, description="Square metres")
+    min_length: Optional[float] = Field(None, ge=0, description="Metres")
+    max_length: Optional[float] = Field(None, ge=0, description="Metres")
+    min_npoints: Optional[int] = Field(None, ge=0)
+    max_npoints: Optional[int] = Field(None, ge=0)
+
+    def key(self) -> str:
+        """Cache key part ("" = no bounds)."""
+        return ",".join(f"{name}={value}" for name, value in self.model_dump().items() if value is not None)
+
+
+class FeatureSummary(BaseModel):
+    id: int
+    name: str
+    type: str
+    bbox: Optional[list[float]]
+    centroid: Optional[list[float]]
+    # Geodesic, in square metres and metres
+    area: float
+    length: float
+    npoints: int
+
+
+class SummaryPage(BaseModel):
+    items: list[FeatureSummary]
+    next: Optional[int] = None
+
+
+class NearestFeature(GeoOut):
+    # Geodesic distance from the query point, in metres
+    distance: float
+
+
+class NearestResult(BaseModel):
+    items: list[NearestFeature]
+
+
+class GeoQuery(BaseModel):
+    predicate: Literal["intersects", "within", "dwithin"] = "intersects"
+    geometry: Geometry
+    # Search radius for "dwithin", in the units of SRID 4326 (degrees)
+    distance: Optional[float] = None
+
+    @model_validator(mode="after")
+    def check_distance(self):
+        if self.predicate == "dwithin" and (self.distance is None or self.distance < 0):
+            raise ValueError("dwithin requires a non-negative distance")
+        return self
+
+
+class BulkImportError(BaseModel):
+    index: int
+    error: str
+
+
+class BulkImportReport(BaseModel):
+    inserted: int = 0
+    failed: int = 0
+    batches: int = 0
+    errors: list[BulkImportError] = []
+    # Number of geometries changed by each normalization step
+    normalized: dict[str, int] = {}
+
+
+class BatchCreate(GeoCreate):
+    op: Literal["create"]
+
+
+class BatchUpdate(GeoCreate):
+    op: Literal["update"]
+    id: int
+
+
+class BatchDelete(BaseModel):
+    op: Literal["delete"]
+    id: int
+
+
+BatchOperation = Annotated[Union[BatchCreate, BatchUpdate, BatchDelete], Field(discriminator="op")]
+
+
+class BatchRequest(BaseModel):
+    # atomic: all operations commit or none do; best_effort: failures are
+    # reported per operation and everything else is committed
+    mode: Literal["atomic", "best_effort"] = "atomic"
+    operations: list[BatchOperation] = Field(..., min_length=1, max_length=MAX_BATCH_OPERATIONS)
+
+
+class BatchResult(BaseModel):
+    index: int
+    op: str
+    status: int
+    id: Optional[int] = None
+    version: Optional[int] = None
+    error: Optional[str] = None
+    # Normalization steps applied to the operation's geometry
+    normalized: Optional[list[str]] = None
+
+
+class BatchReport(BaseModel):
+    created: int = 0
+    updated: int = 0
+    deleted: int = 0
+    failed: int = 0
+    results: list[BatchResult] = []
+
+
+# Bounds are [minx, miny, maxx, maxy]; None when nothing matched
+Extent = Optional[list[float]]
+
+
+class TypeCount(BaseModel):
+    type: str
+    count: int
+    extent: Extent
+
+
+class TypeCounts(BaseModel):
+    items: list[TypeCount]
+
+
+class ExtentSummary(BaseModel):
+    count: int
+    extent: Extent
+
+
+class GridCell(BaseModel):
+    # Snapped cell origin for size grids, geohash prefix for geohash grids
+    x: Optional[float] = None
+    y: Optional[float] = None
+    geohash: Optional[str] = None
+    count: int
+    # Mean centroid of the features in the cell
+    center: list[float]
+
+
+class GridSummary(BaseModel):
+    cells: list[GridCell]
+    # True when the grid had more than MAX_GRID_CELLS non-empty cells
+    truncated: bool
+
+
+class Cluster(BaseModel):
+    cluster: int
+    count: int
+    center: list[float]
+    extent: Extent
+
+
+class ClusterSummary(BaseModel):
+    clusters: list[Cluster]
+    # Features DBSCAN assigned to no cluster
+    noise: int = 0
+
+
+class SearchHit(BaseModel):
+    id: int
+    name: str
+    type: str
+    # A point on the feature, for centering a map on it
+    center: Optional[list[float]]
+    score: float
+
+
+class SearchResult(BaseModel):
+    items: list[SearchHit]
+
+
+class Change(BaseModel):
+    seq: int
+    op: Literal["create", "update", "delete"]
+    id: int
+    version: Optional[int] = None
+    changed_at: datetime
+    # Current state of the feature; None once it has been deleted
+    feature: Optional[GeoOut] = None
 
 
+class ChangeFeed(BaseModel):
+    changes: list[Change]
+    # Pass as `since` to continue from here
+    next: int
+    more: bool
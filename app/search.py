@@ -0,0 +1,105 @@
+"""Name search for autocomplete.
+
+Two modes, each served by its own index (models.GeoData.__table_args__):
+
+- ``prefix``: names starting with the query, case-insensitively, in
+  alphabetical order. A range scan on the B-tree over
+  ``lower(name) COLLATE "C"`` returns them already sorted, so the cost
+  depends on `limit`, not on how many names share the prefix.
+- ``fuzzy``: names containing a word similar to the query (pg_trgm
+  ``<%``, so typos and partial words match), best match first. Candidates
+  come from the trigram GIN index and are ranked by word similarity.
+
+Both combine with the `type` and bbox filters in the same statement.
+Results are small (no geometry, just a representative point), and cached
+with the bbox as their scope like the aggregates.
+"""
+import hashlib
+from typing import Optional
+
+import orjson
+from sqlalchemy import func, literal, select
+
+from . import crud, metrics, models
+from .cache import Rendered, cache
+
+DEFAULT_SEARCH_RESULTS = 10
+MAX_SEARCH_RESULTS = 100
+# Sorts after every other character, so lower(name) < prefix + PREFIX_END
+# holds for exactly the names that start with prefix
+PREFIX_END = "\U0010ffff"
+
+
+def search_statement(
+    q: str,
+    mode: str = "prefix",
+    limit: int = DEFAULT_SEARCH_RESULTS,
+    bbox=None,
+    type: Optional[str] = None,
+):
+    name = models.GeoData.name
+    point = func.ST_PointOnSurface(models.GeoData.geometry)
+    if mode == "fuzzy":
+        query = literal(q)
+        condition = query.op("<%", is_comparison=True)(name)
+        score = func.word_similarity(query, name)
+        order = (query.op("<<->")(name), name, models.GeoData.id)
+    else:
+        # Bounds instead of LIKE, so the range scan also works with the
+        # generic plans of prepared statements
+        prefix = q.lower()
+        key = func.lower(name).collate("C")
+        condition = key.between(prefix, prefix + PREFIX_END)
+        score = func.similarity(func.lower(name), prefix)
+        order = (key, models.GeoData.id)
+    statement = (
+        select(
+            models.GeoData.id,
+            name,
+            func.GeometryType(models.GeoData.geometry).label("geometry_type"),
+            func.ST_X(point).label("x"),
+            func.ST_Y(point).label("y"),
+            score.label("score"),
+        )
+        .where(condition, *crud.query_filters(bbox))
+        .order_by(*order)
+        .limit(limit)
+    )
+    if type is not None:
+        statement = statement.where(models.GeoData.type == type)
+    return statement
+
+
+def hit(row) -> dict:
+    return {
+        "id": row.id,
+        "name": row.name,
+        "type": crud.GEOMETRY_TYPES.get(row.geometry_type, row.geometry_type),
+        "center": [row.x, row.y] if row.x is not None else None,
+        "score": round(row.score, 4),
+    }
+
+
+async def search(
+    db,
+    q: str,
+    mode: str = "prefix",
+    limit: int = DEFAULT_SEARCH_RESULTS,
+    bbox=None,
+    type: Optional[str] = None,
+) -> bytes:
+    """Matching features, best first, as a rendered SearchResult body."""
+    params = [q, mode, limit, bbox, type]
+    key = "search:" + hashlib.sha1(orjson.dumps(params)).hexdigest()
+    rendered = cache.get(key)
+    if rendered is not None:
+        return rendered.body
+    generation = cache.generation()
+    operation = f"search_{mode}"
+    with metrics.DB_SECONDS.time(operation=operation):
+        rows = (await db.execute(search_statement(q, mode, limit, bbox, type))).all()
+    metrics.ROWS_RETURNED.observe(len(rows), operation=operation)
+    with metrics.SERIALIZE_SECONDS.time(operation=operation):
+        body = orjson.dumps({"items": [hit(row) for row in rows]})
+    cache.set(key, Rendered(body), {"extent": list(bbox) if bbox is not None else None}, since=generation)
+    return body
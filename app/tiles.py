@@ -0,0 +1,108 @@
+"""Mapbox Vector Tiles rendered by PostGIS (ST_AsMVT/ST_AsMVTGeom)."""
+import math
+from fastapi import HTTPException
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import layout, metrics
+from .cache import Rendered, cache
+
+MAX_ZOOM = 22
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+TILE_LAYER = "cities"
+MVT_MEDIA_TYPE = "application/vnd.mapbox-vector-tile"
+# Low zoom tiles cover more of the world but get fewer features; the limit
+# doubles every second zoom level up to TILE_MAX_FEATURES
+TILE_MIN_FEATURES = 1000
+TILE_MAX_FEATURES = 20000
+# Web Mercator's latitude limit; geometries are clipped to it (and to the
+# tile) in lon/lat before being projected, since poles have no 3857 image
+MAX_LATITUDE = 85.0511287798066
+
+# Partition pruning, see app.layout; it uses the same :minx, :miny, :maxx,
+# :maxy parameters as the lon/lat envelope, since the planner can't prune
+# on the CTE's
+TILE_REGION_FILTER = "AND " + layout.REGION_SQL.format(geometry="c.geometry") if layout.CITIES_PARTITIONED else ""
+
+TILE_SQL = text(f"""
+WITH bounds AS (
+    SELECT ST_TileEnvelope(:z, :x, :y) AS geom_3857,
+           ST_MakeEnvelope(:minx, :miny, :maxx, :maxy, 4326) AS geom_4326
+),
+features AS (
+    SELECT c.id,
+           c.name,
+           c.type,
+           ST_AsMVTGeom(
+               ST_Transform(ST_Simplify(ST_ClipByBox2D(c.geometry, bounds.geom_4326), :tolerance, true), 3857),
+               bounds.geom_3857, :extent, :buffer, true
+           ) AS geom
+    FROM cities c, bounds
+    WHERE c.geometry && bounds.geom_4326 {TILE_REGION_FILTER}
+    -- Over the limit, the largest features (geodesic area, then length,
+    -- then vertices) are kept; the id makes every render the same
+    ORDER BY c.area DESC, c.length DESC, c.npoints DESC, c.id
+    LIMIT :max_features
+)
+SELECT ST_AsMVT(features, :layer, :extent, 'geom', 'id')
+FROM features
+WHERE geom IS NOT NULL
+""")
+
+
+def simplify_tolerance(z: int) -> float:
+    """Roughly one pixel of a 256px tile at zoom `z`, in degrees."""
+    return 360.0 / (256 * 2 ** z)
+
+
+def feature_limit(z: int) -> int:
+    return min(TILE_MAX_FEATURES, TILE_MIN_FEATURES << (z // 2))
+
+
+def check_tile(z: int, x: int, y: int):
+    if not 0 <= z <= MAX_ZOOM:
+        raise HTTPException(status_code=400, detail=f"z must be between 0 and {MAX_ZOOM}")
+    if not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise HTTPException(status_code=400, detail="Tile coordinates out of range for this zoom")
+
+
+def tile_bounds(z: int, x: int, y: int):
+    """Lon/lat extent of a tile including the ST_AsMVTGeom buffer, within
+    Web Mercator's latitude limit."""
+    n = 2 ** z
+    margin = TILE_BUFFER / TILE_EXTENT
+
+    def lon(tx):
+        return tx / n * 360.0 - 180.0
+
+    def lat(ty):
+        latitude = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * ty / n))))
+        return max(-MAX_LATITUDE, min(MAX_LATITUDE, latitude))
+
+    return lon(x - margin), lat(y + 1 + margin), lon(x + 1 + margin), lat(y - margin)
+
+
+async def get_tile(db: AsyncSession, z: int, x: int, y: int) -> bytes:
+    check_tile(z, x, y)
+    key = f"tile:{z}/{x}/{y}"
+    rendered = cache.get(key)
+    if rendered is not None:
+        return rendered.body
+
+    bounds = tile_bounds(z, x, y)
+    generation = cache.generation()
+    with metrics.DB_SECONDS.time(operation="tile"):
+        result = await db.execute(TILE_SQL, {
+            "z": z,
+            "x": x,
+            "y": y,
+            "tolerance": simplify_tolerance(z),
+            "extent": TILE_EXTENT,
+            "buffer": TILE_BUFFER,
+            "max_features": feature_limit(z),
+            "layer": TILE_LAYER,
+            **layout.region_params(bounds),
+        })
+        tile = bytes(result.scalar() or b"")
+    cache.set(key, Rendered(tile), {"extent": list(bounds)}, since=generation)
+    return tile
@@ -0,0 +1,66 @@
+"""Compare two benchmark suite result files.
+
+Prints the relative change of every latency, throughput and serialization
+metric present in both files, and exits with status 1 if any of them got
+worse by more than --threshold (default 10%), so it can gate CI.
+
+Run with: python -m benchmarks.compare base.json new.json [--threshold 0.1]
+"""
+import argparse
+import json
+import sys
+
+# metric -> True when larger is better
+ENDPOINT_METRICS = {"rps": True, "p50_ms": False, "p99_ms": False}
+
+
+def flatten(results):
+    """{metric key: (value, larger_is_better)} for one result file."""
+    metrics = {}
+    for dataset in results.get("datasets", []):
+        prefix = f"{dataset['kind']}/{dataset['vertices']}v/{dataset['rows']}"
+        for endpoint, values in dataset["endpoints"].items():
+            for metric, higher in ENDPOINT_METRICS.items():
+                metrics[f"{prefix} {endpoint} {metric}"] = (values[metric], higher)
+    for entry in results.get("serialization", []):
+        prefix = f"serialize {entry['kind']}/{entry['vertices']}v"
+        for path, values in entry["paths"].items():
+            metrics[f"{prefix} {path} seconds"] = (values["seconds"], False)
+    return metrics
+
+
+def compare(base, new, threshold):
+    """Yield (key, base value, new value, change, regressed) for shared metrics."""
+    base_metrics, new_metrics = flatten(base), flatten(new)
+    for key in sorted(base_metrics.keys() & new_metrics.keys()):
+        (old, higher), (value, _) = base_metrics[key], new_metrics[key]
+        if not old:
+            continue
+        change = (value - old) / old
+        worse = -change if higher else change
+        yield key, old, value, change, worse > threshold
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("base")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    regressions = 0
+    print(f"{'metric':<52}{'base':>12}{'new':>12}{'change':>9}")
+    for key, old, value, change, regressed in compare(base, new, args.threshold):
+        regressions += regressed
+        print(f"{key:<52}{old:>12.4g}{value:>12.4g}{change:>+9.1%}{'  REGRESSION' if regressed else ''}")
+    print(f"{regressions} regression(s) over {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+"""Load benchmark: async routes vs the sync (threadpool) stack.
+
+Starts two uvicorn servers against the configured database:
+
+- async: ``app.main:app`` (asyncpg + ``async def`` routes)
+- sync:  ``benchmarks.load:sync_app``, the same read endpoints implemented
+         with the psycopg2 ``SessionLocal`` and plain ``def`` routes
+
+then drives both with N concurrent clients and reports req/s and p50/p99
+latency per endpoint. The database needs at least one row in ``cities``.
+
+Run with: python -m benchmarks.load [--concurrency 100] [--requests 5000]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Optional
+
+import httpx
+from fastapi import Depends, FastAPI
+from fastapi.responses import Response
+from sqlalchemy.orm import Session
+
+from app import crud, database
+
+sync_app = FastAPI()
+
+
+@sync_app.get("/geo-data/{geo_data_id}")
+def sync_get_geo_data(geo_data_id: int, db: Session = Depends(database.get_db)):
+    return Response(crud.get_geo_data(db, geo_data_id), media_type="application/json")
+
+
+@sync_app.get("/geo-data/list/")
+def sync_list_geo_data(limit: int = 100, after_id: Optional[int] = None, db: Session = Depends(database.get_db)):
+    return Response(crud.list_geo_data(db, limit, after_id), media_type="application/json")
+
+
+STACKS = {
+    "sync": ("benchmarks.load:sync_app", 8101),
+    "async": ("app.main:app", 8102),
+}
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def run_load(base_url, path, concurrency, total):
+    """Issue `total` GETs from `concurrency` clients. `path` may be a list,
+    which is cycled through (e.g. random ids or bboxes)."""
+    paths = [path] if isinstance(path, str) else path
+    latencies = []
+    errors = 0
+    response_bytes = 0
+    remaining = iter(range(total))
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        async def worker():
+            nonlocal errors, response_bytes
+            for i in remaining:
+                start = time.perf_counter()
+                response = await client.get(paths[i % len(paths)])
+                latencies.append(time.perf_counter() - start)
+                response_bytes += len(response.content)
+                if response.status_code != 200:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    return {
+        "rps": total / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "p90_ms": percentile(latencies, 90) * 1000,
+        "mean_ms": statistics.fmean(latencies) * 1000,
+        "mean_bytes": response_bytes / total,
+        "errors": errors,
+    }
+
+
+def wait_until_ready(base_url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(base_url + "/openapi.json", timeout=1)
+            return
+        except httpx.TransportError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server at {base_url} did not start")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--geo-id", type=int, default=1)
+    parser.add_argument("--limit", type=int, default=50)
+    args = parser.parse_args()
+
+    paths = [f"/geo-data/{args.geo_id}", f"/geo-data/list/?limit={args.limit}"]
+    print(f"{'stack':<7}{'endpoint':<28}{'req/s':>9}{'p50 ms':>9}{'p99 ms':>9}{'errors':>8}")
+    for stack, (target, port) in STACKS.items():
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", target, "--port", str(port), "--log-level", "warning"],
+            env=os.environ.copy(),
+        )
+        try:
+            base_url = f"http://127.0.0.1:{port}"
+            wait_until_ready(base_url)
+            for path in paths:
+                asyncio.run(run_load(base_url, path, args.concurrency, min(args.requests, 200)))  # warm up
+                result = asyncio.run(run_load(base_url, path, args.concurrency, args.requests))
+                print(
+                    f"{stack:<7}{path:<28}{result['rps']:>9.0f}{result['p50_ms']:>9.1f}"
+                    f"{result['p99_ms']:>9.1f}{result['errors']:>8}"
+                )
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""Serialization benchmark: legacy GeoOut path vs the fast paths.
+
+Compares, per geometry type, the time to turn stored WKB into a JSON
+response body:
+
+- legacy:  two ``to_shape`` calls per row, per-coordinate list comprehensions,
+           geojson_pydantic models, ``response_model`` re-validation, JSON encode
+- wkb:     WKB decoded once for the whole batch with vectorized Shapely 2,
+           GEOS GeoJSON writer, orjson assembly
+- postgis: geometries already rendered by ``ST_AsGeoJSON`` in the database,
+           only the orjson assembly runs in Python
+
+Run with: python -m benchmarks.serialization [--rows N] [--vertices N]
+"""
+import argparse
+import json
+import math
+import time
+import tracemalloc
+from collections import namedtuple
+
+import shapely
+from fastapi.encoders import jsonable_encoder
+from geoalchemy2.shape import from_shape, to_shape
+from shapely.geometry import Point, LineString, Polygon, MultiPoint, MultiLineString, MultiPolygon
+from geojson_pydantic import Point as GeoPoint, LineString as GeoLineString, Polygon as GeoPolygon, MultiPoint as GeoMultiPoint, MultiLineString as GeoMultiLineString, MultiPolygon as GeoMultiPolygon
+
+from app import crud, schemas
+
+Row = namedtuple("Row", "id name geometry")
+FeatureRow = namedtuple("FeatureRow", "id name geometry_type geojson")
+GEOS_TYPE_NAMES = {0: "POINT", 1: "LINESTRING", 3: "POLYGON", 4: "MULTIPOINT", 5: "MULTILINESTRING", 6: "MULTIPOLYGON"}
+
+
+def legacy_wkb_to_geojson(wkb_element):
+    """The original per-coordinate WKB -> geojson_pydantic conversion."""
+    shapely_geometry = to_shape(wkb_element)
+    if isinstance(shapely_geometry, Point):
+        coords = [float(x) for x in shapely_geometry.coords[0]]
+        return GeoPoint(type="Point", coordinates=coords)
+    elif isinstance(shapely_geometry, LineString):
+        coords = [[float(x) for x in coord] for coord in shapely_geometry.coords]
+        return GeoLineString(type="LineString", coordinates=coords)
+    elif isinstance(shapely_geometry, Polygon):
+        coords = [[float(x) for x in coord] for coord in shapely_geometry.exterior.coords]
+        return GeoPolygon(type="Polygon", coordinates=[coords])
+    elif isinstance(shapely_geometry, MultiPoint):
+        coords = [[float(x) for x in p.coords[0]] for p in shapely_geometry.geoms]
+        return GeoMultiPoint(type="MultiPoint", coordinates=coords)
+    elif isinstance(shapely_geometry, MultiLineString):
+        coords = [[[float(x) for x in coord] for coord in line.coords] for line in shapely_geometry.geoms]
+        return GeoMultiLineString(type="MultiLineString", coordinates=coords)
+    elif isinstance(shapely_geometry, MultiPolygon):
+        coords = [[[[float(x) for x in coord] for coord in poly.exterior.coords]] for poly in shapely_geometry.geoms]
+        return GeoMultiPolygon(type="MultiPolygon", coordinates=coords)
+    raise ValueError(f"Unsupported geometry type: {type(shapely_geometry)}")
+
+
+def legacy_serialize(rows):
+    out = []
+    for row in rows:
+        geometry_type = type(to_shape(row.geometry)).__name__
+        geo = schemas.GeoOut(id=row.id, name=row.name, type=geometry_type, geometry=legacy_wkb_to_geojson(row.geometry))
+        # FastAPI validates the returned object against response_model again
+        out.append(jsonable_encoder(schemas.GeoOut.model_validate(geo)))
+    return json.dumps(out).encode()
+
+
+def wkb_serialize(rows):
+    # Decode the whole batch once, then take both type and GeoJSON from it
+    geometries = shapely.from_wkb([bytes(row.geometry.data) for row in rows])
+    types = shapely.get_type_id(geometries)
+    geojson = shapely.to_geojson(geometries)
+    return b"[" + b",".join(
+        crud.row_json(FeatureRow(row.id, row.name, GEOS_TYPE_NAMES[t], g)) for row, t, g in zip(rows, types.tolist(), geojson.tolist())
+    ) + b"]"
+
+
+def postgis_serialize(rows):
+    return b"[" + b",".join(crud.row_json(row) for row in rows) + b"]"
+
+
+def ring(n, cx=0.0, cy=0.0, r=1.0):
+    pts = [(cx + r * math.cos(2 * math.pi * i / n), cy + r * math.sin(2 * math.pi * i / n)) for i in range(n)]
+    return pts + [pts[0]]
+
+
+def make_geometry(kind, vertices):
+    if kind == "Point":
+        return Point(12.5, 41.9)
+    if kind == "LineString":
+        return LineString(ring(vertices)[:-1])
+    if kind == "Polygon":
+        return Polygon(ring(vertices))
+    if kind == "MultiPoint":
+        return MultiPoint(ring(vertices)[:-1])
+    if kind == "MultiLineString":
+        return MultiLineString([ring(vertices // 4, cx=i * 3)[:-1] for i in range(4)])
+    if kind == "MultiPolygon":
+        return MultiPolygon([Polygon(ring(vertices // 4, cx=i * 3)) for i in range(4)])
+    raise ValueError(kind)
+
+
+GEOMETRY_KINDS = ("Point", "LineString", "Polygon", "MultiPoint", "MultiLineString", "MultiPolygon")
+SERIALIZERS = {"legacy": legacy_serialize, "wkb": wkb_serialize, "postgis": postgis_serialize}
+
+
+def timed(fn, rows, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(rows)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def peak_memory(fn, rows):
+    """Peak bytes allocated by Python while `fn(rows)` runs."""
+    tracemalloc.start()
+    try:
+        fn(rows)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def measure(kind, rows, vertices, repeat=3):
+    """Best-of-`repeat` seconds and peak memory of each serializer for one geometry type."""
+    geometry = make_geometry(kind, vertices)
+    wkb = from_shape(geometry, srid=4326)
+    inputs = {
+        "legacy": [Row(i, f"{kind} {i}", wkb) for i in range(rows)],
+        "wkb": [Row(i, f"{kind} {i}", wkb) for i in range(rows)],
+        "postgis": [FeatureRow(i, f"{kind} {i}", kind.upper(), shapely.to_geojson(geometry)) for i in range(rows)],
+    }
+    return {
+        name: {
+            "seconds": timed(fn, inputs[name], repeat),
+            "peak_bytes": peak_memory(fn, inputs[name]),
+        }
+        for name, fn in SERIALIZERS.items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--vertices", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'geometry':<16}{'legacy ms':>12}{'wkb ms':>10}{'postgis ms':>12}{'wkb x':>8}{'postgis x':>11}")
+    for kind in GEOMETRY_KINDS:
+        result = measure(kind, args.rows, args.vertices, args.repeat)
+        legacy, fast_wkb, postgis = (result[name]["seconds"] for name in ("legacy", "wkb", "postgis"))
+        print(
+            f"{kind:<16}{legacy * 1000:>12.1f}{fast_wkb * 1000:>10.1f}{postgis * 1000:>12.1f}"
+            f"{legacy / fast_wkb:>8.1f}{legacy / postgis:>11.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""Startup benchmark: cold-start time and per-worker memory per launch mode.
+
+Launch modes:
+
+- uvicorn:   ``uvicorn app.main:app``, one process
+- workers:   ``uvicorn app.main:app --workers N``, every worker is a fresh
+             interpreter that imports the app itself
+- gunicorn:  ``gunicorn -c gunicorn.conf.py`` with N workers, the app is
+             imported once in the master and the workers are forked
+
+For each mode the server is started ``--runs`` times and the script
+records the seconds until the first response and until every worker has
+logged "Application startup complete", then, after a few requests, the
+RSS, PSS and private (unshared) memory of every process from
+/proc/<pid>/smaps_rollup (Linux only). PSS splits shared pages between the
+processes sharing them, so the PSS sum is the real footprint of the
+server. It also records the in-process import time of ``app.main``.
+
+Starting the app needs no database, so this runs anywhere; the probe
+endpoint (/pool/stats) does not connect either.
+
+Run with: python -m benchmarks.startup [--workers 4] [--runs 3] [--output startup.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import httpx
+
+PORT = 8104
+READY_LINE = "Application startup complete"
+PROBE_PATH = "/pool/stats"
+
+
+def commands(mode, workers, port):
+    if mode == "uvicorn":
+        return [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port)]
+    if mode == "workers":
+        return [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--workers", str(workers)]
+    return [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "--bind", f"127.0.0.1:{port}",
+            "--workers", str(workers)]
+
+
+def import_seconds():
+    """Seconds to import app.main in a fresh interpreter."""
+    code = "import time; t = time.perf_counter(); import app.main; print(time.perf_counter() - t)"
+    return float(subprocess.check_output([sys.executable, "-c", code], text=True).strip())
+
+
+def children(pid):
+    """Pids of all descendants of `pid` (Linux only)."""
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The command name may contain spaces; ppid follows the ')'
+                parents[int(entry)] = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+    found = []
+    pending = [pid]
+    while pending:
+        parent = pending.pop()
+        for child, ppid in parents.items():
+            if ppid == parent:
+                found.append(child)
+                pending.append(child)
+    return found
+
+
+def memory(pid):
+    """RSS, PSS and private memory of a process in bytes, or None."""
+    fields = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if value.strip().endswith("kB"):
+                    fields[name] = int(value.split()[0]) * 1024
+        with open(f"/proc/{pid}/cmdline") as f:
+            cmdline = f.read().replace("\0", " ").strip()
+    except OSError:
+        return None
+    return {
+        "pid": pid,
+        "cmdline": cmdline[:120],
+        "rss_bytes": fields.get("Rss"),
+        "pss_bytes": fields.get("Pss"),
+        "private_bytes": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0),
+    }
+
+
+def run_once(mode, workers, port, timeout, requests):
+    expected = 1 if mode == "uvicorn" else workers
+    ready = threading.Event()
+    started = []
+
+    start = time.perf_counter()
+    # Several workers need a shared cache or none (see gunicorn.conf.py)
+    env = {"CACHE_BACKEND": "none", **os.environ}
+    server = subprocess.Popen(
+        commands(mode, workers, port), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, env=env
+    )
+
+    def watch():
+        for line in server.stdout:
+            if READY_LINE in line:
+                started.append(time.perf_counter() - start)
+                if len(started) == expected:
+                    ready.set()
+
+    threading.Thread(target=watch, daemon=True).start()
+    try:
+        base_url = f"http://127.0.0.1:{port}"
+        first_response = None
+        deadline = time.monotonic() + timeout
+        while first_response is None and time.monotonic() < deadline:
+            try:
+                httpx.get(base_url + PROBE_PATH, timeout=1).raise_for_status()
+                first_response = time.perf_counter() - start
+            except httpx.TransportError:
+                time.sleep(0.02)
+        if first_response is None or not ready.wait(max(0, deadline - time.monotonic())):
+            raise RuntimeError(f"{mode} did not start within {timeout}s")
+        with httpx.Client(base_url=base_url) as client:
+            for _ in range(requests):
+                client.get(PROBE_PATH)
+        processes = [m for m in (memory(pid) for pid in [server.pid, *children(server.pid)]) if m is not None]
+    finally:
+        server.terminate()
+        server.wait()
+    return {
+        "first_response_seconds": first_response,
+        "all_workers_seconds": max(started),
+        "processes": processes,
+        "rss_total_bytes": sum(p["rss_bytes"] or 0 for p in processes),
+        "pss_total_bytes": sum(p["pss_bytes"] or 0 for p in processes),
+    }
+
+
+def summarize(runs):
+    last = runs[-1]["processes"]
+    # The master (and uvicorn's resource tracker) do not serve requests
+    workers = last[1:] if len(last) > 1 else last
+    return {
+        "first_response_seconds": statistics.median(r["first_response_seconds"] for r in runs),
+        "all_workers_seconds": statistics.median(r["all_workers_seconds"] for r in runs),
+        "pss_total_bytes": statistics.median(r["pss_total_bytes"] for r in runs),
+        "rss_total_bytes": statistics.median(r["rss_total_bytes"] for r in runs),
+        "worker_pss_bytes": max((p["pss_bytes"] or 0) for p in workers),
+        "worker_private_bytes": max(p["private_bytes"] for p in workers),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", default="uvicorn,workers,gunicorn")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--requests", type=int, default=50, help="requests before memory is read")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--output", help="write the raw results as JSON")
+    args = parser.parse_args(argv)
+
+    results = {"import_seconds": statistics.median(import_seconds() for _ in range(args.runs)), "modes": {}}
+    print(f"import app.main  {results['import_seconds']:.2f} s")
+    mib = 1 << 20
+    for mode in args.modes.split(","):
+        runs = [run_once(mode, args.workers, PORT, args.timeout, args.requests) for _ in range(args.runs)]
+        summary = summarize(runs)
+        results["modes"][mode] = {"workers": 1 if mode == "uvicorn" else args.workers, "summary": summary, "runs": runs}
+        print(f"{mode:<9} first response {summary['first_response_seconds']:.2f} s  "
+              f"all workers {summary['all_workers_seconds']:.2f} s  "
+              f"PSS total {summary['pss_total_bytes'] / mib:.0f} MiB  "
+              f"per worker {summary['worker_pss_bytes'] / mib:.0f} MiB PSS, "
+              f"{summary['worker_private_bytes'] / mib:.0f} MiB private")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
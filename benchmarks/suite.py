@@ -0,0 +1,183 @@
+"""Benchmark suite: load synthetic datasets and measure every read path.
+
+For each dataset (points at each scale, and polygons of each vertex count)
+the suite empties ``cities``, loads the data with ``benchmarks.datagen``,
+starts ``app.main:app`` under uvicorn and drives each endpoint with random
+ids, bboxes and coordinates, recording req/s, p50/p90/p99 latency, mean
+response size and the server's peak RSS. It also runs the in-process
+serialization benchmark per geometry type and vertex count, with peak
+Python memory. Results are written as JSON; compare two runs with
+``python -m benchmarks.compare``.
+
+Polygon datasets are capped at --max-vertices vertices in total, so the
+100k-vertex polygons load a few hundred rows rather than a million.
+
+The suite TRUNCATES ``cities``: point it at a scratch database.
+
+Run with: python -m benchmarks.suite [--scales 10000,100000,1000000] [--output results.json]
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+from sqlalchemy import text
+
+from benchmarks import datagen, serialization
+from benchmarks.load import run_load, wait_until_ready
+
+SCALES = (10_000, 100_000, 1_000_000)
+POLYGON_VERTICES = (10, 100, 1_000, 10_000, 100_000)
+MAX_DATASET_VERTICES = 20_000_000
+SERIALIZATION_VERTICES = (10, 100, 1_000)
+PORT = 8103
+TILE_ZOOM = 8
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def datasets(scales, vertex_counts, max_vertices):
+    for rows in scales:
+        yield {"kind": "points", "vertices": 1, "rows": rows}
+    for vertices in vertex_counts:
+        yield {"kind": "polygons", "vertices": vertices, "rows": min(max(scales), max_vertices // vertices)}
+
+
+def tile_path(lon, lat, z=TILE_ZOOM):
+    n = 2 ** z
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return f"/tiles/{z}/{x}/{y}.mvt"
+
+
+def endpoint_paths(rows, count, seed=0, kind="points"):
+    """Randomized request paths per endpoint, all inside the generated extent."""
+    rng = np.random.default_rng(seed)
+    lon, lat = datagen.random_points(rng, count)
+    ids = rng.integers(1, rows + 1, count)
+    return {
+        "get": [f"/geo-data/{i}" for i in ids],
+        "list": [f"/geo-data/list/?limit=100&after_id={i}" for i in ids],
+        "query_bbox": [f"/geo-data/query/?bbox={x:.4f},{y:.4f},{x + 0.5:.4f},{y + 0.5:.4f}&limit=100" for x, y in zip(lon, lat)],
+        "nearest": [f"/geo-data/nearest/?lon={x:.4f}&lat={y:.4f}&k=20" for x, y in zip(lon, lat)],
+        "tile": [tile_path(x, y) for x, y in zip(lon, lat)],
+        # datagen names features "<kind> <n>"; prefixes of random length
+        "search": [f"/geo-data/search?q={kind}%20{str(i)[:n]}" for i, n in zip(ids, rng.integers(1, 6, count))],
+        "fuzzy": [f"/geo-data/search?q={kind[1:]}%20{i}&mode=fuzzy" for i in ids],
+    }
+
+
+def peak_rss(pid):
+    """Peak resident set size of a process in bytes (Linux only)."""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def run_dataset(dataset, args, session_factory):
+    with session_factory() as db:
+        datagen.truncate(db)
+        start = time.perf_counter()
+        datagen.load(db, dataset["kind"], dataset["rows"], dataset["vertices"], seed=args.seed)
+        load_seconds = time.perf_counter() - start
+        db.execute(text("ANALYZE cities"))
+        db.commit()
+
+    env = os.environ.copy()
+    if not args.cache:
+        env["CACHE_BACKEND"] = "none"
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(PORT), "--log-level", "warning"],
+        env=env,
+    )
+    endpoints = {}
+    try:
+        base_url = f"http://127.0.0.1:{PORT}"
+        wait_until_ready(base_url)
+        for name, paths in endpoint_paths(dataset["rows"], args.requests, args.seed, dataset["kind"]).items():
+            asyncio.run(run_load(base_url, paths, args.concurrency, min(args.requests, 200)))  # warm up
+            endpoints[name] = asyncio.run(run_load(base_url, paths, args.concurrency, args.requests))
+            print(f"  {name:<12}{endpoints[name]['rps']:>9.0f} req/s  p50 {endpoints[name]['p50_ms']:.1f} ms  "
+                  f"p99 {endpoints[name]['p99_ms']:.1f} ms")
+        rss = peak_rss(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+    return {**dataset, "load_seconds": load_seconds, "server_peak_rss_bytes": rss, "endpoints": endpoints}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", default=",".join(map(str, SCALES)), help="point dataset sizes")
+    parser.add_argument("--vertices", default=",".join(map(str, POLYGON_VERTICES)), help="polygon vertex counts")
+    parser.add_argument("--max-vertices", type=int, default=MAX_DATASET_VERTICES)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=2000, help="requests per endpoint")
+    parser.add_argument("--serialization-rows", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cache", action="store_true", help="keep the response cache enabled")
+    parser.add_argument("--skip-endpoints", action="store_true", help="serialization only, no database")
+    parser.add_argument("--output", help="defaults to benchmarks/results/<time>-<commit>.json")
+    args = parser.parse_args(argv)
+
+    commit = git_commit()
+    started = datetime.now(timezone.utc)
+    results = {
+        "meta": {
+            "commit": commit,
+            "started_at": started.isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "datasets": [],
+        "serialization": [],
+    }
+
+    for vertices in SERIALIZATION_VERTICES:
+        for kind in serialization.GEOMETRY_KINDS:
+            print(f"serialization {kind} x{vertices}")
+            results["serialization"].append({
+                "kind": kind,
+                "vertices": vertices,
+                "rows": args.serialization_rows,
+                "paths": serialization.measure(kind, args.serialization_rows, vertices),
+            })
+
+    if not args.skip_endpoints:
+        from app.database import SessionLocal
+
+        scales = [int(s) for s in args.scales.split(",")]
+        vertex_counts = [int(v) for v in args.vertices.split(",")]
+        for dataset in datasets(scales, vertex_counts, args.max_vertices):
+            print(f"{dataset['kind']} x{dataset['rows']} ({dataset['vertices']} vertices)")
+            results["datasets"].append(run_dataset(dataset, args, SessionLocal))
+
+    output = args.output
+    if output is None:
+        os.makedirs(os.path.join("benchmarks", "results"), exist_ok=True)
+        output = os.path.join("benchmarks", "results", f"{started:%Y%m%dT%H%M%S}-{commit or 'nogit'}.json")
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {output}")
+
+
+if __name__ == "__main__":
+    main()
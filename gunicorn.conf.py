@@ -0,0 +1,64 @@
+"""Production launch profile: gunicorn managing uvicorn workers.
+
+Run with: gunicorn -c gunicorn.conf.py
+
+The app is imported once in the master (preload_app) and forked, so the
+workers share its code and read-only pages and start without re-importing
+it. Importing the app creates no engines or connections; each worker
+creates its own in the lifespan (app.database.engines), after the fork.
+Apply migrations (alembic upgrade schema@head) before starting.
+
+Settings from the environment:
+    WEB_CONCURRENCY        worker processes, default: one per CPU core
+    BIND                   default 0.0.0.0:8000
+    GUNICORN_TIMEOUT       seconds before a silent worker is restarted
+    GUNICORN_MAX_REQUESTS  restart workers after this many requests, 0 never
+
+Each worker has its own pools, so the database sees up to
+WEB_CONCURRENCY * 2 * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections.
+
+The response cache must be shared by the workers: the default in-process
+LRU is only invalidated at once in the worker that handled a write, and
+the others serve stale bodies (and 304s) until the change feed reaches
+them (app.changes). With more than one
+worker the server refuses to start unless CACHE_BACKEND is `redis` with a
+REDIS_URL, or `none`.
+"""
+import gc
+import os
+import sys
+
+from app import cache
+
+wsgi_app = "app.main:create_app()"
+worker_class = "uvicorn_worker.UvicornWorker"
+workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+bind = os.getenv("BIND", "0.0.0.0:8000")
+preload_app = True
+
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+graceful_timeout = 30
+keepalive = 5
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "0"))
+max_requests_jitter = max_requests // 10
+
+accesslog = "-"
+errorlog = "-"
+loglevel = os.getenv("LOG_LEVEL", "info")
+
+
+def pre_fork(server, worker):
+    # Move the preloaded app's objects out of the collector's reach, so
+    # collections in the workers don't touch (and copy) their pages
+    gc.freeze()
+
+
+def on_starting(server):
+    # Checked here rather than at import, so --workers on the command line counts
+    if server.cfg.workers > 1 and not cache.shared_across_processes():
+        server.log.error(
+            "CACHE_BACKEND=%s is per process and would serve stale responses with %d workers; "
+            "use CACHE_BACKEND=redis with REDIS_URL, or CACHE_BACKEND=none",
+            cache.CACHE_BACKEND, server.cfg.workers,
+        )
+        sys.exit(1)
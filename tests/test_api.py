@@ -2,14 +2,29 @@ import pytest
 from fastapi.testclient import TestClient
 from fastapi import HTTPException
 from sqlalchemy import create_engine, text
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import sessionmaker, close_all_sessions
-from sqlalchemy.pool import StaticPool
+from sqlalchemy.pool import NullPool, StaticPool
 import os
+import time
+
+from tests.test_config import (
+    TEST_DATABASE_URL, TEST_ASYNC_DATABASE_URL, TEST_DB_NAME, TEST_DB_USER, TEST_DB_PASSWORD, TEST_DB_HOST, TEST_DB_PORT
+)
+
+# The app's own engines (used by background tasks such as the change hub)
+# connect to the test database too
+os.environ.update(
+    POSTGRES_USER=TEST_DB_USER,
+    POSTGRES_PASSWORD=TEST_DB_PASSWORD,
+    POSTGRES_HOST=TEST_DB_HOST,
+    POSTGRES_PORT=TEST_DB_PORT,
+    POSTGRES_DB=TEST_DB_NAME,
+)
 
 from app.main import app
-from app.database import base, get_db
-from app import models
-from tests.test_config import TEST_DATABASE_URL, TEST_DB_NAME
+from app.database import base, get_db, get_async_db
+from app import changes, models
 
 # Create a connection to the default database to create the test database
 default_db_url = TEST_DATABASE_URL.rsplit('/', 1)[0] + '/postgres'
@@ -18,6 +33,10 @@ default_engine = create_engine(default_db_url)
 # Test database setup
 engine = create_engine(TEST_DATABASE_URL)
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# TestClient runs each client on its own event loop, so asyncpg
+# connections must not be pooled across tests
+async_engine = create_async_engine(TEST_ASYNC_DATABASE_URL, poolclass=NullPool)
+TestingAsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 
 # Dependency override
 def override_get_db():
@@ -27,7 +46,12 @@ def override_get_db():
     finally:
         db.close()
 
+async def override_get_async_db():
+    async with TestingAsyncSessionLocal() as db:
+        yield db
+
 app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_async_db] = override_get_async_db
 
 @pytest.fixture(scope="session", autouse=True)
 def setup_test_database():
@@ -84,6 +108,16 @@ def client():
     with TestClient(app) as test_client:
         yield test_client
 
+def sequence_changes():
+    # What the change hubs do in the background, waiting for one that holds the lock
+    for _ in range(100):
+        with engine.begin() as conn:
+            conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": changes.SEQUENCE_LOCK})
+            conn.execute(changes.SEQUENCE_SQL)
+            if not conn.execute(text("SELECT count(*) FROM cities_changes WHERE seq IS NULL")).scalar():
+                return
+        time.sleep(0.05)
+
 def test_create_geo_data_point(client):
     """Test creating a point geometry"""
     response = client.post(
@@ -236,8 +270,57 @@ def test_list_geo_data(client):
     response = client.get("/geo-data/list/")
     assert response.status_code == 200
     data = response.json()
-    assert len(data) > 0
-    assert data[0]["name"] == "Test Point"
+    assert len(data["items"]) > 0
+    assert data["items"][0]["name"] == "Test Point"
+
+def test_list_geo_data_keyset_pagination(client):
+    """Test walking the list endpoint page by page with the next cursor"""
+    for i in range(3):
+        client.post(
+            "/geo-data/create/",
+            json={
+                "name": f"Page Point {i}",
+                "type": "Point",
+                "geometry": {
+                    "type": "Point",
+                    "coordinates": [100.0 + i, 0.0]
+                }
+            }
+        )
+
+    ids = []
+    after_id = None
+    while True:
+        params = {"limit": 2}
+        if after_id is not None:
+            params["after_id"] = after_id
+        response = client.get("/geo-data/list/", params=params)
+        assert response.status_code == 200
+        data = response.json()
+        assert len(data["items"]) <= 2
+        ids.extend(item["id"] for item in data["items"])
+        after_id = data["next"]
+        if after_id is None:
+            break
+
+    assert ids == sorted(ids)
+    assert len(ids) == len(set(ids))
+    assert len(ids) >= 3
+
+def test_stream_geo_data(client):
+    """Test streaming the table as a FeatureCollection and as NDJSON"""
+    response = client.get("/geo-data/list/stream")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/geo+json"
+    collection = response.json()
+    assert collection["type"] == "FeatureCollection"
+    assert len(collection["features"]) > 0
+    assert collection["features"][0]["type"] == "Feature"
+
+    response = client.get("/geo-data/list/stream", params={"format": "ndjson"})
+    assert response.status_code == 200
+    lines = response.text.strip().split("\n")
+    assert len(lines) == len(collection["features"])
 
 def test_get_geo_data(client):
     """Test getting a specific geo data entry"""
@@ -317,4 +400,881 @@ def test_update_geo_data(client):
     assert response.status_code == 200
     data = response.json()
     assert data["name"] == "Updated Point"
-    assert data["geometry"]["coordinates"] == [101.0, 1.0] 
\ No newline at end of file
+    assert data["geometry"]["coordinates"] == [101.0, 1.0] 
+
+def test_query_geo_data_bbox(client):
+    """Test filtering features by bounding box"""
+    inside = client.post(
+        "/geo-data/create/",
+        json={
+            "name": "Inside Point",
+            "type": "Point",
+            "geometry": {
+                "type": "Point",
+                "coordinates": [10.0, 10.0]
+            }
+        }
+    ).json()["id"]
+    outside = client.post(
+        "/geo-data/create/",
+        json={
+            "name": "Outside Point",
+            "type": "Point",
+            "geometry": {
+                "type": "Point",
+                "coordinates": [50.0, 50.0]
+            }
+        }
+    ).json()["id"]
+
+    response = client.get("/geo-data/query/", params={"bbox": "9,9,11,11"})
+    assert response.status_code == 200
+    ids = [item["id"] for item in response.json()["items"]]
+    assert inside in ids
+    assert outside not in ids
+
+    response = client.get("/geo-data/query/", params={"bbox": "11,11,9,9"})
+    assert response.status_code == 400
+
+def test_query_geo_data_predicates(client):
+    """Test intersects and dwithin spatial predicates"""
+    geo_id = client.post(
+        "/geo-data/create/",
+        json={
+            "name": "Predicate Point",
+            "type": "Point",
+            "geometry": {
+                "type": "Point",
+                "coordinates": [-20.0, -20.0]
+            }
+        }
+    ).json()["id"]
+    polygon = {
+        "type": "Polygon",
+        "coordinates": [[[-21.0, -21.0], [-19.0, -21.0], [-19.0, -19.0], [-21.0, -19.0], [-21.0, -21.0]]]
+    }
+
+    response = client.post("/geo-data/query/", json={"predicate": "intersects", "geometry": polygon})
+    assert response.status_code == 200
+    assert geo_id in [item["id"] for item in response.json()["items"]]
+
+    response = client.post(
+        "/geo-data/query/",
+        json={
+            "predicate": "dwithin",
+            "geometry": {"type": "Point", "coordinates": [-20.5, -20.0]},
+            "distance": 1.0
+        }
+    )
+    assert response.status_code == 200
+    assert geo_id in [item["id"] for item in response.json()["items"]]
+
+    response = client.post(
+        "/geo-data/query/",
+        json={"predicate": "dwithin", "geometry": {"type": "Point", "coordinates": [0.0, 0.0]}}
+    )
+    assert response.status_code == 422
+
+def test_bulk_import_feature_collection(client):
+    """Test bulk loading a FeatureCollection with per-feature error reporting"""
+    features = [
+        {
+            "type": "Feature",
+            "properties": {"name": f"Bulk Point {i}", "type": "Point"},
+            "geometry": {"type": "Point", "coordinates": [-60.0 - i * 0.01, -60.0]}
+        }
+        for i in range(5)
+    ]
+    features.append({
+        "type": "Feature",
+        "properties": {"name": "Bowtie"},
+        "geometry": {
+            "type": "Polygon",
+            "coordinates": [[[0.0, 0.0], [1.0, 1.0], [1.0, 0.0], [0.0, 1.0], [0.0, 0.0]]]
+        }
+    })
+    features.append({"type": "Feature", "properties": {"name": "No Geometry"}, "geometry": None})
+
+    response = client.post(
+        "/geo-data/bulk/",
+        params={"batch_size": 2},
+        json={"type": "FeatureCollection", "features": features}
+    )
+    assert response.status_code == 200
+    report = response.json()
+    # The self-intersecting bowtie is repaired on the way in
+    assert report["inserted"] == 6
+    assert report["failed"] == 1
+    assert report["batches"] == 4
+    assert [error["index"] for error in report["errors"]] == [6]
+    assert report["normalized"]["repaired"] == 1
+
+    response = client.get("/geo-data/query/", params={"bbox": "-61,-61,-59,-59"})
+    names = [item["name"] for item in response.json()["items"]]
+    assert all(f"Bulk Point {i}" in names for i in range(5))
+
+def test_bulk_import_ndjson(client):
+    """Test bulk loading newline-delimited GeoJSON"""
+    lines = [
+        '{"type": "Feature", "properties": {"name": "NDJSON Line"}, "geometry": {"type": "LineString", "coordinates": [[-70.0, -70.0], [-69.0, -69.0]]}}',
+        'not json',
+        '{"type": "Feature", "properties": {"name": "NDJSON Point"}, "geometry": {"type": "Point", "coordinates": [-70.5, -70.5]}}',
+    ]
+    response = client.post(
+        "/geo-data/bulk/",
+        params={"format": "ndjson"},
+        content="\n".join(lines).encode()
+    )
+    assert response.status_code == 200
+    report = response.json()
+    assert report["inserted"] == 2
+    assert report["failed"] == 1
+    assert report["errors"][0]["index"] == 1
+
+def test_bulk_import_malformed_feature(client):
+    """Test that malformed JSON only fails its own feature, and truncated input keeps the features before it"""
+    feature = '{"type": "Feature", "properties": {"name": "Malformed Neighbour"}, "geometry": {"type": "Point", "coordinates": [-71.0, -71.0]}}'
+    body = '{"type": "FeatureCollection", "features": [%s, %s, %s, {bad}, %s]}' % ((feature,) * 4)
+    response = client.post("/geo-data/bulk/", params={"batch_size": 100}, content=body.encode())
+    report = response.json()
+    assert report["inserted"] == 4
+    assert report["failed"] == 1
+    assert report["batches"] == 1
+    assert report["errors"][0]["index"] == 3
+
+    body = '{"type": "FeatureCollection", "features": [%s, %s, %s, {"type": ' % ((feature,) * 3)
+    response = client.post("/geo-data/bulk/", params={"batch_size": 100}, content=body.encode())
+    report = response.json()
+    assert report["inserted"] == 3
+    assert report["failed"] == 1
+    assert report["errors"][0]["index"] == -1
+
+def test_pool_stats(client):
+    """Test the connection pool statistics endpoint"""
+    response = client.get("/pool/stats")
+    assert response.status_code == 200
+    data = response.json()
+    assert "pid" in data
+    for name in ("sync", "async"):
+        assert "pool" in data[name]
+
+def test_get_tile(client):
+    """Test rendering a vector tile that contains a feature"""
+    client.post(
+        "/geo-data/create/",
+        json={
+            "name": "Tile Point",
+            "type": "Point",
+            "geometry": {
+                "type": "Point",
+                "coordinates": [12.5, 41.9]
+            }
+        }
+    )
+
+    response = client.get("/tiles/0/0/0.mvt")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/vnd.mapbox-vector-tile"
+    assert len(response.content) > 0
+    assert b"Tile Point" in response.content
+
+    response = client.get("/tiles/1/2/0.mvt")
+    assert response.status_code == 400
+
+def test_tile_keeps_largest_features(client):
+    """Test that a tile over its feature limit keeps the largest features"""
+    from app import tiles
+
+    for name, ring in [
+        ("Tile Small", [[150.0, -45.0], [150.5, -45.0], [150.5, -44.5], [150.0, -45.0]]),
+        ("Tile Large", [[151.0, -47.0], [155.0, -47.0], [155.0, -43.0], [151.0, -47.0]]),
+    ]:
+        client.post("/geo-data/create/", json={"name": name, "type": "Polygon", "geometry": {"type": "Polygon", "coordinates": [ring]}})
+
+    limit = tiles.TILE_MAX_FEATURES
+    tiles.TILE_MAX_FEATURES = 1
+    try:
+        response = client.get("/tiles/5/29/20.mvt")
+    finally:
+        tiles.TILE_MAX_FEATURES = limit
+    assert response.status_code == 200
+    assert b"Tile Large" in response.content
+    assert b"Tile Small" not in response.content
+
+def test_cache_invalidation_on_write(client):
+    """Test that cached responses are served and dropped when the row changes"""
+    geo_id = client.post(
+        "/geo-data/create/",
+        json={
+            "name": "Cached Point",
+            "type": "Point",
+            "geometry": {
+                "type": "Point",
+                "coordinates": [30.0, 30.0]
+            }
+        }
+    ).json()["id"]
+
+    client.get(f"/geo-data/{geo_id}")
+    client.get("/geo-data/query/", params={"bbox": "29,29,31,31"})
+    hits = client.get("/cache/stats").json()["hits"]
+    assert client.get(f"/geo-data/{geo_id}").json()["name"] == "Cached Point"
+    assert client.get("/cache/stats").json()["hits"] == hits + 1
+
+    client.put(
+        f"/geo-data/{geo_id}",
+        json={
+            "name": "Moved Point",
+            "type": "Point",
+            "geometry": {
+                "type": "Point",
+                "coordinates": [35.0, 35.0]
+            }
+        }
+    )
+    assert client.get(f"/geo-data/{geo_id}").json()["name"] == "Moved Point"
+    old_area = client.get("/geo-data/query/", params={"bbox": "29,29,31,31"}).json()
+    assert geo_id not in [item["id"] for item in old_area["items"]]
+
+    client.delete(f"/geo-data/{geo_id}")
+    assert client.get(f"/geo-data/{geo_id}").status_code == 404
+
+def test_cache_skips_bodies_read_before_a_write():
+    """Test that a body read before an invalidation is not cached after it"""
+    from app.cache import LRUBackend, LocalRedis, RedisBackend, Rendered, ResponseCache
+
+    for backend in (LRUBackend(), RedisBackend(LocalRedis())):
+        response_cache = ResponseCache(backend)
+        generation = response_cache.generation()
+        response_cache.invalidate([1], [(0, 0, 1, 1)])
+        response_cache.set("feature:1", Rendered(b"old"), {"ids": [1]}, since=generation)
+        response_cache.set("feature:2", Rendered(b"current"), {"ids": [2]}, since=generation)
+        assert response_cache.get("feature:1") is None
+        assert response_cache.get("feature:2").body == b"current"
+
+def test_cache_follows_changes_made_elsewhere(client):
+    """Test that the change hub drops cached bodies of rows written outside the app"""
+    import asyncio
+
+    geo_id = client.post(
+        "/geo-data/create/",
+        json={"name": "Before", "type": "Point", "geometry": {"type": "Point", "coordinates": [33.0, 33.0]}}
+    ).json()["id"]
+    hub = changes.ChangeHub()
+
+    async def publish():
+        async with TestingAsyncSessionLocal() as db:
+            await hub.publish(db)
+
+    asyncio.run(publish())
+    assert client.get(f"/geo-data/{geo_id}").json()["name"] == "Before"
+
+    # As the CLI loader or another worker would, bypassing this process's cache
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE cities SET name = 'After' WHERE id = :id"), {"id": geo_id})
+    sequence_changes()
+    asyncio.run(publish())
+    assert client.get(f"/geo-data/{geo_id}").json()["name"] == "After"
+
+def test_redis_cache_prunes_expired_scopes():
+    """Test that expired entries leave the Redis scope index"""
+    from app.cache import LocalRedis, RedisBackend, Rendered
+
+    backend = RedisBackend(LocalRedis(), ttl=0.01)
+    backend.set("feature:1", Rendered(b"body"), {"ids": [1]})
+    time.sleep(0.02)
+    backend.invalidate([2], [])
+    assert len(backend) == 0
+
+def test_conditional_requests(client):
+    """Test ETag / If-None-Match handling on features and pages"""
+    geo_id = client.post(
+        "/geo-data/create/",
+        json={
+            "name": "Versioned Point",
+            "type": "Point",
+            "geometry": {
+                "type": "Point",
+                "coordinates": [40.0, 40.0]
+            }
+        }
+    ).json()["id"]
+
+    response = client.get(f"/geo-data/{geo_id}")
+    etag = response.headers["etag"]
+    assert "last-modified" in response.headers
+
+    response = client.get(f"/geo-data/{geo_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+
+    page = client.get("/geo-data/query/", params={"bbox": "39,39,41,41"})
+    page_etag = page.headers["etag"]
+    response = client.get("/geo-data/query/", params={"bbox": "39,39,41,41"}, headers={"If-None-Match": page_etag})
+    assert response.status_code == 304
+
+    spatial_query = {"predicate": "within", "geometry": {"type": "Polygon", "coordinates": [[[39, 39], [41, 39], [41, 41], [39, 41], [39, 39]]]}}
+    spatial_etag = client.post("/geo-data/query/", json=spatial_query).headers["etag"]
+    response = client.post("/geo-data/query/", json=spatial_query, headers={"If-None-Match": spatial_etag})
+    assert response.status_code == 304
+
+    client.put(
+        f"/geo-data/{geo_id}",
+        json={
+            "name": "Versioned Point v2",
+            "type": "Point",
+            "geometry": {
+                "type": "Point",
+                "coordinates": [40.5, 40.5]
+            }
+        }
+    )
+    response = client.get(f"/geo-data/{geo_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    response = client.get("/geo-data/query/", params={"bbox": "39,39,41,41"}, headers={"If-None-Match": page_etag})
+    assert response.status_code == 200
+    response = client.post("/geo-data/query/", json=spatial_query, headers={"If-None-Match": spatial_etag})
+    assert response.status_code == 200
+
+def test_geometry_simplify_and_precision(client):
+    """Test simplify, precision and zoom band options on feature and page reads"""
+    geo_id = client.post(
+        "/geo-data/create/",
+        json={
+            "name": "Detailed Line",
+            "type": "LineString",
+            "geometry": {
+                "type": "LineString",
+                "coordinates": [[-60.123456, -60.0], [-59.5, -59.9999], [-59.0, -60.0]]
+            }
+        }
+    ).json()["id"]
+
+    response = client.get(f"/geo-data/{geo_id}", params={"precision": 2})
+    assert response.status_code == 200
+    assert response.json()["geometry"]["coordinates"][0] == [-60.12, -60]
+
+    response = client.get(f"/geo-data/{geo_id}", params={"simplify": 0.01})
+    assert response.json()["geometry"]["coordinates"] == [[-60.123456, -60.0], [-59.0, -60.0]]
+    assert response.json()["type"] == "LineString"
+
+    response = client.get(f"/geo-data/{geo_id}", params={"zoom": 3})
+    assert len(response.json()["geometry"]["coordinates"]) == 2
+    full = client.get(f"/geo-data/{geo_id}")
+    assert len(full.json()["geometry"]["coordinates"]) == 3
+    assert response.headers["etag"] != full.headers["etag"]
+
+    response = client.get("/geo-data/query/", params={"bbox": "-61,-61,-58,-58", "precision": 1})
+    assert response.json()["items"][0]["geometry"]["coordinates"][0] == [-60.1, -60]
+
+    assert client.get(f"/geo-data/{geo_id}", params={"precision": 16}).status_code == 422
+
+def test_batch_geo_data(client):
+    """Test creating, updating and deleting features in one batch request"""
+    point = {"type": "Point", "coordinates": [70.0, 70.0]}
+    first, second = (
+        client.post("/geo-data/create/", json={"name": f"Batch {i}", "type": "Point", "geometry": point}).json()["id"]
+        for i in range(2)
+    )
+
+    response = client.post(
+        "/geo-data/batch/",
+        json={
+            "operations": [
+                {"op": "create", "name": "Batch New", "type": "Point", "geometry": point},
+                {"op": "update", "id": first, "name": "Batch Updated", "type": "Point", "geometry": point},
+                {"op": "delete", "id": second},
+            ]
+        }
+    )
+    assert response.status_code == 200
+    report = response.json()
+    assert (report["created"], report["updated"], report["deleted"], report["failed"]) == (1, 1, 1, 0)
+    assert [result["status"] for result in report["results"]] == [201, 200, 200]
+    assert report["results"][1]["version"] == 2
+    assert client.get(f"/geo-data/{first}").json()["name"] == "Batch Updated"
+    assert client.get(f"/geo-data/{second}").status_code == 404
+
+    # Atomic: one missing id rolls back the whole batch
+    operations = [
+        {"op": "update", "id": first, "name": "Not Applied", "type": "Point", "geometry": point},
+        {"op": "delete", "id": 999999},
+    ]
+    response = client.post("/geo-data/batch/", json={"operations": operations})
+    assert response.status_code == 409
+    assert response.json()["detail"]["errors"][0]["index"] == 1
+    assert client.get(f"/geo-data/{first}").json()["name"] == "Batch Updated"
+
+    # Best effort: the rest is committed and the failure is reported
+    response = client.post("/geo-data/batch/", json={"mode": "best_effort", "operations": operations})
+    assert response.status_code == 200
+    assert [result["status"] for result in response.json()["results"]] == [200, 404]
+    assert client.get(f"/geo-data/{first}").json()["name"] == "Not Applied"
+
+def test_nearest_geo_data(client):
+    """Test k-nearest-neighbour search ordered by distance"""
+    for i, lon in enumerate([80.0, 80.1, 80.3, 80.2]):
+        client.post(
+            "/geo-data/create/",
+            json={
+                "name": f"Nearest {i}",
+                "type": "Station" if i % 2 else "Point",
+                "geometry": {"type": "Point", "coordinates": [lon, 10.0]}
+            }
+        )
+
+    response = client.get("/geo-data/nearest/", params={"lon": 79.9, "lat": 10.0, "k": 3})
+    assert response.status_code == 200
+    items = response.json()["items"]
+    assert [item["name"] for item in items] == ["Nearest 0", "Nearest 1", "Nearest 3"]
+    assert 10000 < items[0]["distance"] < 12000  # 0.1 degree of longitude at 10N, in metres
+    assert items[0]["distance"] < items[1]["distance"] < items[2]["distance"]
+
+    response = client.get("/geo-data/nearest/", params={"lon": 79.9, "lat": 10.0, "k": 3, "type": "Station"})
+    assert [item["name"] for item in response.json()["items"]] == ["Nearest 1", "Nearest 3"]
+
+    response = client.get("/geo-data/nearest/", params={"lon": 79.9, "lat": 10.0, "name": "Nearest 2"})
+    assert [item["name"] for item in response.json()["items"]] == ["Nearest 2"]
+
+    assert client.get("/geo-data/nearest/", params={"lon": 200, "lat": 10.0}).status_code == 422
+
+    # At 80N a degree of longitude is ~19 km and a degree of latitude ~111 km:
+    # the five features due north/south are closer in degrees, the one to
+    # the east is closer on the ground
+    for name, coordinates in [
+        ("East", [2.0, 80.0]), ("North 1", [0.0, 80.5]), ("North 2", [0.0, 80.6]),
+        ("North 3", [0.0, 80.7]), ("South 1", [0.0, 79.4]), ("South 2", [0.0, 79.3]),
+    ]:
+        client.post(
+            "/geo-data/create/",
+            json={"name": name, "type": "HighLatitude", "geometry": {"type": "Point", "coordinates": coordinates}}
+        )
+    # k=1 reads 4 planar candidates, none of them "East"
+    response = client.get("/geo-data/nearest/", params={"lon": 0.0, "lat": 80.0, "k": 1, "type": "HighLatitude"})
+    items = response.json()["items"]
+    assert [item["name"] for item in items] == ["East"]
+    assert 38_000 < items[0]["distance"] < 39_500
+
+def test_memory_replica(client):
+    """Test reads served from the in-memory replica and its refresh after writes"""
+    from app.replica import replica
+
+    ids = [
+        client.post(
+            "/geo-data/create/",
+            json={"name": f"Replica {i}", "type": "Point", "geometry": {"type": "Point", "coordinates": [-80.0 + i, -10.0]}}
+        ).json()["id"]
+        for i in range(3)
+    ]
+    from_db = client.get("/geo-data/query/", params={"bbox": "-81,-11,-77,-9"}).json()
+
+    sequence_changes()
+    replica.load(TestingSessionLocal)
+    try:
+        assert client.get("/replica/stats").json()["enabled"] is True
+        assert client.get("/geo-data/query/", params={"bbox": "-81,-11,-77,-9"}).json() == from_db
+        assert client.get(f"/geo-data/{ids[0]}").json()["name"] == "Replica 0"
+        nearest = client.get("/geo-data/nearest/", params={"lon": -78.9, "lat": -10.0, "k": 1}).json()["items"]
+        assert nearest[0]["id"] == ids[1]
+        position = client.get("/replica/stats").json()["position"]
+
+        # Not in the replica until the next refresh, but readable by id right away
+        new_id = client.post(
+            "/geo-data/create/",
+            json={"name": "Replica new", "type": "Point", "geometry": {"type": "Point", "coordinates": [-80.0, 10.0]}}
+        ).json()["id"]
+        assert client.get(f"/geo-data/{new_id}").json()["name"] == "Replica new"
+
+        client.put(
+            f"/geo-data/{ids[0]}",
+            json={"name": "Replica moved", "type": "Point", "geometry": {"type": "Point", "coordinates": [100.0, 10.0]}}
+        )
+        client.delete(f"/geo-data/{ids[1]}")
+        sequence_changes()
+        replica.refresh()
+        items = client.get("/geo-data/query/", params={"bbox": "-81,-11,-77,-9"}).json()["items"]
+        assert [item["id"] for item in items] == [ids[2]]
+        assert client.get(f"/geo-data/{ids[0]}").json()["name"] == "Replica moved"
+        assert client.get(f"/geo-data/{ids[1]}").status_code == 404
+        assert client.get("/replica/stats").json()["position"] > position
+    finally:
+        replica.snapshot = None
+
+def test_metrics(client):
+    """Test the Prometheus metrics endpoint"""
+    geo_id = client.post(
+        "/geo-data/create/",
+        json={"name": "Metrics Point", "type": "Point", "geometry": {"type": "Point", "coordinates": [5.0, 5.0]}}
+    ).json()["id"]
+    client.get(f"/geo-data/{geo_id}", params={"precision": 3})
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    body = response.text
+    assert 'http_request_duration_seconds_count{method="GET",route="/geo-data/{geo_data_id}",status="200"}' in body
+    assert 'db_query_duration_seconds_count{operation="get"}' in body
+    assert 'serialization_duration_seconds_count{operation="feature"}' in body
+    assert 'http_response_size_bytes_bucket{method="POST",route="/geo-data/create/",le="+Inf"}' in body
+
+def test_export_geoparquet(client):
+    """Test exporting the table as GeoParquet"""
+    import io
+    import json
+    import pyarrow.parquet as pa_parquet
+    import shapely
+
+    for i in range(3):
+        client.post(
+            "/geo-data/create/",
+            json={"name": f"Export {i}", "type": "ExportPoint", "geometry": {"type": "Point", "coordinates": [120.0 + i, -30.0]}}
+        )
+
+    response = client.get("/geo-data/export/", params={"format": "parquet", "type": "ExportPoint", "bbox": "119,-31,121.5,-29"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/vnd.apache.parquet"
+    table = pa_parquet.read_table(io.BytesIO(response.content))
+    assert json.loads(table.schema.metadata[b"geo"])["primary_column"] == "geometry"
+    assert table.column("name").to_pylist() == ["Export 0", "Export 1"]
+    assert shapely.from_wkb(table.column("geometry").to_pylist()[1]).equals(shapely.Point(121.0, -30.0))
+    assert table.column("bbox").to_pylist()[0] == {"xmin": 120.0, "ymin": -30.0, "xmax": 120.0, "ymax": -30.0}
+
+def test_aggregates(client):
+    """Test type counts, extent, grid and cluster summaries"""
+    coordinates = [[140.0, 60.0], [140.01, 60.01], [140.02, 60.0], [143.0, 62.0], [143.01, 62.0]]
+    for i, point in enumerate(coordinates):
+        client.post(
+            "/geo-data/create/",
+            json={
+                "name": f"Aggregate {i}",
+                "type": "Depot" if i < 3 else "Camp",
+                "geometry": {"type": "Point", "coordinates": point}
+            }
+        )
+    bbox = "139,59,144,63"
+
+    response = client.get("/geo-data/stats/types", params={"bbox": bbox})
+    assert response.status_code == 200
+    assert response.json()["items"] == [
+        {"type": "Depot", "count": 3, "extent": [140.0, 60.0, 140.02, 60.01]},
+        {"type": "Camp", "count": 2, "extent": [143.0, 62.0, 143.01, 62.0]},
+    ]
+
+    response = client.get("/geo-data/stats/extent", params={"bbox": bbox, "type": "Camp"})
+    assert response.json() == {"count": 2, "extent": [143.0, 62.0, 143.01, 62.0]}
+
+    response = client.get("/geo-data/stats/grid", params={"bbox": bbox, "size": 1})
+    cells = response.json()["cells"]
+    assert [(cell["x"], cell["y"], cell["count"]) for cell in cells] == [(140.0, 60.0, 3), (143.0, 62.0, 2)]
+    assert not response.json()["truncated"]
+    response = client.get("/geo-data/stats/grid", params={"bbox": bbox, "geohash": 3})
+    assert sorted(cell["count"] for cell in response.json()["cells"]) == [2, 3]
+    assert client.get("/geo-data/stats/grid", params={"bbox": bbox}).status_code == 400
+
+    response = client.get("/geo-data/stats/clusters", params={"bbox": bbox, "k": 2})
+    assert sorted(cluster["count"] for cluster in response.json()["clusters"]) == [2, 3]
+    response = client.get(
+        "/geo-data/stats/clusters", params={"bbox": bbox, "method": "dbscan", "eps": 0.1, "min_points": 3}
+    )
+    assert [cluster["count"] for cluster in response.json()["clusters"]] == [3]
+    assert response.json()["noise"] == 2
+
+    # Cached summaries are invalidated by writes inside the bbox
+    client.post(
+        "/geo-data/create/",
+        json={"name": "Aggregate 5", "type": "Camp", "geometry": {"type": "Point", "coordinates": [143.02, 62.0]}}
+    )
+    response = client.get("/geo-data/stats/extent", params={"bbox": bbox, "type": "Camp"})
+    assert response.json()["count"] == 3
+
+def test_binary_formats(client):
+    """Test WKB, EWKB and binary feature stream responses negotiated by Accept"""
+    import shapely
+    import struct
+
+    created = client.post(
+        "/geo-data/create/",
+        json={"name": "Binary", "type": "Point", "geometry": {"type": "Point", "coordinates": [-120.0, 70.0]}}
+    ).json()
+
+    response = client.get(f"/geo-data/{created['id']}", headers={"Accept": "application/vnd.ogc.wkb"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/vnd.ogc.wkb"
+    assert response.headers["vary"] == "Accept"
+    assert shapely.from_wkb(response.content).equals(shapely.Point(-120.0, 70.0))
+
+    response = client.get(f"/geo-data/{created['id']}", headers={"Accept": "application/vnd.postgis.ewkb"})
+    assert shapely.get_srid(shapely.from_wkb(response.content)) == 4326
+
+    # Different representations of the same row get different ETags
+    json_etag = client.get(f"/geo-data/{created['id']}").headers["etag"]
+    assert response.headers["etag"] != json_etag
+
+    response = client.get(
+        "/geo-data/query/",
+        params={"bbox": "-121,69,-119,71"},
+        headers={"Accept": "application/vnd.geo-features, application/json;q=0.5"},
+    )
+    assert response.headers["content-type"] == "application/vnd.geo-features"
+    body = response.content
+    length, feature_id, version, name_length = struct.unpack_from("<IqIH", body)
+    assert length == len(body) - 4
+    assert (feature_id, version) == (created["id"], 1)
+    offset = 18 + name_length
+    (type_length,) = struct.unpack_from("<H", body, offset)
+    assert body[18:offset] == b"Binary"
+    assert body[offset + 2:offset + 2 + type_length] == b"Point"
+    assert shapely.from_wkb(body[offset + 2 + type_length:]).equals(shapely.Point(-120.0, 70.0))
+
+    # Bulk imports may leave the name NULL; the record carries an empty one
+    client.post(
+        "/geo-data/bulk/",
+        json={"type": "FeatureCollection", "features": [
+            {"type": "Feature", "properties": {}, "geometry": {"type": "Point", "coordinates": [-125.0, 70.0]}}
+        ]},
+    )
+    response = client.get(
+        "/geo-data/query/", params={"bbox": "-126,69,-124,71"}, headers={"Accept": "application/vnd.geo-features"}
+    )
+    assert response.status_code == 200
+    assert struct.unpack_from("<IqIH", response.content)[3] == 0
+
+    # A bare geometry cannot hold a page
+    response = client.get("/geo-data/list/", headers={"Accept": "application/vnd.ogc.wkb"})
+    assert response.status_code == 406
+    assert client.get("/geo-data/list/", headers={"Accept": "text/html, */*;q=0.8"}).status_code == 200
+
+def test_response_compression(client):
+    """Test gzip response compression and the precompressed variant cache"""
+    from app import compression
+
+    # brotli and zstandard ship with the app, so the default list is fully offered
+    assert compression.ENCODINGS == ["br", "zstd", "gzip"]
+
+    coordinates = [[-100.0 + i * 0.001, -50.0 + i * 0.001] for i in range(500)]
+    created = client.post(
+        "/geo-data/create/",
+        json={"name": "Compressed", "type": "LineString", "geometry": {"type": "LineString", "coordinates": coordinates}}
+    ).json()
+
+    response = client.get(f"/geo-data/{created['id']}", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["vary"]
+    assert int(response.headers["content-length"]) < len(response.content)
+    assert response.json()["geometry"]["coordinates"][0] == [-100.0, -50.0]
+    # The encoded body gets a weak validator, which still revalidates
+    etag = response.headers["etag"]
+    assert etag.startswith("W/")
+    assert client.get(
+        f"/geo-data/{created['id']}", headers={"Accept-Encoding": "gzip", "If-None-Match": etag}
+    ).status_code == 304
+
+    # Served again from the precompressed variant
+    hits = compression.variants.hits
+    client.get(f"/geo-data/{created['id']}", headers={"Accept-Encoding": "gzip"})
+    assert compression.variants.hits == hits + 1
+
+    response = client.get(f"/geo-data/{created['id']}", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in response.headers
+
+    # Small bodies are not worth compressing
+    response = client.get("/pool/stats", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in response.headers
+
+    response = client.get("/geo-data/list/stream", params={"format": "ndjson"}, headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert "content-length" not in response.headers
+    assert any(line for line in response.text.splitlines())
+
+def test_geometry_normalization(client):
+    """Test that written geometries are normalized and the steps are reported"""
+    # Clockwise exterior ring with a repeated vertex
+    response = client.post(
+        "/geo-data/create/",
+        json={
+            "name": "Clockwise",
+            "type": "Polygon",
+            "geometry": {"type": "Polygon", "coordinates": [[[30.0, -40.0], [30.0, -39.0], [30.0, -39.0], [31.0, -39.0], [30.0, -40.0]]]}
+        }
+    )
+    assert response.status_code == 200
+    assert response.headers["x-geometry-normalized"] == "deduplicated,oriented"
+    assert response.json()["geometry"]["coordinates"] == [[[30.0, -40.0], [31.0, -39.0], [30.0, -39.0], [30.0, -40.0]]]
+
+    bowtie = {"type": "Polygon", "coordinates": [[[30.0, -40.0], [31.0, -39.0], [31.0, -40.0], [30.0, -39.0], [30.0, -40.0]]]}
+    created = client.post("/geo-data/create/", json={"name": "Bowtie", "type": "Polygon", "geometry": bowtie})
+    assert "repaired" in created.headers["x-geometry-normalized"]
+    assert created.json()["type"] == "MultiPolygon"
+
+    point = {"type": "Point", "coordinates": [30.5, -39.5]}
+    response = client.put(f"/geo-data/{created.json()['id']}", json={"name": "Point", "type": "Point", "geometry": point})
+    assert response.status_code == 200
+    assert "x-geometry-normalized" not in response.headers
+
+    collapsed = {"type": "LineString", "coordinates": [[30.0, -40.0], [30.0, -40.0]]}
+    response = client.post("/geo-data/create/", json={"name": "Collapsed", "type": "LineString", "geometry": collapsed})
+    assert response.status_code == 422
+
+    response = client.post(
+        "/geo-data/batch/",
+        json={
+            "mode": "best_effort",
+            "operations": [
+                {"op": "create", "name": "Batch Bowtie", "type": "Polygon", "geometry": bowtie},
+                {"op": "create", "name": "Batch Collapsed", "type": "LineString", "geometry": collapsed},
+            ],
+        },
+    )
+    results = response.json()["results"]
+    assert results[0]["status"] == 201
+    assert "repaired" in results[0]["normalized"]
+    assert results[1]["status"] == 422
+
+def test_change_feed(client):
+    """Test the change feed after creates, updates and deletes"""
+    sequence_changes()
+    position = client.get("/geo-data/changes").json()["next"]
+    point = {"name": "Feed Point", "type": "Point", "geometry": {"type": "Point", "coordinates": [40.0, -30.0]}}
+    created = client.post("/geo-data/create/", json=point).json()
+    client.put(f"/geo-data/{created['id']}", json={**point, "name": "Feed Point 2"})
+    client.delete(f"/geo-data/{created['id']}")
+    far = {"name": "Far Point", "type": "Point", "geometry": {"type": "Point", "coordinates": [120.0, 60.0]}}
+    other = client.post("/geo-data/create/", json=far).json()
+    sequence_changes()
+
+    response = client.get("/geo-data/changes", params={"since": position, "bbox": "39,-31,41,-29"})
+    assert response.status_code == 200
+    feed = response.json()
+    assert [(change["op"], change["id"]) for change in feed["changes"]] == [
+        ("create", created["id"]),
+        ("update", created["id"]),
+        ("delete", created["id"]),
+    ]
+    # The feature is gone, so no change carries its state any more
+    assert all(change["feature"] is None for change in feed["changes"])
+    assert not feed["more"]
+    assert client.get("/geo-data/changes", params={"since": feed["next"]}).json()["changes"] == []
+
+    page = client.get("/geo-data/changes", params={"since": position, "limit": 2}).json()
+    assert page["more"]
+    assert [change["seq"] for change in page["changes"]] == [position + 1, position + 2]
+
+    with client.websocket_connect(f"/geo-data/changes/ws?since={position}&bbox=119,59,121,61") as websocket:
+        change = websocket.receive_json()
+        assert (change["op"], change["id"]) == ("create", other["id"])
+        client.put(f"/geo-data/{other['id']}", json={**far, "name": "Far Point 2"})
+        change = websocket.receive_json()
+        assert change["op"] == "update"
+        assert change["feature"]["name"] == "Far Point 2"
+
+def test_search_by_name(client):
+    """Test prefix and fuzzy name search"""
+    for name, geometry_type, coordinates in [
+        ("Searchville", "Point", [50.0, 10.0]),
+        ("Searchburg", "Point", [50.5, 10.5]),
+        ("New Searchville", "Point", [80.0, 20.0]),
+        ("Searchlake", "LineString", [[50.0, 10.0], [51.0, 11.0]]),
+    ]:
+        client.post(
+            "/geo-data/create/",
+            json={"name": name, "type": geometry_type, "geometry": {"type": geometry_type, "coordinates": coordinates}},
+        )
+
+    response = client.get("/geo-data/search", params={"q": "search"})
+    assert response.status_code == 200
+    assert [hit["name"] for hit in response.json()["items"]] == ["Searchburg", "Searchlake", "Searchville"]
+    assert response.json()["items"][0]["center"] == [50.5, 10.5]
+
+    response = client.get("/geo-data/search", params={"q": "SEARCHV", "limit": 1})
+    assert [hit["name"] for hit in response.json()["items"]] == ["Searchville"]
+
+    response = client.get("/geo-data/search", params={"q": "serchville", "mode": "fuzzy"})
+    names = [hit["name"] for hit in response.json()["items"]]
+    assert set(names) == {"Searchville", "New Searchville"}
+
+    response = client.get("/geo-data/search", params={"q": "serchville", "mode": "fuzzy", "bbox": "49,9,52,12"})
+    assert [hit["name"] for hit in response.json()["items"]] == ["Searchville"]
+
+    response = client.get("/geo-data/search", params={"q": "search", "type": "LineString"})
+    assert [hit["name"] for hit in response.json()["items"]] == ["Searchlake"]
+
+    assert client.get("/geo-data/search", params={"q": ""}).status_code == 422
+
+def test_summary_view(client):
+    """Test the summary view and size filters"""
+    square = {"type": "Polygon", "coordinates": [[[-170.0, 0.0], [-169.0, 0.0], [-169.0, 1.0], [-170.0, 1.0], [-170.0, 0.0]]]}
+    line = {"type": "LineString", "coordinates": [[-170.0, 2.0], [-169.0, 2.0]]}
+    created = client.post("/geo-data/create/", json={"name": "Summary Square", "type": "Polygon", "geometry": square}).json()
+    client.post("/geo-data/create/", json={"name": "Summary Line", "type": "LineString", "geometry": line})
+
+    bbox = "-171,-1,-168,3"
+    response = client.get("/geo-data/query/", params={"bbox": bbox, "view": "summary"})
+    assert response.status_code == 200
+    items = {item["name"]: item for item in response.json()["items"]}
+    summary = items["Summary Square"]
+    assert "geometry" not in summary
+    assert summary["bbox"] == [-170.0, 0.0, -169.0, 1.0]
+    assert summary["centroid"] == [-169.5, 0.5]
+    # One square degree at the equator, on the spheroid
+    assert 1.2e10 < summary["area"] < 1.25e10
+    assert summary["length"] == 0
+    assert summary["npoints"] == 5
+    assert 111_000 < items["Summary Line"]["length"] < 111_500
+
+    response = client.get("/geo-data/query/", params={"bbox": bbox, "min_area": 1e9})
+    assert [item["name"] for item in response.json()["items"]] == ["Summary Square"]
+    assert "geometry" in response.json()["items"][0]
+    response = client.get("/geo-data/query/", params={"bbox": bbox, "view": "summary", "max_npoints": 2})
+    assert [item["name"] for item in response.json()["items"]] == ["Summary Line"]
+
+    response = client.get(f"/geo-data/{created['id']}", params={"view": "summary"})
+    assert response.json()["npoints"] == 5
+    response = client.get(
+        f"/geo-data/{created['id']}", params={"view": "summary"}, headers={"Accept": "application/vnd.ogc.wkb"}
+    )
+    assert response.status_code == 406
+
+def _migration(name):
+    import importlib.util
+    path = os.path.join(os.path.dirname(__file__), "..", "alembic", "versions", f"{name}.py")
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def test_storage_layout(client):
+    """Test the geohash clustering and partitioning migrations"""
+    from app import layout
+    from app.crud import bbox_filter
+    from sqlalchemy import func, select
+
+    for name, geometry in [
+        ("Layout Inside", {"type": "Point", "coordinates": [10.0, 45.0]}),
+        ("Layout Meridian", {"type": "LineString", "coordinates": [[-5.0, 40.0], [5.0, 41.0]]}),
+        ("Layout Equator", {"type": "Polygon", "coordinates": [[[120.0, -1.0], [121.0, -1.0], [121.0, 1.0], [120.0, -1.0]]]}),
+    ]:
+        client.post("/geo-data/create/", json={"name": name, "type": geometry["type"], "geometry": geometry})
+
+    cluster, partition = _migration("cluster_cities_by_geohash"), _migration("partition_cities")
+    # The rebuilt table gets every index the model declares
+    declared = {index.name for index in models.GeoData.__table__.indexes}
+    assert declared <= {statement.split()[2] for statement in partition.INDEXES}
+    with engine.connect() as conn:
+        for statement in [cluster.GEOHASH_FUNCTION, *partition.FUNCTIONS]:
+            conn.execute(text(statement))
+        regions = dict(conn.execute(text("SELECT name, cities_region(geometry) FROM cities WHERE name LIKE 'Layout %'")).all())
+        assert regions == {"Layout Inside": 2 + 4 * 1, "Layout Meridian": -1, "Layout Equator": -1}
+
+        # The pruning predicate never drops a row the bbox overlaps
+        for bbox in [(0, 30, 20, 50), (-180, -90, 180, 90), (4, 40.5, 4.5, 40.6), (100, -10, 130, 10), (9, 44, 11, 46)]:
+            overlapping = select(func.count()).where(bbox_filter(bbox))
+            pruned = overlapping.where(layout.region_filter(models.GeoData.geometry, bbox))
+            assert conn.execute(pruned).scalar() == conn.execute(overlapping).scalar() > 0
+
+        conn.execute(text("CREATE INDEX ix_cities_geohash ON cities (cities_geohash(centroid_x, centroid_y))"))
+        [leaf] = layout.leaves(conn, analyze=True)
+        assert leaf.table_name == "cities" and leaf.rows > 0
+        conn.execute(text("DROP INDEX ix_cities_geohash"))
+        conn.commit()
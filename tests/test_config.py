@@ -7,4 +7,5 @@ TEST_DB_NAME = "test_db"
 TEST_DB_PORT = os.getenv("POSTGRES_PORT", "5432")
 TEST_DB_HOST = os.getenv("POSTGRES_HOST", "db")
 
-TEST_DATABASE_URL = f"postgresql+psycopg2://{TEST_DB_USER}:{TEST_DB_PASSWORD}@{TEST_DB_HOST}:{TEST_DB_PORT}/{TEST_DB_NAME}" 
\ No newline at end of file
+TEST_DATABASE_URL = f"postgresql+psycopg2://{TEST_DB_USER}:{TEST_DB_PASSWORD}@{TEST_DB_HOST}:{TEST_DB_PORT}/{TEST_DB_NAME}" 
+TEST_ASYNC_DATABASE_URL = f"postgresql+asyncpg://{TEST_DB_USER}:{TEST_DB_PASSWORD}@{TEST_DB_HOST}:{TEST_DB_PORT}/{TEST_DB_NAME}"
\ No newline at end of file